@@ -0,0 +1,67 @@
+"""
+Decode/encode microbenchmark for the JSON backends objects.codec can use.
+
+python -m benchmarks.bench_codec [profiles.json ...]
+
+Pass recorded /skyblock/profiles responses (plain or .gz) to benchmark real payloads, a synthetic one is used otherwise.
+"""
+import gzip
+import json
+import sys
+import time
+
+from benchmarks.payloads import profiles_response
+from objects import codec
+
+BACKENDS = {"json": (json.loads, lambda obj: json.dumps(obj, separators=(",", ":")).encode())}
+try:
+    import orjson
+
+    BACKENDS["orjson"] = (orjson.loads, orjson.dumps)
+except ImportError:
+    pass
+try:
+    import ujson
+
+    BACKENDS["ujson"] = (ujson.loads, lambda obj: ujson.dumps(obj).encode())
+except ImportError:
+    pass
+
+
+def load_payloads(paths: list) -> dict:
+    payloads = {}
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            payloads[path] = f.read()
+    if not payloads:
+        payloads["synthetic"] = json.dumps(profiles_response("0" * 32, profiles=4, members=4)).encode()
+    return payloads
+
+
+def timeit(func, arg, min_time: float = 1.0) -> float:
+    """Average seconds per call"""
+    runs, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time or runs < 3:
+        func(arg)
+        runs += 1
+    return elapsed / runs
+
+
+def main(paths: list):
+    print(f"objects.codec uses {codec.BACKEND}")
+    for name, raw in load_payloads(paths).items():
+        decoded = json.loads(raw)
+        member = next(iter(decoded["profiles"][0]["members"].values())) if decoded.get("profiles") else decoded
+        print(f"\n{name}: {round(len(raw) / 1024)} KB")
+        baseline = None
+        for backend, (loads, dumps) in BACKENDS.items():
+            decode = timeit(loads, raw)
+            encode = timeit(dumps, member)
+            baseline = baseline or decode
+            print(f"  {backend:<7} decode {decode * 1000:8.2f} ms ({baseline / decode:4.1f}x)"
+                  f"   encode member {encode * 1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
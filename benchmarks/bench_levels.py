@@ -0,0 +1,107 @@
+"""
+Level lookup microbenchmark, objects.levels against the dict scans SkyBlockPlayer used before.
+
+python -m benchmarks.bench_levels [samples]
+
+Every sample is also checked to give the exact same result as the old functions.
+"""
+import random
+import sys
+import time
+
+from objects import levels
+
+
+def legacy_cata_lvl(exp, overflow=False):
+    levels = {
+        1: 50, 2: 75, 3: 110, 4: 160, 5: 230, 6: 330, 7: 470, 8: 670, 9: 950, 10: 1340, 11: 1890, 12: 2665,
+        13: 3760, 14: 5260, 15: 7380, 16: 10300, 17: 14400, 18: 20000, 19: 27600, 20: 38000, 21: 52500, 22: 71500,
+        23: 97000, 24: 132000, 25: 180000, 26: 243000, 27: 328000, 28: 445000, 29: 600000, 30: 800000, 31: 1065000,
+        32: 1410000, 33: 1900000, 34: 2500000, 35: 3300000, 36: 4300000, 37: 5600000, 38: 7200000, 39: 9200000,
+        40: 12000000, 41: 15000000, 42: 19000000, 43: 24000000, 44: 30000000, 45: 38000000, 46: 48000000,
+        47: 60000000, 48: 75000000, 49: 93000000, 50: 116250000,
+    }
+    remaining_xp = exp
+    level50 = sum(levels.values())
+
+    if exp >= level50:
+        return 50 + (exp - level50) / 200000000 if overflow else 50
+
+    for lvl, xp in levels.items():
+        if remaining_xp < xp:
+            decimal = remaining_xp / xp
+            return lvl + decimal - 1
+        remaining_xp -= xp
+    return 0
+
+
+def legacy_skill_lvl(exp, max_level=60):
+    levels = {
+        "0": 0, "1": 50, "2": 175, "3": 375, "4": 675, "5": 1175, "6": 1925, "7": 2925, "8": 4425, "9": 6425,
+        "10": 9925, "11": 14925, "12": 22425, "13": 32425, "14": 47425, "15": 67425, "16": 97425, "17": 147425,
+        "18": 222425, "19": 322425, "20": 522425, "21": 822425, "22": 1222425, "23": 1722425, "24": 2322425,
+        "25": 3022425, "26": 3822425, "27": 4722425, "28": 5722425, "29": 6822425, "30": 8022425, "31": 9322425,
+        "32": 10722425, "33": 12222425, "34": 13822425, "35": 15522425, "36": 17322425, "37": 19222425,
+        "38": 21222425, "39": 23322425, "40": 25522425, "41": 27822425, "42": 30222425, "43": 32722425,
+        "44": 35322425, "45": 38072425, "46": 40972425, "47": 44072425, "48": 47472425, "49": 51172425,
+        "50": 55172425, "51": 59472425, "52": 64072425, "53": 68972425, "54": 74172425, "55": 79672425,
+        "56": 85472425, "57": 91572425, "58": 97972425, "59": 104672425, "60": 111672425
+    }
+    for level in levels:
+        if exp >= levels[str(max_level)]:
+            return max_level
+        if levels[level] > exp:
+            lowexp = levels[str(int(level) - 1)]
+            highexp = levels[level]
+            difference = highexp - lowexp
+            extra = exp - lowexp
+            percentage = (extra / difference)
+            return (int(level) - 1) + percentage
+
+
+def samples(n: int, top: int, seed: int = 0) -> list:
+    """XP spread evenly over the levels, ints and floats, plus every table boundary"""
+    rng = random.Random(seed)
+    values = [0, 1, top - 1, top, top + 1, top * 3]
+    for _ in range(n):
+        exp = rng.uniform(0, 1) ** 4 * top * 1.2  # most players are low level
+        values.append(exp if rng.random() < 0.5 else int(exp))
+    return values
+
+
+def timeit(func, values: list, min_time: float = 1.0) -> float:
+    """Average seconds per lookup"""
+    runs, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time or runs < 3:
+        for exp in values:
+            func(exp)
+        runs += 1
+    return elapsed / runs / len(values)
+
+
+def check(name: str, old, new, values: list):
+    for exp in values:
+        expected, got = old(exp), new(exp)
+        if type(expected) is not type(got) or expected != got:
+            raise AssertionError(f"{name}({exp!r}): expected {expected!r}, got {got!r}")
+
+
+def main(n: int):
+    cases = {
+        "skill (max 60)": (legacy_skill_lvl, levels.skill_level,
+                           samples(n, levels.SKILL_XP[-1]) + list(levels.SKILL_XP)),
+        "skill (max 50)": (lambda exp: legacy_skill_lvl(exp, 50), lambda exp: levels.skill_level(exp, 50),
+                           samples(n, levels.SKILL_XP[50]) + list(levels.SKILL_XP)),
+        "cata": (legacy_cata_lvl, levels.cata_level, samples(n, levels.CATA_XP[-1]) + list(levels.CATA_XP)),
+        "cata overflow": (lambda exp: legacy_cata_lvl(exp, True), lambda exp: levels.cata_level(exp, True),
+                          samples(n, levels.CATA_XP[-1] * 2) + list(levels.CATA_XP)),
+    }
+    for name, (old, new, values) in cases.items():
+        check(name, old, new, values)
+        before, after = timeit(old, values), timeit(new, values)
+        print(f"{name:<15} old {before * 1e9:7.0f} ns   new {after * 1e9:5.0f} ns   ({before / after:4.1f}x)")
+    print(f"\nAll {sum(len(values) for *_, values in cases.values())} lookups identical")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,81 @@
+"""
+Bulk senither weight benchmark, objects.batch_weight against SkyBlockPlayer.senither_weight one player at a time.
+
+python -m benchmarks.bench_weight [players ...]
+
+Defaults to 1k, 100k and 1M players with random XP. SkyBlockPlayer is only timed on the first CHECKED players of each
+run and extrapolated, every one of those is also checked against the batch result.
+"""
+import sys
+import time
+
+import numpy as np
+
+from objects import batch_weight
+from objects.api_objects import SkyBlockPlayer
+
+CHECKED = 5000
+SIZES = (1000, 100000, 1000000)
+
+
+def random_columns(n: int, rng: np.random.Generator) -> dict:
+    """Columns of XP for n players, most of them far from maxed, half the values whole numbers"""
+    def xp(top: float) -> np.ndarray:
+        values = rng.random(n) ** 3 * top
+        return np.where(rng.random(n) < 0.5, np.round(values), np.round(values, 1))
+
+    return {
+        "skills": {skill: xp(150000000) for skill in batch_weight.SKILLS},
+        "slayers": {slayer: np.round(xp(30000000)) for slayer in batch_weight.SLAYERS},
+        "catacombs": xp(1500000000),
+        "classes": {cls: xp(800000000) for cls in batch_weight.CLASSES},
+    }
+
+
+def member_of(cols: dict, i: int) -> dict:
+    """Player i of cols as a profile member"""
+    return {
+        **{f"experience_skill_{skill}": float(cols["skills"][skill][i]) for skill in batch_weight.SKILLS},
+        "slayer_bosses": {slayer: {"xp": int(cols["slayers"][slayer][i])} for slayer in batch_weight.SLAYERS},
+        "dungeons": {
+            "dungeon_types": {"catacombs": {"experience": float(cols["catacombs"][i])}},
+            "player_classes": {cls: {"experience": float(cols["classes"][cls][i])} for cls in batch_weight.CLASSES},
+        },
+    }
+
+
+def player_of(uuid: str, member: dict) -> SkyBlockPlayer:
+    profile = {"profile_id": uuid, "cute_name": "Apple", "members": {uuid: member}}
+    return SkyBlockPlayer(uuid, {"profiles": [profile]})
+
+
+def main(sizes):
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        cols = random_columns(n, rng)
+        start = time.perf_counter()
+        weights = {overflow: batch_weight.senither_weights(cols, overflow) for overflow in (True, False)}
+        batch = time.perf_counter() - start
+
+        checked = min(n, CHECKED)
+        members = [member_of(cols, i) for i in range(checked)]
+        if batch_weight.columns(members)["catacombs"].tolist() != cols["catacombs"][:checked].tolist():
+            raise AssertionError("columns() doesn't give back the columns the members were built from")
+        players = [player_of(f"{i:032x}", member) for i, member in enumerate(members)]
+        start = time.perf_counter()
+        expected = {
+            overflow: np.array([player.senither_weight(overflow) for player in players]) for overflow in (True, False)
+        }
+        single = (time.perf_counter() - start) / checked * n
+        for overflow in (True, False):
+            if not np.allclose(weights[overflow]["total"][:checked], expected[overflow], rtol=1e-9, atol=1e-9):
+                worst = np.argmax(np.abs(weights[overflow]["total"][:checked] - expected[overflow]))
+                raise AssertionError(f"Player {worst} (overflow {overflow}): expected {expected[overflow][worst]!r}, "
+                                     f"got {weights[overflow]['total'][worst]!r}")
+
+        print(f"{n:>8} players   one at a time {single:8.2f} s{' (extrapolated)' if n > checked else ''}   "
+              f"batch {batch:6.3f} s ({single / batch:5.0f}x)")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,127 @@
+"""
+WeightCache benchmark, a guild refresh's weights with and without reusing the ones of profiles that didn't change.
+
+python -m benchmarks.bench_weight_cache [players] [changed fraction]
+
+Every player has 3 profiles and is selected on senither weight, then the lily weight of the selected profile is
+computed, like Tasks.get_player does. The cache is warmed with one refresh, then changed fraction of the players get
+new XP on one profile. Every weight is checked against the uncached one and the memory the cache holds is measured.
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from objects.api_objects import SkyBlockPlayer
+from utils.weights import WeightCache
+
+PLAYERS = 500
+CHANGED = 0.2
+PROFILES = 3
+ROUNDS = 5
+
+
+def random_member(rng: random.Random) -> dict:
+    def xp(top: float) -> float:
+        return round(rng.random() ** 3 * top, rng.choice((0, 1)))
+
+    return {
+        "last_save": rng.randrange(1600000000000, 1700000000000),
+        **{f"experience_skill_{skill}": xp(150000000) for skill in (
+            "taming", "mining", "farming", "combat", "foraging", "fishing", "enchanting", "alchemy", "carpentry",
+            "runecrafting",
+        )},
+        "slayer_bosses": {slayer: {"xp": int(xp(30000000))} for slayer in (
+            "zombie", "spider", "wolf", "enderman", "blaze", "vampire",
+        )},
+        "dungeons": {
+            "dungeon_types": {
+                "catacombs": {
+                    "experience": xp(1500000000),
+                    "tier_completions": {str(tier): rng.randrange(500) for tier in range(8)},
+                },
+                "master_catacombs": {"tier_completions": {str(tier): rng.randrange(100) for tier in range(1, 8)}},
+            },
+            "player_classes": {cls: {"experience": xp(800000000)} for cls in (
+                "healer", "mage", "berserk", "archer", "tank",
+            )},
+        },
+    }
+
+
+def random_players(n: int, rng: random.Random) -> dict:
+    """uuid: /skyblock/profiles data as SkyBlockPlayer takes it"""
+    players = {}
+    for i in range(n):
+        uuid = f"{i:032x}"
+        players[uuid] = {"profiles": [
+            {"profile_id": f"{uuid}{p}", "cute_name": f"Profile {p}", "members": {uuid: random_member(rng)}}
+            for p in range(PROFILES)
+        ]}
+    return players
+
+
+def refresh(players: dict, weight_cache: WeightCache = None) -> dict:
+    """uuid: (senither weight, lily weight) of every player"""
+    weights = {}
+    for uuid, data in players.items():
+        player = SkyBlockPlayer(uuid, data, select_profile_on="weight", weight_cache=weight_cache)
+        weights[uuid] = (player.senither_weight(), _lily(player)["total"])
+    return weights
+
+
+def _lily(player: SkyBlockPlayer) -> dict:
+    coroutine = player.lily_weight(None)  # the skill API is on, lily_weight doesn't wait on anything
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("lily_weight awaited something")
+
+
+def timed(players: dict, weight_cache: WeightCache = None) -> tuple:
+    best, weights = None, None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        weights = refresh(players, weight_cache)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, weights
+
+
+def main(n: int, changed: float):
+    rng = random.Random(0)
+    players = random_players(n, rng)
+    weight_cache = WeightCache(None, max_size=n)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    refresh(players, weight_cache)  # warm
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    for uuid in rng.sample(sorted(players), int(n * changed)):
+        profiles = players[uuid]["profiles"]
+        profiles[rng.randrange(PROFILES)]["members"][uuid] = random_member(rng)
+
+    uncached, expected = timed(players)
+    stats = dict(weight_cache.stats)
+    start = time.perf_counter()
+    first = refresh(players, weight_cache)  # the refresh with changed players, the next ones reuse everything
+    with_changes = time.perf_counter() - start
+    rate = weight_cache.reuse_rate(stats)
+    cached, weights = timed(players, weight_cache)
+    if weights != expected or first != expected:
+        uuid = next(uuid for uuid in expected if weights[uuid] != expected[uuid] or first[uuid] != expected[uuid])
+        raise AssertionError(f"{uuid}: expected {expected[uuid]!r}, got {first[uuid]!r} then {weights[uuid]!r}")
+
+    print(f"{n} players x {PROFILES} profiles, {changed:.0%} changed")
+    print(f"  uncached        {uncached:.3f} s")
+    print(f"  {changed:4.0%} changed     {with_changes:.3f} s ({uncached / with_changes:.1f}x)")
+    print(f"  all reused      {cached:.3f} s ({uncached / cached:.1f}x)")
+    print(f"  reuse rate with the changed players {rate:.1%}")
+    print(f"  cache holds {held / n:.0f} bytes per player")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else PLAYERS, float(sys.argv[2]) if len(sys.argv) > 2 else CHANGED)
@@ -0,0 +1,234 @@
+"""
+Local stand-in for every endpoint Httpr calls, for load testing without touching Hypixel, Mojang or nwapi.
+
+python -m benchmarks.fake_api [--port 8080] [--guild-size 125] [--complexity 1] [--latency 0.05] [--jitter 0.05]
+                              [--limit 120] [--rate-429 0] [--rate-5xx 0] [--rate-reset 0] [--seed 0]
+
+Point the updater at it with FAKE_API=http://127.0.0.1:8080, requests are routed by their Host header so the rate
+limiter still sees the real hosts. Everything is generated from the ids in the request, the same request always gets the
+same payload. Hypixel requests are also limited per API-Key to --limit per minute like the real thing, with the
+RateLimit-* headers. GET /_stats shows what was served.
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import random
+import time
+import uuid as uuid_lib
+
+from aiohttp import web
+
+from benchmarks.payloads import profiles_response
+from objects import codec
+
+
+def seed_of(*parts) -> int:
+    return int.from_bytes(hashlib.sha1(":".join(map(str, parts)).encode()).digest()[:8], "big")
+
+
+def name_of(uuid: str) -> str:
+    return f"Player_{uuid[:8]}"
+
+
+def uuid_of(name: str) -> str:
+    return uuid_lib.UUID(int=seed_of("name", name.lower()) << 64 | seed_of("name2", name.lower())).hex
+
+
+def json_response(data, status: int = 200, headers: dict = None) -> web.Response:
+    return web.Response(body=codec.dumps(data), status=status, headers=headers, content_type="application/json")
+
+
+class FakeApi:
+    def __init__(self, guild_size: int = 125, complexity: float = 1.0, latency: float = 0.05, jitter: float = 0.05,
+                 limit: int = 120, rate_429: float = 0.0, rate_5xx: float = 0.0, rate_reset: float = 0.0,
+                 seed: int = 0):
+        self.guild_size = guild_size
+        self.complexity = complexity
+        self.latency = latency
+        self.jitter = jitter
+        self.limit = limit
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_reset = rate_reset
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.guild_of = {}  # member uuid: guild id, for ?player= lookups
+        self.windows = {}  # API key: (window start, requests in it)
+        self.stats = collections.Counter()
+        self.routes = {
+            ("api.hypixel.net", "/player"): self.player,
+            ("api.hypixel.net", "/skyblock/profiles"): self.profiles,
+            ("api.hypixel.net", "/guild"): self.guild,
+            ("nwapi.guildleaderboard.com", "/networth"): self.networth,
+        }
+
+    """
+    Faults
+    """
+
+    def hypixel_window(self, key: str) -> tuple:
+        now = time.monotonic()
+        start, count = self.windows.get(key, (now, 0))
+        if now - start >= 60:
+            start, count = now, 0
+        self.windows[key] = (start, count + 1)
+        return count + 1, 60 - (now - start)
+
+    async def inject(self, request: web.Request, host: str):
+        """Returns a response to send instead of the real one, or None"""
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        if host == "api.hypixel.net":
+            count, reset = self.hypixel_window(request.headers.get("API-Key", ""))
+            request["ratelimit_headers"] = {
+                "RateLimit-Limit": str(self.limit),
+                "RateLimit-Remaining": str(max(0, self.limit - count)),
+                "RateLimit-Reset": str(int(reset) + 1),
+            }
+            if count > self.limit:
+                self.stats["429_limit"] += 1
+                return json_response({"success": False, "cause": "Key throttle"}, 429, {
+                    **request["ratelimit_headers"], "Retry-After": str(int(reset) + 1)
+                })
+        roll = self.rng.random()
+        if roll < self.rate_reset:
+            self.stats["resets"] += 1
+            request.transport.abort()
+            return web.Response(status=500)  # never sent, the connection is already gone
+        roll -= self.rate_reset
+        if roll < self.rate_429:
+            self.stats["429_injected"] += 1
+            retry_after = self.rng.randint(1, 5)
+            return json_response({"success": False, "cause": "Too many requests"}, 429, {"Retry-After": str(retry_after)})
+        roll -= self.rate_429
+        if roll < self.rate_5xx:
+            self.stats["5xx"] += 1
+            return web.Response(status=self.rng.choice((500, 502, 503, 504)), text="Fake error")
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        host = request.host.split(":")[0]
+        path = request.path
+        if path == "/_stats":
+            return json_response(dict(self.stats))
+        fault = await self.inject(request, host)
+        if fault is not None:
+            return fault
+        handler = self.routes.get((host, path))
+        if handler is None and host == "api.mojang.com" and path.startswith("/users/profiles/minecraft/"):
+            handler = self.mojang_uuid
+        elif handler is None and host == "api.mojang.com" and path.startswith("/user/profiles/"):
+            handler = self.mojang_names
+        elif handler is None and host == "sessionserver.mojang.com" and path.startswith("/session/minecraft/profile/"):
+            handler = self.session_profile
+        if handler is None:
+            self.stats["404"] += 1
+            return json_response({"success": False, "cause": f"No fake for {host}{path}"}, 404)
+        self.stats[handler.__name__] += 1
+        response = await handler(request)
+        response.headers.update(request.get("ratelimit_headers", {}))
+        return response
+
+    """
+    Hypixel
+    """
+
+    def guild_payload(self, guild_id: str) -> dict:
+        rng = random.Random(seed_of(self.seed, "guild", guild_id))
+        members = [uuid_lib.UUID(int=rng.getrandbits(128)).hex for _ in range(self.guild_size)]
+        for member_uuid in members:
+            self.guild_of.setdefault(member_uuid, guild_id)
+        return {
+            "_id": guild_id,
+            "name": f"Guild {guild_id[:6]}",
+            "created": 1500000000000,
+            "members": [
+                {"uuid": member_uuid, "rank": "Guild Master" if i == 0 else "Member",
+                 "joined": 1500000000000 + rng.randint(0, 10 ** 11)}
+                for i, member_uuid in enumerate(members)
+            ],
+        }
+
+    async def player(self, request: web.Request) -> web.Response:
+        uuid = request.query.get("uuid", "")
+        return json_response({"success": True, "player": {
+            "uuid": uuid, "displayname": name_of(uuid), "achievements": {"skyblock_sb_levels": 200}
+        }})
+
+    async def profiles(self, request: web.Request) -> web.Response:
+        uuid = request.query.get("uuid", "")
+        rng = random.Random(seed_of(self.seed, "profiles", uuid))
+        data = profiles_response(uuid, profiles=rng.randint(1, 4), members=rng.randint(1, 4),
+                                 complexity=self.complexity, seed=seed_of(self.seed, uuid))
+        data["profiles"][rng.randrange(len(data["profiles"]))]["selected"] = True
+        return json_response(data)
+
+    async def guild(self, request: web.Request) -> web.Response:
+        if "id" in request.query:
+            guild_id = request.query["id"]
+        elif "player" in request.query:
+            guild_id = self.guild_of.get(request.query["player"]) or f"{seed_of(request.query['player']):024x}"[:24]
+        elif "name" in request.query:
+            guild_id = f"{seed_of(request.query['name'].lower()):024x}"[:24]
+        else:
+            return json_response({"success": False, "cause": "Missing one or more fields [id, player, name]"}, 400)
+        guild = self.guild_payload(guild_id)
+        if "player" in request.query and request.query["player"] not in self.guild_of:
+            guild["members"][0]["uuid"] = request.query["player"]
+            self.guild_of[request.query["player"]] = guild_id
+        return json_response({"success": True, "guild": guild})
+
+    """
+    nwapi
+    """
+
+    async def networth(self, request: web.Request) -> web.Response:
+        body = codec.loads(await request.read())
+        if "profileData" not in body:
+            return json_response({"cause": "Missing profileData"}, 400)
+        rng = random.Random(seed_of(self.seed, "networth", request.query.get("uuid", "")))
+        return json_response({"networth": rng.random() * 10 ** 10, "purse": body["profileData"].get("coin_purse", 0),
+                              "bank": body.get("bankBalance", 0)})
+
+    """
+    Mojang
+    """
+
+    async def mojang_uuid(self, request: web.Request) -> web.Response:
+        name = request.path.rsplit("/", 1)[-1]
+        return json_response({"id": uuid_of(name), "name": name})
+
+    async def mojang_names(self, request: web.Request) -> web.Response:
+        uuid = request.path.split("/")[3]
+        return json_response([{"name": f"Old_{uuid[:6]}"}, {"name": name_of(uuid)}])
+
+    async def session_profile(self, request: web.Request) -> web.Response:
+        uuid = request.path.rsplit("/", 1)[-1]
+        return json_response({"id": uuid, "name": name_of(uuid), "properties": []})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--guild-size", type=int, default=125)
+    parser.add_argument("--complexity", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--limit", type=int, default=120, help="Hypixel requests per minute per API-Key")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--rate-reset", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = vars(parser.parse_args())
+    host, port = args.pop("host"), args.pop("port")
+    web.run_app(FakeApi(**{key.replace("-", "_"): value for key, value in args.items()}).app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Synthetic Hypixel payloads shaped like the real responses, for benchmarks when no recorded payloads are at hand.
+"""
+import base64
+import random
+import uuid as uuid_lib
+
+SKILLS = ["mining", "foraging", "enchanting", "farming", "combat", "fishing", "alchemy", "taming", "carpentry",
+          "runecrafting", "social"]
+SLAYERS = ["zombie", "spider", "wolf", "enderman", "blaze", "vampire"]
+CLASSES = ["healer", "mage", "berserk", "archer", "tank"]
+INVENTORIES = ["inv_contents", "inv_armor", "equippment_contents", "wardrobe_contents", "ender_chest_contents",
+               "personal_vault_contents", "talisman_bag", "potion_bag", "fishing_bag", "quiver",
+               "candy_inventory_contents"]
+
+
+def _nbt_blob(rng: random.Random, size: int) -> dict:
+    # the real thing is gzipped NBT, random bytes compress about as badly
+    return {"type": 0, "data": base64.b64encode(rng.randbytes(size)).decode()}
+
+
+def member(rng: random.Random, complexity: float = 1.0) -> dict:
+    """One entry of profile["members"], complexity scales the inventories, collections and stats"""
+    data = {
+        "last_save": 1660000000000 + rng.randint(0, 10 ** 9),
+        "first_join": 1560000000000 + rng.randint(0, 10 ** 9),
+        "coin_purse": rng.random() * 10 ** 8,
+        "fairy_souls_collected": rng.randint(0, 238),
+        "leveling": {"experience": rng.randint(0, 40000)},
+        "slayer_bosses": {
+            slayer: {
+                "xp": rng.randint(0, 5 * 10 ** 6),
+                **{f"boss_kills_tier_{tier}": rng.randint(0, 2000) for tier in range(5)},
+            } for slayer in SLAYERS
+        },
+        "dungeons": {
+            "dungeon_types": {
+                "catacombs": {
+                    "experience": rng.random() * 10 ** 9,
+                    "tier_completions": {str(floor): rng.randint(0, 1000) for floor in range(8)},
+                    "fastest_time": {str(floor): rng.randint(10 ** 5, 10 ** 6) for floor in range(8)},
+                },
+                "master_catacombs": {
+                    "tier_completions": {str(floor): rng.randint(0, 500) for floor in range(1, 8)},
+                },
+            },
+            "player_classes": {cls: {"experience": rng.random() * 3 * 10 ** 8} for cls in CLASSES},
+        },
+        "collection": {f"COLLECTION_{i}": rng.randint(0, 10 ** 8) for i in range(int(80 * complexity))},
+        "stats": {f"stat_{i}": rng.random() * 10 ** 4 for i in range(int(400 * complexity))},
+        "objectives": {f"objective_{i}": {"status": "COMPLETE", "progress": 0, "completed_at": rng.randint(0, 10 ** 12)}
+                       for i in range(int(60 * complexity))},
+        "sacks_counts": {f"SACK_ITEM_{i}": rng.randint(0, 10 ** 5) for i in range(int(150 * complexity))},
+        "pets": [
+            {"uuid": str(uuid_lib.UUID(int=rng.getrandbits(128))), "type": f"PET_{i}", "exp": rng.random() * 10 ** 7,
+             "active": i == 0, "tier": "LEGENDARY", "heldItem": None, "candyUsed": 0, "skin": None}
+            for i in range(int(40 * complexity))
+        ],
+        **{f"essence_{kind}": rng.randint(0, 10 ** 5) for kind in ["wither", "dragon", "spider", "undead", "diamond"]},
+        **{inventory: _nbt_blob(rng, int(6000 * complexity)) for inventory in INVENTORIES},
+        "backpack_contents": {str(i): _nbt_blob(rng, int(3000 * complexity)) for i in range(int(9 * complexity))},
+    }
+    for skill in SKILLS:
+        data[f"experience_skill_{skill}"] = rng.random() * 10 ** 8
+    return data
+
+
+def profiles_response(uuid: str, profiles: int = 3, members: int = 3, complexity: float = 1.0, seed: int = 0) -> dict:
+    """A /skyblock/profiles response for uuid, every profile has the player plus members - 1 co-op members"""
+    rng = random.Random(seed)
+    return {
+        "success": True,
+        "profiles": [
+            {
+                "profile_id": uuid_lib.UUID(int=rng.getrandbits(128)).hex,
+                "cute_name": f"Profile{i}",
+                "game_mode": "ironman" if i == 2 else "normal",
+                "banking": {"balance": rng.random() * 10 ** 9, "transactions": []},
+                "members": {
+                    member_uuid: member(rng, complexity)
+                    for member_uuid in [uuid, *[uuid_lib.UUID(int=rng.getrandbits(128)).hex for _ in range(members - 1)]]
+                },
+            } for i in range(profiles)
+        ],
+    }
@@ -7,6 +7,10 @@ import asyncpg
 import discord
 from discord import Webhook
 
+from objects.cache import HYPIXEL_KEYS, MemoryLimiter, bucket_name, ratelimit_wait
+from objects.pg_limiter import PostgresLimiter
+from utils.httpr import RATELIMIT_BACKEND
+
 
 def get_xp_lvl(exp):
     levels = {
@@ -292,7 +296,8 @@ class SkyBlockPlayer:
     async def get_name(self, client, max_ratelimit_wait) -> str:
         if self._name:
             return self._name
-        self._name = await client.httpr.get_name(self.uuid, max_ratelimit_wait)
+        with ratelimit_wait(max_ratelimit_wait):
+            self._name = await client.httpr.get_name(self.uuid)
         return self._name
 
     @staticmethod
@@ -509,10 +514,21 @@ class Database:
 
 class Httpr:
     session: aiohttp.ClientSession = None
-    key = "023e759c-4f2c-40e6-a6d3-c1d93a438c98"
+    ratelimit = None
+    key = HYPIXEL_KEYS[0] if HYPIXEL_KEYS else "023e759c-4f2c-40e6-a6d3-c1d93a438c98"
 
     async def main(self):
-        Httpr.session = aiohttp.ClientSession()
+        Httpr.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=10, keepalive_timeout=75, ttl_dns_cache=300)
+        )
+        # with RATELIMIT_BACKEND=postgres this is the bucket the updater uses for the key, so running both can't go over
+        # its limit. With memory (the default) neither process knows about the other's requests.
+        if RATELIMIT_BACKEND == "postgres":
+            limiter = PostgresLimiter(Database.pool)
+        else:
+            limiter = MemoryLimiter()
+            print("RATELIMIT_BACKEND isn't postgres, the rate-limit isn't shared with the updater")
+        Httpr.ratelimit = limiter.bucket(bucket_name("api.hypixel.net", self.key), 100, 5)
 
     async def get_ah_page(self, page: int) -> dict:
         async with self.session.get(f"https://api.hypixel.net/skyblock/auctions?page={page}") as r:
@@ -520,11 +536,15 @@ class Httpr:
                 return await r.json()
 
     async def get_guild_inf(self, id: str) -> dict:
+        await self.ratelimit.acquire()
+        self.ratelimit.release()
         async with self.session.get(f"https://api.hypixel.net/guild?key={self.key}&id={id}") as r:
             if r.status == 200:
                 return await r.json()
 
     async def get_player_inf(self, uuid: str) -> dict:
+        await self.ratelimit.acquire()
+        self.ratelimit.release()
         async with self.session.get(f"https://api.hypixel.net/skyblock/profiles?uuid={uuid}&key={self.key}") as r:
             if r.status == 200:
                 return SkyBlockPlayer(
@@ -711,9 +731,8 @@ async def main():
             em = discord.Embed(title=guild_info["guild"]["name"],
                                description=f"Average Weight: {average_weight}\nMembers: {len(guild_members)}")
 
-            async with aiohttp.ClientSession() as session:
-                webhook = Webhook.from_url(webhook_url, session=session)
-                await webhook.send(embed=em)
+            webhook = Webhook.from_url(webhook_url, session=http.session)  # reuse the pooled connections
+            await webhook.send(embed=em)
 
 
 asyncio.run(main())
@@ -5,7 +5,10 @@ from dotenv import load_dotenv
 
 from utils.database import Database
 from utils.httpr import Httpr
+from utils.names import NameResolver
+from utils.networth import NetworthCache
 from utils.tasks import Tasks
+from utils.weights import WeightCache
 
 load_dotenv(".env")
 
@@ -15,6 +18,9 @@ class Client:
         self.loop: asyncio.BaseEventLoop = None
         self.db: Database = None
         self.httpr: Httpr = None
+        self.names: NameResolver = None
+        self.networth: NetworthCache = None
+        self.weights: WeightCache = None
         self.tasks: Tasks = None
         self.logger = logging.getLogger("backend")
         self.logger.setLevel(logging.INFO)
@@ -28,6 +34,12 @@ class Client:
             self.db = await Database(self).open()
         if not self.httpr:
             self.httpr = await Httpr(self).open()
+        if not self.names:
+            self.names = await NameResolver(self).open()
+        if not self.networth:
+            self.networth = await NetworthCache(self).open()
+        if not self.weights:
+            self.weights = await WeightCache(self).open()
         if not self.tasks:
             self.tasks = await Tasks(self).open()
 
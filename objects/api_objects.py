@@ -2,141 +2,401 @@ from __future__ import annotations
 
 import logging
 import math
+from array import array
 
 import lilyweight
 from lilyweight import LilyWeight
 
+from objects import levels
+
+SENITHER_CONSTANTS = {
+    "dungeons_level50_experience": 569809640,
+    "skills_level50_experience": 55172425,
+    "skills_level60_experience": 111672425,
+    "dungeon_weights": {
+        "catacombs": 0.0002149604615,
+        "healer": 0.0000045254834,
+        "mage": 0.0000045254834,
+        "berserk": 0.0000045254834,
+        "archer": 0.0000045254834,
+        "tank": 0.0000045254834,
+    },
+    "slayer_weights": {
+        "zombie": {
+            "divider": 2208,
+            "modifier": 0.15,
+        },
+        "spider": {
+            "divider": 2118,
+            "modifier": 0.08,
+        },
+        "wolf": {
+            "divider": 1962,
+            "modifier": 0.015,
+        },
+        "enderman": {
+            "divider": 1430,
+            "modifier": 0.017,
+        }
+    },
+    "skill_weights": {
+        # Maxes out mining at 1,750 points at 60.
+        "mining": {
+            "exponent": 1.18207448,
+            "divider": 259634,
+            "maxLevel": 60,
+        },
+        # Maxes out foraging at 850 points at level 50.
+        "foraging": {
+            "exponent": 1.232826,
+            "divider": 259634,
+            "maxLevel": 50,
+        },
+        # Maxes out enchanting at 450 points at level 60.
+        "enchanting": {
+            "exponent": 0.96976583,
+            "divider": 882758,
+            "maxLevel": 60,
+        },
+        # Maxes out farming at 2,200 points at level 60.
+        "farming": {
+            "exponent": 1.217848139,
+            "divider": 220689,
+            "maxLevel": 60,
+        },
+        # Maxes out combat at 1,500 points at level 60.
+        "combat": {
+            "exponent": 1.15797687265,
+            "divider": 275862,
+            "maxLevel": 60,
+        },
+        # Maxes out fishing at 2,500 points at level 50.
+        "fishing": {
+            "exponent": 1.406418,
+            "divider": 88274,
+            "maxLevel": 50,
+        },
+        # Maxes out alchemy at 200 points at level 50.
+        "alchemy": {
+            "exponent": 1.0,
+            "divider": 1103448,
+            "maxLevel": 50,
+        },
+        # Maxes out taming at 500 points at level 50.
+        "taming": {
+            "exponent": 1.14744,
+            "divider": 441379,
+            "maxLevel": 60,
+        },
+        # Sets up carpentry and runecrafting without any weight components.
+        "carpentry": {
+            "maxLevel": 50,
+        },
+        "runecrafting": {
+            "maxLevel": 25,
+        },
+    },
+    "skill_weight_groups": [
+        'mining', 'foraging', 'enchanting', 'farming', 'combat', 'fishing', 'alchemy', 'taming'
+    ],
+}
+
+# Dungeon classes by their position in dungeon_weights, for senither_inputs
+CLASS_INDEX = {name: index for index, name in enumerate(SENITHER_CONSTANTS["dungeon_weights"])}
+# What SkyBlockPlayer.select_profile can pick a profile on, "weight" is senither weight
+SELECT_PROFILE_ON = ("last_save", "weight", "senither_weight", "lily_weight", "cata", "slayer")
+SKILL_MAX_LEVEL = {
+    "mining": 60,
+    "foraging": 50,
+    "enchanting": 60,
+    "farming": 60,
+    "combat": 60,
+    "fishing": 50,
+    "alchemy": 50,
+    "taming": 60,
+    "carpentry": 50,
+    "runecrafting": 25,
+}
+
+
+def catacombs_xp_of(member: dict) -> float:
+    try:
+        return member["dungeons"]["dungeon_types"]["catacombs"]["experience"]
+    except:
+        return 0
+
+
+def slayer_xp_of(member: dict) -> float:
+    if member and member.get("slayer_bosses") is not None:
+        return sum([i.get("xp", 0) for i in member.get("slayer_bosses", {}).values()])
+    return 0
+
+
+# Senither Weight, for one profile member
+
+def _senither_calculate_dungeon_weight(weight_type: str, level: int, experience: int, with_overflow: bool = True):
+    percentage_modifier = SENITHER_CONSTANTS["dungeon_weights"][weight_type]
+
+    # Calculates the base weight using the players level
+    base = math.pow(level, 4.5) * percentage_modifier
+
+    # If the dungeon XP is below the requirements for a level 50 dungeon we'll
+    # just return our weight right away.
+    if experience <= SENITHER_CONSTANTS["dungeons_level50_experience"]:
+        return base
+
+    # Calculates the XP above the level 50 requirement, and the splitter
+    # value, weight given past level 50 is given at 1/4 the rate.
+    remaining = experience - SENITHER_CONSTANTS["dungeons_level50_experience"]
+    splitter = (4 * SENITHER_CONSTANTS["dungeons_level50_experience"]) / base
+
+    # Calculates the dungeon overflow weight and returns it to the weight object builder.
+    return math.floor(base) + math.pow(remaining / splitter, 0.968) if with_overflow else math.floor(base)
+
+
+def senither_dungeon_weight_of(member: dict, with_overflow: bool = True):
+    if member is None or member.get("dungeons") is None or member.get("dungeons").get("player_classes") is None:
+        return 0
+    cata_xp = catacombs_xp_of(member)
+    return sum(
+        _senither_calculate_dungeon_weight(
+            cls_data, levels.cata_level(exp.get("experience", 0)), exp.get("experience", 0), with_overflow
+        ) for cls_data, exp in member["dungeons"]["player_classes"].items()
+    ) + _senither_calculate_dungeon_weight("catacombs", levels.cata_level(cata_xp), cata_xp, with_overflow)
+
+
+def _senither_calculate_slayer_weight(weight_type: str, experience: int, with_overflow: bool = True):
+    slayer_weight = SENITHER_CONSTANTS["slayer_weights"].get(weight_type)
+    if not slayer_weight:
+        return 0
+
+    if experience <= 1000000:
+        return 0 if experience <= 0 else experience / slayer_weight["divider"]
+
+    base = 1000000 / slayer_weight["divider"]
+    remaining = experience - 1000000
+
+    modifier = slayer_weight["modifier"]
+    overflow = 0
+
+    while remaining > 0:
+        left = min(remaining, 1000000)
+
+        overflow += math.pow(left / (slayer_weight["divider"] * (1.5 + modifier)), 0.942)
+        modifier += slayer_weight["modifier"]
+        remaining -= left
+
+    return base + overflow if with_overflow else base
+
+
+def senither_slayer_weight_of(member: dict, with_overflow: bool = True):
+    if member is None or member.get("slayer_bosses") is None:
+        return 0
+    return sum(
+        _senither_calculate_slayer_weight(
+            slayer_type, member["slayer_bosses"].get(slayer_type, {}).get("xp", 0), with_overflow
+        )
+        for slayer_type in SENITHER_CONSTANTS["slayer_weights"].keys()
+    )
+
+
+def _senither_calculate_skill_weight(weight_type: str, level: int, experience: int, with_overflow: bool = True):
+    skill_weight = SENITHER_CONSTANTS["skill_weights"].get(weight_type)
+    if not skill_weight or skill_weight["divider"] == 0 or skill_weight["exponent"] == 0:
+        return 0
+
+    # Gets the XP required to max out the skill.
+    max_skill_level_xp = SENITHER_CONSTANTS["skills_level60_experience"] if skill_weight["maxLevel"] == 60 \
+        else SENITHER_CONSTANTS["skills_level50_experience"]
+
+    # Calculates the base weight using the players level, if the players level
+    # is 50/60 we'll round off their weight to get a nicer looking number.
+    base = math.pow(level * 10, 0.5 + skill_weight["exponent"] + level / 100) / 1250
+    if experience > max_skill_level_xp:
+        base = round(base)
+
+    # If the skill XP is below the requirements for a level 50/60 skill we'll
+    # just return our weight to the weight object builder right away.
+    if experience <= max_skill_level_xp:
+        return base
+
+    # Calculates the skill overflow weight and returns it to the weight object builder.
+    return base + math.pow((experience - max_skill_level_xp) / skill_weight["divider"], 0.968) if with_overflow \
+        else base
+
+
+def senither_skill_weight_of(member: dict, with_overflow: bool = True):
+    if member is None:
+        return 0
+
+    r = 0
+    for skill_type in SENITHER_CONSTANTS["skill_weights"].keys():
+        if skill_type in SENITHER_CONSTANTS["skill_weight_groups"]:
+            experience = member.get(f"experience_skill_{skill_type}", 0)
+            r += _senither_calculate_skill_weight(
+                skill_type, levels.skill_level(experience, SKILL_MAX_LEVEL[skill_type]), experience, with_overflow
+            )
+    return r
+
+
+def senither_components(member: dict, with_overflow: bool = True) -> dict:
+    return {
+        "slayer": senither_slayer_weight_of(member, with_overflow),
+        "skill": senither_skill_weight_of(member, with_overflow),
+        "dungeon": senither_dungeon_weight_of(member, with_overflow),
+    }
+
+
+def senither_inputs(member: dict) -> array:
+    """
+    Every value senither_components(member) depends on, as doubles. Members with equal inputs have equal components,
+    classes are kept in their order since that's the order they're summed in.
+    """
+    if member is None:
+        return array("d")
+    inputs = array("d", [
+        member.get(f"experience_skill_{skill}", 0) for skill in SENITHER_CONSTANTS["skill_weight_groups"]
+    ])
+    slayer_bosses = member.get("slayer_bosses") or {}
+    inputs.extend([slayer_bosses.get(slayer, {}).get("xp", 0) for slayer in SENITHER_CONSTANTS["slayer_weights"]])
+    player_classes = (member.get("dungeons") or {}).get("player_classes")
+    if player_classes is None:  # no dungeon weight at all
+        inputs.append(-1)
+        return inputs
+    inputs.append(len(player_classes))
+    inputs.append(catacombs_xp_of(member))
+    for cls, data in player_classes.items():
+        inputs.append(CLASS_INDEX[cls])
+        inputs.append(data.get("experience", 0))
+    return inputs
+
+
+def senither_total(components: dict) -> float:
+    return components["slayer"] + components["skill"] + components["dungeon"]
+
+
+# Lily Weight, for one profile member
+
+def lily_weight_inputs(member: dict, skill_level_dict: dict = None, skill_experience_dict: dict = None) -> tuple:
+    """
+    The arguments and slayer keyword arguments of LilyWeight.get_weight_raw for member, skills come from the profile
+    unless they're given, for when the skill API is off
+    """
+    slayer_kwargs = {  # Loop through the slayer bosses and get the xp if they key exists else default value
+        "zombie": 0, "spider": 0, "wolf": 0, "enderman": 0, "blaze": 0
+    }
+    if member and member.get("slayer_bosses"):
+        for boss_type, boss_data in member.get("slayer_bosses", {}).items():
+            slayer_kwargs[boss_type] = boss_data.get("xp", 0)
+
+        # Catacombs Completions
+    # Get the catacombs weight of the player
+    try:
+        cata_completions = member["dungeons"]["dungeon_types"]["catacombs"]["tier_completions"]
+        # Try to get the catacombs completions
+    except:
+        # If the keys are not found set to default value
+        cata_completions = {}
+    try:
+        m_cata_compl = member["dungeons"]["dungeon_types"]["master_catacombs"]["tier_completions"]
+    except:
+        m_cata_compl = {}
+
+    # Catacombs XP
+    cata_xp = catacombs_xp_of(member)
+
+    # Skills
+    if skill_level_dict is None:
+        skill_experience_dict = {}
+        skill_level_dict = {}
+        # Loop through all the skills lily weight uses
+        if member and member.get("experience_skill_mining") is not None:
+            for skill_type in lilyweight.used_skills.keys():
+                experience = member.get(f"experience_skill_{skill_type}", 0)  # Get the experience of the skill
+                skill_experience_dict[skill_type] = experience  # Add the experience to the experience skill dict
+                skill_level_dict[skill_type] = lilyweight.get_level_from_XP(experience)
+                # Add the skill level to the counter
+
+    slayer_kwargs.pop("vampire", None)
+    return (skill_level_dict, skill_experience_dict, cata_completions, m_cata_compl, cata_xp), slayer_kwargs
+
+
+def lily_weight_of(member: dict, skill_level_dict: dict = None, skill_experience_dict: dict = None) -> dict:
+    args, slayer_kwargs = lily_weight_inputs(member, skill_level_dict, skill_experience_dict)
+    return LilyWeight.get_weight_raw(*args, **slayer_kwargs)
+
+
+class ProfileEvaluator:
+    """
+    Picks one of a player's profiles by select_profile_on, scoring every profile once. The profiles are only read,
+    never copied or changed, the response they come from can be cached and shared.
+    select() also returns what was computed for the winner (its senither components or lily weight) so the player
+    doesn't compute it again. With a weight_cache, weights of profiles that didn't change since last time are reused.
+    """
+
+    def __init__(self, uuid: str, select_profile_on: str = "last_save", weight_cache=None):
+        if select_profile_on not in SELECT_PROFILE_ON:
+            raise ValueError(f"Invalid select_profile_on: {select_profile_on}")
+        self.uuid = uuid
+        self.select_profile_on = select_profile_on
+        self.weight_cache = weight_cache
+
+    def evaluate(self, member: dict, profile_id: str = None) -> tuple:
+        """The score of one member and what was computed for it, if it's worth keeping"""
+        if self.select_profile_on in ("weight", "senither_weight"):
+            if self.weight_cache is not None:
+                components = self.weight_cache.senither_components(self.uuid, profile_id, member)
+            else:
+                components = senither_components(member)
+            return senither_total(components), components
+        if self.select_profile_on == "lily_weight":
+            if self.weight_cache is not None:
+                weight = self.weight_cache.lily_weight(self.uuid, profile_id, member)
+            else:
+                weight = lily_weight_of(member)
+            return weight["total"], weight
+        if self.select_profile_on == "cata":
+            return member.get("dungeons", {}).get("dungeon_types", {}).get("catacombs", {}).get("experience", 0), None
+        if self.select_profile_on == "slayer":
+            return sum([i.get("xp", 0) for i in member.get("slayer_bosses", {}).values()]), None
+        return member.get("last_save", 0), None
+
+    def select(self, profiles: list) -> tuple:
+        """(profile, member, computed) of the best profile, the first one wins ties. Nones if uuid is in none of them"""
+        best, best_score = (None, None, None), None
+        for profile in profiles:
+            member = profile["members"].get(self.uuid)
+            if member is None:
+                continue
+            score, computed = self.evaluate(member, profile.get("profile_id"))
+            if best_score is None or score > best_score:
+                best, best_score = (profile, member, computed), score
+        return best
+
 
 class SkyBlockPlayer:
     def __init__(
             self, uuid: str, player_data: dict = None, profile_id: str = None, profile_name: str = None,
-            select_profile_on: str = "last_save"
+            select_profile_on: str = "last_save", weight_cache=None
     ):
         self.uuid = uuid
         self.player_data = player_data
-        if player_data.get("profiles"):
-            for profile in player_data["profiles"]:
-                if self.uuid not in profile["members"]:
-                    self.player_data["profiles"].remove(profile)
+        self.weight_cache = weight_cache  # utils.weights.WeightCache, None computes everything
 
         """
         select_profile_on can be one of the following:
         - last_save
-        - senither_weight
+        - weight (senither_weight)
         - lily_weight
         - cata
         - slayer
         """
         self._name, self._weight_with_overflow, self._weight_without_overflow, self.profile, self.gexp, _selected_profile_name = (
                                                                                                                                  None,) * 6
+        self._lily_weight, self.selected_profile, self.weight_components = None, None, None
 
         self.select_profile(profile_id, profile_name, select_profile_on)
 
-        self._senither_constants = {
-            "dungeons_level50_experience": 569809640,
-            "skills_level50_experience": 55172425,
-            "skills_level60_experience": 111672425,
-            "dungeon_weights": {
-                "catacombs": 0.0002149604615,
-                "healer": 0.0000045254834,
-                "mage": 0.0000045254834,
-                "berserk": 0.0000045254834,
-                "archer": 0.0000045254834,
-                "tank": 0.0000045254834,
-            },
-            "slayer_weights": {
-                "zombie": {
-                    "divider": 2208,
-                    "modifier": 0.15,
-                },
-                "spider": {
-                    "divider": 2118,
-                    "modifier": 0.08,
-                },
-                "wolf": {
-                    "divider": 1962,
-                    "modifier": 0.015,
-                },
-                "enderman": {
-                    "divider": 1430,
-                    "modifier": 0.017,
-                }
-            },
-            "skill_weights": {
-                # Maxes out mining at 1,750 points at 60.
-                "mining": {
-                    "exponent": 1.18207448,
-                    "divider": 259634,
-                    "maxLevel": 60,
-                },
-                # Maxes out foraging at 850 points at level 50.
-                "foraging": {
-                    "exponent": 1.232826,
-                    "divider": 259634,
-                    "maxLevel": 50,
-                },
-                # Maxes out enchanting at 450 points at level 60.
-                "enchanting": {
-                    "exponent": 0.96976583,
-                    "divider": 882758,
-                    "maxLevel": 60,
-                },
-                # Maxes out farming at 2,200 points at level 60.
-                "farming": {
-                    "exponent": 1.217848139,
-                    "divider": 220689,
-                    "maxLevel": 60,
-                },
-                # Maxes out combat at 1,500 points at level 60.
-                "combat": {
-                    "exponent": 1.15797687265,
-                    "divider": 275862,
-                    "maxLevel": 60,
-                },
-                # Maxes out fishing at 2,500 points at level 50.
-                "fishing": {
-                    "exponent": 1.406418,
-                    "divider": 88274,
-                    "maxLevel": 50,
-                },
-                # Maxes out alchemy at 200 points at level 50.
-                "alchemy": {
-                    "exponent": 1.0,
-                    "divider": 1103448,
-                    "maxLevel": 50,
-                },
-                # Maxes out taming at 500 points at level 50.
-                "taming": {
-                    "exponent": 1.14744,
-                    "divider": 441379,
-                    "maxLevel": 60,
-                },
-                # Sets up carpentry and runecrafting without any weight components.
-                "carpentry": {
-                    "maxLevel": 50,
-                },
-                "runecrafting": {
-                    "maxLevel": 25,
-                },
-            },
-            "skill_weight_groups": [
-                'mining', 'foraging', 'enchanting', 'farming', 'combat', 'fishing', 'alchemy', 'taming'
-            ],
-        }
-
-        self.skill_max_level = {
-            "mining": 60,
-            "foraging": 50,
-            "enchanting": 60,
-            "farming": 60,
-            "combat": 60,
-            "fishing": 50,
-            "alchemy": 50,
-            "taming": 60,
-            "carpentry": 50,
-            "runecrafting": 25,
-        }
-
     def _selected_profile(
             self, profile_id: str = None, profile_name: str = None, select_profile_on: str = "last_save"
     ) -> dict:
@@ -147,65 +407,44 @@ class SkyBlockPlayer:
             for profile in self.player_data["profiles"]:
                 if profile["profile_id"] == profile_id:  # and self.uuid in profile["members"]:
                     self.selected_profile_name = profile["cute_name"]
+                    self.selected_profile = profile
                     return profile["members"][self.uuid]
         if profile_name:
             for profile in self.player_data["profiles"]:
                 if profile["cute_name"] == profile_name:
                     self.selected_profile_name = profile["cute_name"]
+                    self.selected_profile = profile
                     return profile["members"][self.uuid]
 
-        profiles = []
-        for profile in self.player_data["profiles"]:
-            try:
-                profile["members"][self.uuid]["cute_name"] = profile["cute_name"]
-                profiles.append(profile["members"][self.uuid])
-            except KeyError:
-                continue
-
-        if select_profile_on == "last_save":
-            found_profile = sorted(profiles, key=lambda x: x.get("last_save", 0), reverse=True)[0]
-
-        elif select_profile_on == "weight":
-            try:
-                found_profile = sorted(
-                    self.player_data["profiles"],
-                    key=lambda x: SkyBlockPlayer(self.uuid, self.player_data, x["profile_id"]).senither_weight(),
-                    reverse=True
-                )[0]["members"][self.uuid]
-            except IndexError:
-                self.selected_profile_name = None
-                return None
-
-        elif select_profile_on == "cata":
-            found_profile = sorted(
-                profiles,
-                key=lambda x: x.get("dungeons", {}).get("dungeon_types", {}).get("catacombs", {}).get("experience", 0),
-                reverse=True
-            )[0]
-        elif select_profile_on == "slayer":
-            found_profile = sorted(
-                profiles,
-                key=lambda x: sum([i.get("xp", 0) for i in x.get("slayer_bosses", {}).values()]),
-                reverse=True
-            )[0]
-        else:
-            raise ValueError(f"Invalid select_profile_on: {select_profile_on}")
+        profile, member, computed = ProfileEvaluator(self.uuid, select_profile_on, self.weight_cache).select(
+            self.player_data["profiles"]
+        )
+        if profile is None:
+            self.selected_profile_name = None
+            return None
+        if select_profile_on in ("weight", "senither_weight"):
+            self.weight_components = computed
+            self._weight_with_overflow = senither_total(computed)
+        elif select_profile_on == "lily_weight" and member.get("experience_skill_mining") is not None:
+            self._lily_weight = computed  # the same as lily_weight() gives with the skill API on
 
-        self.selected_profile_name = found_profile["cute_name"]
-        return found_profile
+        self.selected_profile_name = profile["cute_name"]
+        self.selected_profile = profile
+        return member
 
     def select_profile(self, profile_id: str = None, profile_name: str = None, select_profile_on: str = "last_save"):
         """
         select_profile_on can be one of the following:
         - last_save
-        - senither_weight
+        - weight (senither_weight)
         - lily_weight
         - cata
         - slayer
         """
 
-        self.profile = self._selected_profile(profile_id, profile_name, select_profile_on)
         self._weight_with_overflow, self._weight_without_overflow = None, None
+        self._lily_weight, self.selected_profile, self.weight_components = None, None, None
+        self.profile = self._selected_profile(profile_id, profile_name, select_profile_on)
         return self
 
     async def get_name(self, app) -> str:
@@ -216,28 +455,7 @@ class SkyBlockPlayer:
 
     @staticmethod
     def get_cata_lvl(exp, overflow=False):
-        levels = {
-            1: 50, 2: 75, 3: 110, 4: 160, 5: 230, 6: 330, 7: 470, 8: 670, 9: 950, 10: 1340, 11: 1890, 12: 2665,
-            13: 3760, 14: 5260, 15: 7380, 16: 10300, 17: 14400, 18: 20000, 19: 27600, 20: 38000, 21: 52500, 22: 71500,
-            23: 97000, 24: 132000, 25: 180000, 26: 243000, 27: 328000, 28: 445000, 29: 600000, 30: 800000, 31: 1065000,
-            32: 1410000, 33: 1900000, 34: 2500000, 35: 3300000, 36: 4300000, 37: 5600000, 38: 7200000, 39: 9200000,
-            40: 12000000, 41: 15000000, 42: 19000000, 43: 24000000, 44: 30000000, 45: 38000000, 46: 48000000,
-            47: 60000000, 48: 75000000, 49: 93000000, 50: 116250000,
-        }
-        # > 50 200 000 000 per level
-        # levels dict is incremental
-        remaining_xp = exp
-        level50 = sum(levels.values())
-
-        if exp >= level50:
-            return 50 + (exp - level50) / 200000000 if overflow else 50
-
-        for lvl, xp in levels.items():
-            if remaining_xp < xp:
-                decimal = remaining_xp / xp
-                return lvl + decimal - 1
-            remaining_xp -= xp
-        return 0
+        return levels.cata_level(exp, overflow)
 
     @property
     def last_save(self):
@@ -248,10 +466,7 @@ class SkyBlockPlayer:
 
     @property
     def catacombs_xp(self) -> float:
-        try:
-            return self.profile["dungeons"]["dungeon_types"]["catacombs"]["experience"]
-        except:
-            return 0
+        return catacombs_xp_of(self.profile)
 
     @property
     def sb_experience(self) -> int:
@@ -280,149 +495,32 @@ class SkyBlockPlayer:
 
     @property
     def slayer_xp(self) -> float:
-        if self.profile and self.profile.get("slayer_bosses") is not None:
-            return sum([i.get("xp", 0) for i in self.profile.get("slayer_bosses", {}).values()])
-        return 0
+        return slayer_xp_of(self.profile)
 
     @property
     def average_skill(self):
         if self.profile is None:
             return 0
         r = 0
-        used_skills = [*self._senither_constants["skill_weight_groups"], 'carpentry']
+        used_skills = [*SENITHER_CONSTANTS["skill_weight_groups"], 'carpentry']
         for skill_type in used_skills:
             experience = self.profile.get(f"experience_skill_{skill_type}", 0)
             r += self.get_skill_lvl(skill_type, experience)
         return r / len(used_skills)
 
     def get_skill_lvl(self, skill_type, exp):
-        max_level = self.skill_max_level[skill_type]
-        levels = {
-            "0": 0, "1": 50, "2": 175, "3": 375, "4": 675, "5": 1175, "6": 1925, "7": 2925, "8": 4425, "9": 6425,
-            "10": 9925, "11": 14925, "12": 22425, "13": 32425, "14": 47425, "15": 67425, "16": 97425, "17": 147425,
-            "18": 222425, "19": 322425, "20": 522425, "21": 822425, "22": 1222425, "23": 1722425, "24": 2322425,
-            "25": 3022425, "26": 3822425, "27": 4722425, "28": 5722425, "29": 6822425, "30": 8022425, "31": 9322425,
-            "32": 10722425, "33": 12222425, "34": 13822425, "35": 15522425, "36": 17322425, "37": 19222425,
-            "38": 21222425, "39": 23322425, "40": 25522425, "41": 27822425, "42": 30222425, "43": 32722425,
-            "44": 35322425, "45": 38072425, "46": 40972425, "47": 44072425, "48": 47472425, "49": 51172425,
-            "50": 55172425, "51": 59472425, "52": 64072425, "53": 68972425, "54": 74172425, "55": 79672425,
-            "56": 85472425, "57": 91572425, "58": 97972425, "59": 104672425, "60": 111672425
-        }
-        for level in levels:
-            if exp >= levels[str(max_level)]:
-                return max_level
-            if levels[level] > exp:
-                lowexp = levels[str(int(level) - 1)]
-                highexp = levels[level]
-                difference = highexp - lowexp
-                extra = exp - lowexp
-                percentage = (extra / difference)
-                return (int(level) - 1) + percentage
+        return levels.skill_level(exp, SKILL_MAX_LEVEL[skill_type])
 
     # Senither Weight
 
-    def _senither_calculate_dungeon_weight(self, weight_type: str, level: int, experience: int,
-                                           with_overflow: bool = True):
-        percentage_modifier = self._senither_constants["dungeon_weights"][weight_type]
-
-        # Calculates the base weight using the players level
-        base = math.pow(level, 4.5) * percentage_modifier
-
-        # If the dungeon XP is below the requirements for a level 50 dungeon we'll
-        # just return our weight right away.
-        if experience <= self._senither_constants["dungeons_level50_experience"]:
-            return base
-
-        # Calculates the XP above the level 50 requirement, and the splitter
-        # value, weight given past level 50 is given at 1/4 the rate.
-        remaining = experience - self._senither_constants["dungeons_level50_experience"]
-        splitter = (4 * self._senither_constants["dungeons_level50_experience"]) / base
-
-        # Calculates the dungeon overflow weight and returns it to the weight object builder.
-        return math.floor(base) + math.pow(remaining / splitter, 0.968) if with_overflow else math.floor(base)
-
     def senither_dungeon_weight(self, with_overflow: bool = True):
-        if self.profile is None or self.profile.get("dungeons") is None or self.profile.get("dungeons").get(
-                "player_classes") is None:
-            return 0
-        return sum(
-            self._senither_calculate_dungeon_weight(
-                cls_data, self.get_cata_lvl(exp.get("experience", 0)), exp.get("experience", 0), with_overflow
-            ) for cls_data, exp in self.profile["dungeons"]["player_classes"].items()
-        ) + self._senither_calculate_dungeon_weight("catacombs", self.catacombs_level, self.catacombs_xp, with_overflow)
-
-    def _senither_calculate_slayer_weight(self, weight_type: str, experience: int, with_overflow: bool = True):
-        slayer_weight = self._senither_constants["slayer_weights"].get(weight_type)
-        if not slayer_weight:
-            return 0
-
-        if experience <= 1000000:
-            return 0 if experience <= 0 else experience / slayer_weight["divider"]
-
-        base = 1000000 / slayer_weight["divider"]
-        remaining = experience - 1000000
-
-        modifier = slayer_weight["modifier"]
-        overflow = 0
-
-        while remaining > 0:
-            left = min(remaining, 1000000)
-
-            overflow += math.pow(left / (slayer_weight["divider"] * (1.5 + modifier)), 0.942)
-            modifier += slayer_weight["modifier"]
-            remaining -= left
-
-        return base + overflow if with_overflow else base
+        return senither_dungeon_weight_of(self.profile, with_overflow)
 
     def senither_slayer_weight(self, with_overflow: bool = True):
-        if self.profile is None or self.profile.get("slayer_bosses") is None:
-            return 0
-        return sum(
-            self._senither_calculate_slayer_weight(
-                slayer_type,
-                self.profile["slayer_bosses"].get(slayer_type, {}).get("xp", 0) if self.profile else 0,
-                with_overflow
-            )
-            for slayer_type in self._senither_constants["slayer_weights"].keys()
-        )
-
-    def _senither_calculate_skill_weight(self, weight_type: str, level: int, experience: int,
-                                         with_overflow: bool = True):
-        skill_weight = self._senither_constants["skill_weights"].get(weight_type)
-        if not skill_weight or skill_weight["divider"] == 0 or skill_weight["exponent"] == 0:
-            return 0
-
-        # Gets the XP required to max out the skill.
-        max_skill_level_xp = self._senither_constants["skills_level60_experience"] if skill_weight["maxLevel"] == 60 \
-            else self._senither_constants["skills_level50_experience"]
-
-        # Calculates the base weight using the players level, if the players level
-        # is 50/60 we'll round off their weight to get a nicer looking number.
-        base = math.pow(level * 10, 0.5 + skill_weight["exponent"] + level / 100) / 1250
-        if experience > max_skill_level_xp:
-            base = round(base)
-
-        # If the skill XP is below the requirements for a level 50/60 skill we'll
-        # just return our weight to the weight object builder right away.
-        if experience <= max_skill_level_xp:
-            return base
-
-        # Calculates the skill overflow weight and returns it to the weight object builder.
-        return base + math.pow((experience - max_skill_level_xp) / skill_weight["divider"], 0.968) if with_overflow \
-            else base
+        return senither_slayer_weight_of(self.profile, with_overflow)
 
     def senither_skill_weight(self, with_overflow: bool = True):
-        if self.profile is None:
-            return 0
-
-        r = 0
-        for skill_type in self._senither_constants["skill_weights"].keys():
-            if skill_type in self._senither_constants["skill_weight_groups"]:
-                experience = self.profile.get(f"experience_skill_{skill_type}", 0)
-                r += self._senither_calculate_skill_weight(
-                    skill_type, self.get_skill_lvl(skill_type, experience), experience, with_overflow
-                )
-        return r
+        return senither_skill_weight_of(self.profile, with_overflow)
 
     def senither_weight(self, with_overflow: bool = True):
         if with_overflow:
@@ -441,37 +539,12 @@ class SkyBlockPlayer:
     # Lily Weight
 
     async def lily_weight(self, app):
-        slayer_kwargs = {  # Loop through the slayer bosses and get the xp if they key exists else default value
-            "zombie": 0, "spider": 0, "wolf": 0, "enderman": 0, "blaze": 0
-        }
-        if self.profile and self.profile.get("slayer_bosses"):
-            for boss_type, boss_data in self.profile.get("slayer_bosses", {}).items():
-                slayer_kwargs[boss_type] = boss_data.get("xp", 0)
-
-            # Catacombs Completions
-        # Get the catacombs weight of the player
-        try:
-            cata_completions = self.profile["dungeons"]["dungeon_types"]["catacombs"]["tier_completions"]
-            # Try to get the catacombs completions
-        except:
-            # If the keys are not found set to default value
-            cata_completions = {}
-        try:
-            m_cata_compl = self.profile["dungeons"]["dungeon_types"]["master_catacombs"]["tier_completions"]
-        except:
-            m_cata_compl = {}
-
-        # Catacombs XP
-        try:
-            cata_xp = self.profile["dungeons"]["dungeon_types"]["catacombs"]["experience"]
-        except:
-            cata_xp = 0
-
-        # Skills
-        skill_experience_dict = {}
-        skill_level_dict = {}
+        if self._lily_weight is not None:
+            return self._lily_weight
         if self.profile and self.profile.get("experience_skill_mining") is None:
             # Skill api is off
+            skill_experience_dict = {}
+            skill_level_dict = {}
             try:
                 player = await app.httpr.get_player_data(self.uuid)  # Get the player data from the hypixel api
                 for skill_type, achv_name in lilyweight.used_skills.items():
@@ -483,17 +556,13 @@ class SkyBlockPlayer:
             except Exception as e:
                 logging.getLogger("lilyweight").error(f"Error getting player data: {e} {self.uuid}")
                 print(e)
-        else:
-            # Loop through all the skills lily weight uses
-            if self.profile:
-                for skill_type in lilyweight.used_skills.keys():
-                    experience = self.profile.get(f"experience_skill_{skill_type}",
-                                                  0)  # Get the experience of the skill
-                    skill_experience_dict[skill_type] = experience  # Add the experience to the experience skill dict
-                    skill_level_dict[skill_type] = lilyweight.get_level_from_XP(experience)
-                    # Add the skill level to the counter
-
-        slayer_kwargs.pop("vampire", None)
-        return LilyWeight.get_weight_raw(
-            skill_level_dict, skill_experience_dict, cata_completions, m_cata_compl, cata_xp, **slayer_kwargs
+            return self._weigh_lily(skill_level_dict, skill_experience_dict)
+        self._lily_weight = self._weigh_lily()
+        return self._lily_weight
+
+    def _weigh_lily(self, skill_level_dict: dict = None, skill_experience_dict: dict = None) -> dict:
+        if self.weight_cache is None or self.selected_profile is None:
+            return lily_weight_of(self.profile, skill_level_dict, skill_experience_dict)
+        return self.weight_cache.lily_weight(
+            self.uuid, self.selected_profile.get("profile_id"), self.profile, skill_level_dict, skill_experience_dict
         )
@@ -0,0 +1,120 @@
+"""
+Senither weight for many players at once with NumPy.
+
+SkyBlockPlayer.senither_weight goes through nested dict lookups and math.pow for every component of every player, fine
+for one player but slow when a whole guild, or every player after a formula change, has to be recomputed. Here every
+component is computed for all players in one go from columns of XP, columns() builds them from profile members.
+Results match senither_weight() to within floating point error, benchmarks/bench_weight.py checks that.
+
+Only used for bulk jobs, NumPy isn't needed to run the updater.
+"""
+import numpy as np
+
+from objects import levels
+from objects.api_objects import SENITHER_CONSTANTS
+
+SKILLS = tuple(SENITHER_CONSTANTS["skill_weight_groups"])
+SLAYERS = tuple(SENITHER_CONSTANTS["slayer_weights"])
+CLASSES = tuple(name for name in SENITHER_CONSTANTS["dungeon_weights"] if name != "catacombs")
+
+_SKILL_XP = np.array(levels.SKILL_XP, dtype=np.float64)
+_SKILL_XP_PER_LEVEL = np.array(levels.SKILL_XP_PER_LEVEL, dtype=np.float64)
+_CATA_XP = np.array(levels.CATA_XP, dtype=np.float64)
+_CATA_XP_PER_LEVEL = np.array(levels.CATA_XP_PER_LEVEL, dtype=np.float64)
+_SLAYER_STEP = 1000000  # slayer XP past the first million is weighted a million at a time
+
+
+def columns(members: list) -> dict:
+    """
+    Columns of XP for senither_weights from profile members as SkyBlockPlayer.profile holds them, None for players
+    without a profile
+    """
+    skills = {skill: np.zeros(len(members)) for skill in SKILLS}
+    slayers = {slayer: np.zeros(len(members)) for slayer in SLAYERS}
+    classes = {cls: np.zeros(len(members)) for cls in CLASSES}
+    catacombs = np.zeros(len(members))
+    for i, member in enumerate(members):
+        if member is None:
+            continue
+        for skill in SKILLS:
+            skills[skill][i] = member.get(f"experience_skill_{skill}", 0)
+        for slayer, data in (member.get("slayer_bosses") or {}).items():
+            if slayer in slayers:
+                slayers[slayer][i] = data.get("xp", 0)
+        dungeons = member.get("dungeons") or {}
+        if dungeons.get("player_classes") is None:  # senither_dungeon_weight is 0 without classes, catacombs too
+            continue
+        for cls, data in dungeons["player_classes"].items():
+            classes[cls][i] = data.get("experience", 0)
+        catacombs[i] = dungeons.get("dungeon_types", {}).get("catacombs", {}).get("experience", 0)
+    return {"skills": skills, "slayers": slayers, "catacombs": catacombs, "classes": classes}
+
+
+def skill_levels(exp: np.ndarray, max_level: int = 60) -> np.ndarray:
+    """levels.skill_level for every value in exp"""
+    level = np.clip(np.searchsorted(_SKILL_XP, exp, side="right"), 1, max_level)
+    progress = (level - 1) + (exp - _SKILL_XP[level - 1]) / _SKILL_XP_PER_LEVEL[level]
+    return np.where(exp >= _SKILL_XP[max_level], max_level, progress)
+
+
+def cata_levels(exp: np.ndarray) -> np.ndarray:
+    """levels.cata_level without overflow for every value in exp"""
+    level = np.clip(np.searchsorted(_CATA_XP, exp, side="right"), 1, levels.CATA_MAX_LEVEL)
+    progress = level + (exp - _CATA_XP[level - 1]) / _CATA_XP_PER_LEVEL[level - 1] - 1
+    return np.where(exp >= _CATA_XP[-1], levels.CATA_MAX_LEVEL, progress)
+
+
+def skill_weight(skill: str, exp: np.ndarray, with_overflow: bool = True) -> np.ndarray:
+    constants = SENITHER_CONSTANTS["skill_weights"][skill]
+    max_xp = SENITHER_CONSTANTS["skills_level60_experience"] if constants["maxLevel"] == 60 \
+        else SENITHER_CONSTANTS["skills_level50_experience"]
+    level = skill_levels(exp, constants["maxLevel"])
+    base = np.power(level * 10, 0.5 + constants["exponent"] + level / 100) / 1250
+    maxed = exp > max_xp
+    base = np.where(maxed, np.round(base), base)  # round() rounds halves to even like np.round
+    if not with_overflow:
+        return base
+    return base + np.where(maxed, np.power(np.maximum(exp - max_xp, 0) / constants["divider"], 0.968), 0)
+
+
+def slayer_weight(slayer: str, exp: np.ndarray, with_overflow: bool = True) -> np.ndarray:
+    constants = SENITHER_CONSTANTS["slayer_weights"][slayer]
+    divider, modifier = constants["divider"], constants["modifier"]
+    below = np.where(exp <= 0, 0, exp / divider)
+    base = _SLAYER_STEP / divider
+    if not with_overflow:
+        return np.where(exp <= _SLAYER_STEP, below, base)
+
+    steps, rest = np.divmod(np.maximum(exp - _SLAYER_STEP, 0), _SLAYER_STEP)
+    steps = steps.astype(np.int64)
+    # The modifier of every step, added up one at a time like the loop in SkyBlockPlayer does
+    modifiers = [modifier]
+    for _ in range(int(steps.max(initial=0))):
+        modifiers.append(modifiers[-1] + modifier)
+    modifiers = np.array(modifiers)
+    full_steps = np.concatenate(([0.0], np.cumsum(np.power(_SLAYER_STEP / (divider * (1.5 + modifiers[:-1])), 0.942))))
+    overflow = full_steps[steps] + np.where(rest > 0, np.power(rest / (divider * (1.5 + modifiers[steps])), 0.942), 0)
+    return np.where(exp <= _SLAYER_STEP, below, base + overflow)
+
+
+def dungeon_weight(name: str, exp: np.ndarray, with_overflow: bool = True) -> np.ndarray:
+    level50 = SENITHER_CONSTANTS["dungeons_level50_experience"]
+    base = np.power(cata_levels(exp), 4.5) * SENITHER_CONSTANTS["dungeon_weights"][name]
+    maxed = exp > level50
+    if not with_overflow:
+        return np.where(maxed, np.floor(base), base)
+    splitter = (4 * level50) / np.where(maxed, base, 1)
+    overflow = np.power(np.maximum(exp - level50, 0) / splitter, 0.968)
+    return np.where(maxed, np.floor(base) + overflow, base)
+
+
+def senither_weights(cols: dict, with_overflow: bool = True) -> dict:
+    """Skill, slayer, dungeon and total senither weight of every player in cols"""
+    skill = sum(skill_weight(name, np.asarray(cols["skills"][name], dtype=np.float64), with_overflow)
+                for name in SKILLS)
+    slayer = sum(slayer_weight(name, np.asarray(cols["slayers"][name], dtype=np.float64), with_overflow)
+                 for name in SLAYERS)
+    dungeon = sum(dungeon_weight(name, np.asarray(cols["classes"][name], dtype=np.float64), with_overflow)
+                  for name in CLASSES)
+    dungeon = dungeon + dungeon_weight("catacombs", np.asarray(cols["catacombs"], dtype=np.float64), with_overflow)
+    return {"skill": skill, "slayer": slayer, "dungeon": dungeon, "total": slayer + skill + dungeon}
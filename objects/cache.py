@@ -1,15 +1,112 @@
 import asyncio
+import collections
+import contextlib
+import email.utils
+import hashlib
+import heapq
+import itertools
 import logging
 import os
+import time
+from contextvars import ContextVar, copy_context
 from functools import wraps
 from typing import Union
 import aiohttp
+import yarl
+from objects import codec, deadline
+from objects.cassette import Cassette
 from objects.errors import *
 from objects.utils import Time
 
 DEFAULT_TIMEOUT = 999
 
+# Priority classes for the rate limiter, lower values are served first.
+# Anything a class leaves unused is handed down to the classes below it.
+PRIORITIES = {
+    "requeue": -1,  # requests sent again after a 429, they already waited their turn once
+    "interactive": 0,  # one-off work somebody is waiting on, e.g. onboarding a new guild
+    "default": 1,
+    "refresh": 2,  # the continuous update_guilds refresh
+    "backfill": 3,  # sweeps like resolve_names that can use whatever budget is left
+}
+DEFAULT_PRIORITY = "default"
+# Seconds to back off after a 429 that doesn't say how long to wait
+DEFAULT_RETRY_AFTER = 5
+# How often a request is sent again after a 429 before InternalRatelimitReached is raised
+MAX_REQUEUES = 3
+
+# Priority used for requests that don't pass one in their trace_request_ctx.
+# Set it with request_priority() and every request made by the task (and the tasks it creates) inherits it.
+current_priority: ContextVar[str] = ContextVar("current_priority", default=DEFAULT_PRIORITY)
+# Same for max_ratelimit_wait, set it with ratelimit_wait()
+current_max_ratelimit_wait: ContextVar[float] = ContextVar("current_max_ratelimit_wait", default=DEFAULT_TIMEOUT)
+# Tokens a composite call reserved up front, {host: count}. Requests made inside the call use these first.
+current_reservation: ContextVar[Union[dict, None]] = ContextVar("current_reservation", default=None)
+
 HYPIXEL_KEY = os.getenv("HYPIXEL_KEY")
+# Comma separated, every key gets its own rate limit. Falls back to HYPIXEL_KEY.
+HYPIXEL_KEYS = [key.strip() for key in (os.getenv("HYPIXEL_KEYS") or HYPIXEL_KEY or "").split(",") if key.strip()]
+
+# Seconds a GET response may be served from the ResponseCache, per host and path prefix.
+# Endpoints that aren't listed are never cached.
+RESPONSE_CACHE_TTLS = {
+    "api.hypixel.net": {
+        "/skyblock/profiles": 60,
+        "/player": 300,  # only used for the achievements fallback of lily weight
+        "/guild": 60,
+    },
+}
+
+
+def retry_after(headers, default: float = DEFAULT_RETRY_AFTER) -> float:
+    """Seconds a 429 response asks us to wait, from Retry-After (seconds or an HTTP date) or RateLimit-Reset"""
+    for name in ("Retry-After", "RateLimit-Reset"):
+        value = headers.get(name)
+        if not value:
+            continue
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return default
+
+
+@contextlib.contextmanager
+def request_priority(priority: str):
+    if priority not in PRIORITIES:
+        raise ValueError(f"Invalid priority: {priority}")
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+@contextlib.contextmanager
+def ratelimit_wait(seconds: float):
+    token = current_max_ratelimit_wait.set(seconds)
+    try:
+        yield
+    finally:
+        current_max_ratelimit_wait.reset(token)
+
+
+# Connection settings per host, anything not set for a host falls back to "default".
+# limit caps the concurrent requests to the host, the timeouts are in seconds.
+# aiohttp keeps one connection pool for the session, so keepalive_timeout is the longest one configured.
+CONNECTION_PROFILES = {
+    "default": {"limit": 10, "keepalive_timeout": 30, "connect_timeout": 10, "read_timeout": 30},
+    "api.hypixel.net": {"limit": 20, "keepalive_timeout": 75, "read_timeout": 60},  # profiles can be several MB
+    "nwapi.guildleaderboard.com": {"limit": 10, "keepalive_timeout": 75, "read_timeout": 60},
+    "api.mojang.com": {"limit": 5},
+    "sessionserver.mojang.com": {"limit": 5},
+}
+DNS_CACHE_TTL = 300
+
 
 """
 high level cache workflow:
@@ -17,7 +114,17 @@ https://cdn.discordapp.com/attachments/789953379027255316/963873058874081311/unk
 """
 
 
-def ratelimit_apis(*apis, host_mapping):
+def ratelimit_apis(*apis, host_mapping, limiter=None):
+    """
+    Records which hosts the decorated method hits in host_mapping.
+    Composite methods (built from other decorated methods) reserve one token on every host they map to before they
+    start, and fail fast with RatelimitReached when that isn't possible within max_ratelimit_wait. That way a call
+    doesn't spend quota on one host and then get stuck on the next. Only list the methods every call makes a request
+    with, a token held for a host that isn't hit blocks everyone else until the call ends.
+    limiter returns the RatelimitHandler to reserve on, without one it's the one of the first argument's `session`.
+    Leaf methods are limited when their request is made.
+    """
+
     def decorator(method):
         hosts = []
         for api in apis:
@@ -27,16 +134,401 @@ def ratelimit_apis(*apis, host_mapping):
                 hosts.extend(host_mapping[api.__qualname__])
 
         host_mapping[method.__qualname__] = hosts
+        composite = not all(isinstance(api, str) for api in apis)
 
         @wraps(method)
         async def wrapper(*args, **kwargs):
-            return await method(*args, **kwargs)
+            if not composite or current_reservation.get() is not None:
+                return await method(*args, **kwargs)
+            if limiter is not None:
+                handler = limiter()
+            else:
+                session = getattr(args[0], "session", None) if args else None
+                handler = session.ratelimit_handler if session is not None else None
+            if handler is None:
+                return await method(*args, **kwargs)
+            async with handler.reserve(hosts):
+                return await method(*args, **kwargs)
 
         return wrapper
 
     return decorator
 
 
+def coalesce_requests(method):
+    """
+    Concurrent calls of the decorated Httpr method with the same arguments share one in-flight call (and its retries)
+    through the session's SingleFlight. Calls with unhashable arguments aren't coalesced.
+    """
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        try:
+            key = (method.__qualname__, args, frozenset(kwargs.items()))
+            hash(key)
+        except TypeError:
+            return await method(self, *args, **kwargs)
+        return await self.session.single_flight.run(
+            key, lambda: method(self, *args, **kwargs), method.__name__.removeprefix("get_")
+        )
+
+    return wrapper
+
+
+class _Flight:
+    """One shared call and the context it runs in, which every caller that joins can make more urgent"""
+
+    def __init__(self, call):
+        self.context = copy_context()
+        self.future = asyncio.get_running_loop().create_task(call(), context=self.context)
+
+    def join(self):
+        """Runs the rest of the call with the caller's priority, deadline and max_ratelimit_wait if they ask for more"""
+        priority, wait, at = current_priority.get(), current_max_ratelimit_wait.get(), deadline.current_deadline.get()
+        if PRIORITIES[priority] < PRIORITIES[self.context[current_priority]]:
+            self.context.run(current_priority.set, priority)
+        if wait > self.context[current_max_ratelimit_wait]:
+            self.context.run(current_max_ratelimit_wait.set, wait)
+        shared_at = self.context[deadline.current_deadline]
+        if shared_at is not None and (at is None or at > shared_at):
+            self.context.run(deadline.current_deadline.set, at)
+
+
+class SingleFlight:
+    """
+    Shares the result of one in-flight call between every caller asking for the same key while it runs.
+    The shared call keeps running if one of its callers gets cancelled.
+    It runs with the most urgent priority, the longest max_ratelimit_wait and the latest deadline of the callers
+    waiting for it. A caller joining later raises them for what the call does from then on, a request already queued
+    keeps its place. Every caller still gives up at its own deadline with DeadlineExceeded.
+    The reservation of the first caller is used by the shared call, reserve() empties it when that caller's block
+    exits, so a call that outlives its first caller takes its own tokens. The reservations of later callers aren't
+    used and are refunded.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    def __repr__(self):
+        return f"<SingleFlight in_flight: {len(self._calls)} stats: {self.stats}>"
+
+    async def run(self, key, call, name: str = "call"):
+        deadline.check(name)
+        flight = self._calls.get(key)
+        if flight is not None:
+            self.stats["coalesced"] += 1
+            flight.join()
+            return await self._wait(flight.future, name)
+
+        flight = _Flight(call)
+        self._calls[key] = flight
+        self.stats["calls"] += 1
+        flight.future.add_done_callback(lambda f: self._done(key, f))
+        return await self._wait(flight.future, name)
+
+    @staticmethod
+    async def _wait(future: asyncio.Future, name: str):
+        """The result of future, or DeadlineExceeded when the caller's deadline passes first"""
+        left = deadline.time_left()
+        if left is not None:
+            await asyncio.wait((future,), timeout=left)
+            if not future.done():
+                raise DeadlineExceeded(f"Deadline passed waiting for {name}", name)
+        return await asyncio.shield(future)
+
+    def _done(self, key, future: asyncio.Future):
+        self._calls.pop(key, None)
+        if not future.cancelled():
+            future.exception()  # retrieved by whoever awaited it, don't warn when they all got cancelled
+
+    def saved(self) -> float:
+        """Fraction of calls that didn't need their own request"""
+        total = self.stats["calls"] + self.stats["coalesced"]
+        return self.stats["coalesced"] / total if total else 0.0
+
+
+class TokenBucket:
+    """
+    Token bucket for a single host.
+    Tokens refill continuously at max / 60 per second on a monotonic clock, so the per-minute budget is spread evenly
+    instead of being spent in one burst when the window resets.
+    Waiters are served by priority class (see PRIORITIES) and in arrival order within a class, exactly one waiter is
+    woken per token. Lower classes only get the tokens no higher class is waiting for.
+    """
+
+    def __init__(self, max_per_minute: int, burst: int = None):
+        self.max = max_per_minute
+        self.rate = max_per_minute / 60  # tokens per second
+        self.capacity = burst if burst else max(1, max_per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._waiters = []  # heap of (priority rank, arrival, future)
+        self._arrivals = itertools.count()
+        self._timer = None
+
+        self.in_flight = 0  # granted requests we haven't seen a response for yet
+        self.sent = 0  # sequence number of the last granted request
+        self.synced = 0  # sequence number of the newest response we synced with
+        self.drift = {"last": 0.0, "mean_abs": 0.0, "syncs": 0}
+        self.backoffs = 0  # 429s that pushed the bucket back
+        self.backoff_until = 0.0  # syncs can't raise the tokens before this
+
+    def __repr__(self):
+        return f"<TokenBucket max: {self.max} tokens: {round(self.tokens, 2)} in_queue: {self.in_queue}>"
+
+    def set_rate(self, max_per_minute: int, burst: int = None):
+        self._refill()
+        self.max = max_per_minute
+        self.rate = max(max_per_minute, 1) / 60
+        self.capacity = burst if burst else max(1, max_per_minute // 10)
+        self.tokens = min(self.tokens, max(self.capacity, 1))
+        if self._waiters:
+            self._schedule()
+
+    @property
+    def in_queue(self) -> int:
+        return len(self._waiters)
+
+    def queued(self) -> dict:
+        queued = {name: 0 for name in PRIORITIES}
+        names = {rank: name for name, rank in PRIORITIES.items()}
+        for rank, _, _ in self._waiters:
+            queued[names[rank]] += 1
+        return queued
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.tokens < self.capacity:  # a sync can leave us above capacity to use up the rest of a server window
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def wait_time(self, priority: str = None) -> float:
+        """
+        Seconds until a new request of the given priority would get a token, assuming nothing with a higher priority
+        arrives in the meantime. Without a priority the back of the whole queue is used.
+        """
+        self._refill()
+        if priority is None:
+            position = self.in_queue
+        else:
+            rank = PRIORITIES[priority]
+            position = sum(1 for waiter_rank, _, _ in self._waiters if waiter_rank <= rank)
+        return max(0.0, (position + 1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            self._granted()
+            return True
+        return False
+
+    def _granted(self):
+        self.in_flight += 1
+        self.sent += 1
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def set_tokens(self, tokens: float):
+        """Sets the tokens available right now, at most capacity, e.g. to follow the keys of a KeyPool"""
+        self._refill()
+        self.tokens = min(float(self.capacity), tokens)
+        if self._waiters:
+            self._schedule()
+
+    def refund(self, count: int = 1):
+        """Gives back granted tokens that were never used for a request."""
+        self._refill()
+        self.tokens = min(self.tokens + count, max(self.tokens, self.capacity))
+        self.in_flight = max(0, self.in_flight - count)
+        if self._waiters:
+            self._schedule()
+
+    def sync(self, remaining: int, reset: float, seq: int) -> float:
+        """
+        Reconciles the bucket with the window a server reported in a response.
+        The server has already counted the request of that response, but not necessarily the ones still in flight, so
+        those are taken off its remaining budget. The tokens are then set so that spending them now plus the refill until
+        the window resets uses exactly what is left in it. Lowering is always safe, raising is only done for responses
+        newer than the last sync, so a late response to an old request can't hand out budget twice, and never during a
+        backoff after a 429.
+        Returns the drift, how many more requests we expected to be able to send in this window than the server allows.
+        """
+        self._refill()
+        server_remaining = remaining - self.in_flight
+        refill = self.rate * max(0.0, reset)
+        drift = (self.tokens + refill) - server_remaining
+        target = min(float(self.max), server_remaining - refill)
+
+        if target < self.tokens or (seq > self.synced and time.monotonic() >= self.backoff_until):
+            self.tokens = target
+        self.synced = max(self.synced, seq)
+
+        self.drift["last"] = drift
+        self.drift["syncs"] += 1
+        self.drift["mean_abs"] += (abs(drift) - self.drift["mean_abs"]) / min(self.drift["syncs"], 100)
+        if self._waiters:
+            self._schedule()
+        return drift
+
+    def backoff(self, seconds: float):
+        """Hands out no token for the next `seconds`, after the server answered 429. Never raises the tokens."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - self.rate * seconds)
+        self.backoff_until = max(self.backoff_until, time.monotonic() + seconds)
+        self.backoffs += 1
+        if self._waiters:
+            self._schedule()
+
+    async def acquire(self, max_wait: float = DEFAULT_TIMEOUT, priority: str = DEFAULT_PRIORITY):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Invalid priority: {priority}")
+        if self.try_acquire():
+            return 0
+        wait = self.wait_time(priority)
+        if wait >= max_wait:
+            raise RatelimitReached(
+                f"Ratelimit reached! Try again in {round(wait, 1)} seconds. {self.in_queue} requests in queue.",
+                reset_time=Time().time + wait,
+            )
+        future = asyncio.get_running_loop().create_future()
+        waiter = (PRIORITIES[priority], next(self._arrivals), future)
+        heapq.heappush(self._waiters, waiter)
+        self._schedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.tokens += 1  # the token was granted after we got cancelled, hand it back
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+            self._schedule()
+            raise
+        return wait
+
+    def _schedule(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._waiters:
+            self._timer = asyncio.get_running_loop().call_later(
+                max(0.0, (1 - self.available()) / self.rate), self._wake
+            )
+
+    def _wake(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.tokens -= 1
+            self._granted()
+            future.set_result(None)
+        self._schedule()
+
+
+def bucket_name(host: str, key: str = None) -> str:
+    """Name of the bucket for a host, or for one API key of a host without putting the key itself in it"""
+    if key is None:
+        return host
+    return f"{host}:{hashlib.sha256(key.encode()).hexdigest()[:16]}"
+
+
+def request_host(params, ctx=None) -> str:
+    """The host a request is for, which isn't the one it's sent to when the session has an upstream for it"""
+    trace_request_ctx = getattr(ctx, "trace_request_ctx", None) or {}
+    return trace_request_ctx.get("host") or str(params.url.host)
+
+
+class MemoryLimiter:
+    """Buckets that only live in this process, see objects.pg_limiter for ones shared between processes"""
+
+    def bucket(self, name: str, max_per_minute: int, burst: int = None) -> TokenBucket:
+        return TokenBucket(max_per_minute, burst)
+
+
+class ApiKey:
+    def __init__(self, key: str, bucket: TokenBucket):
+        self.key = key
+        self.bucket = bucket
+        self.strikes = 0  # 403s and 429s in a row
+        self.disabled_until = 0.0
+
+    def __repr__(self):
+        return f"<ApiKey ...{self.key[-4:]} tokens: {round(self.bucket.available(), 2)} strikes: {self.strikes}>"
+
+    def is_active(self) -> bool:
+        return self.disabled_until <= time.monotonic()
+
+
+class KeyPool:
+    """
+    A pool of API keys for one host, each with its own bucket.
+    Every request goes out with the key that has the most headroom. A key that gets max_strikes 403s or 429s in a row
+    is taken out of rotation for `cooldown` seconds, the last active key is never taken out.
+    """
+
+    def __init__(self, keys: list, max_per_minute: int, burst: int = None, header: str = "API-Key",
+                 max_strikes: int = 3, cooldown: float = 600, logger: logging.Logger = None, host: str = "",
+                 limiter: MemoryLimiter = None):
+        limiter = limiter if limiter else MemoryLimiter()
+        self.keys = [ApiKey(key, limiter.bucket(bucket_name(host, key), max_per_minute, burst)) for key in keys]
+        self.max_per_minute = max_per_minute
+        self.burst = burst
+        self.header = header
+        self.max_strikes = max_strikes
+        self.cooldown = cooldown
+        self.logger = logger if logger else logging.getLogger(__name__)
+
+    def __repr__(self):
+        return f"<KeyPool active: {len(self.active())}/{len(self.keys)}>"
+
+    def active(self) -> list:
+        return [key for key in self.keys if key.is_active()]
+
+    def max(self) -> int:
+        """Requests per minute all active keys together allow"""
+        return self.max_per_minute * max(len(self.active()), 1)
+
+    def capacity(self) -> int:
+        return sum(key.bucket.capacity for key in self.active()) or 1
+
+    def choose(self) -> ApiKey:
+        keys = self.active() or self.keys
+        return max(keys, key=lambda k: k.bucket.available() - k.bucket.in_queue)
+
+    async def acquire(self, max_wait: float = DEFAULT_TIMEOUT, priority: str = DEFAULT_PRIORITY) -> ApiKey:
+        key = self.choose()
+        await key.bucket.acquire(max_wait, priority)
+        return key
+
+    def report(self, key: ApiKey, status: int) -> bool:
+        """Counts strikes for the key, returns True when it was taken out of rotation"""
+        if status not in (403, 429):
+            key.strikes = 0
+            return False
+        key.strikes += 1
+        if key.strikes < self.max_strikes or len(self.active()) <= 1:
+            return False
+        key.strikes = 0
+        key.disabled_until = time.monotonic() + self.cooldown
+        self.logger.error(f"Taking {key} out of rotation for {self.cooldown}s after {self.max_strikes} {status}s")
+        return True
+
+    def tokens(self) -> float:
+        """Tokens available over all active keys, keys in debt don't hold the others back"""
+        return sum(max(0.0, key.bucket.available()) for key in self.active())
+
+
 class Ratelimit:
     """
     Ratelimitresponse class for handling ratelimits.
@@ -58,16 +550,18 @@ class Ratelimit:
         return self.host
 
     def remaining(self):
-        return self.api_d.get("remaining")
+        """Requests that can still be granted within the next minute, after everything already queued."""
+        bucket = self.api_d["bucket"]
+        return max(0, min(bucket.max, int(bucket.available() + bucket.rate * 60) - bucket.in_queue))
 
     def reset_time(self):
-        return self.api_d.get("reset_time")
+        return Time().time + self.wait_time()
 
     def wait_time(self):
-        return self.reset_time() - Time().time
+        return self.api_d["bucket"].wait_time()
 
     def max(self):
-        return self.api_d.get("max")
+        return self.api_d["bucket"].max
 
     def ratelimit_sync(self):
         return self.api_d.get("ratelimit_sync")
@@ -76,12 +570,16 @@ class Ratelimit:
         return self.api_d.get("exclude")
 
     def is_limited(self):
-        return self.remaining() == 0
+        return self.wait_time() > 0
+
+    def drift(self):
+        return self.api_d["bucket"].drift
 
 
 class RatelimitHandler:
-    def __init__(self, logger: logging.Logger = None):
+    def __init__(self, logger: logging.Logger = None, limiter: MemoryLimiter = None):
         self.logger = logger if logger else logging.getLogger(__name__)
+        self.limiter = limiter if limiter else MemoryLimiter()
         self.rate_limits = {  # everything is in requests per minute
             "api.mojang.com": {  # https://wiki.vg/Mojang_API
                 "max": 60,  # max requests per minute
@@ -95,8 +593,9 @@ class RatelimitHandler:
             },
             "api.hypixel.net": {  # https://api.hypixel.net/
                 "max": 100,  # max requests per minute
-                "headers": {"API-Key": HYPIXEL_KEY},
-                "ratelimit_sync": False,
+                "burst": 5,  # keep the key's budget spread over the whole minute
+                "keys": HYPIXEL_KEYS,  # max and burst are per key, sent as the API-Key header
+                "ratelimit_sync": True,  # RateLimit-Remaining / RateLimit-Reset
                 "exclude": ["/skyblock/auctions", "/skyblock/auctions_ended"],
             },
             "api.robothanzo.dev": {  # https://api.robothanzo.dev/
@@ -121,127 +620,437 @@ class RatelimitHandler:
 
         }
         for key, value in self.rate_limits.items():
-            value["reset_time"], value["remaining"], value["in_queue"] = 0, value["max"], 0
+            if value.get("keys"):  # the keys are limited, the host bucket only keeps their sum in check locally
+                value["key_pool"] = KeyPool(value["keys"], value["max"], value.get("burst"), logger=self.logger,
+                                            host=key, limiter=self.limiter)
+                value["bucket"] = TokenBucket(value["key_pool"].max(), value["key_pool"].capacity())
+            else:
+                value["bucket"] = self.limiter.bucket(key, value["max"], value.get("burst"))
+
+    def _update_key_pool(self, api_d: dict):
+        """Scales the host bucket to the keys in rotation"""
+        pool: KeyPool = api_d["key_pool"]
+        if api_d["bucket"].max != pool.max():
+            api_d["bucket"].set_rate(pool.max(), pool.capacity())
 
     def get_ratelimit(self, host: str) -> Ratelimit:
         if host in self.rate_limits:
-            api_d = self.rate_limits[host]
-
-            if api_d["reset_time"] - Time().time <= 0:
-                api_d["reset_time"] = Time().time + 60
-                api_d["remaining"] = api_d["max"]
-            return Ratelimit(host, api_d)
+            return Ratelimit(host, self.rate_limits[host])
         return Ratelimit(host, None)
 
+    @contextlib.asynccontextmanager
+    async def reserve(self, hosts: list, max_ratelimit_wait: float = None, priority: str = None):
+        """
+        Takes a token on every host up front, requests made inside the block use them instead of queueing again.
+        Whatever isn't used is refunded when the block exits.
+        """
+        max_ratelimit_wait = current_max_ratelimit_wait.get() if max_ratelimit_wait is None else max_ratelimit_wait
+        left = deadline.time_left()
+        if left is not None:
+            max_ratelimit_wait = min(max_ratelimit_wait, left)
+        priority = priority or current_priority.get()
+        needed = {host: 1 for host in hosts if host in self.rate_limits}
+
+        for host in needed:  # check everything before taking anything
+            wait = self.rate_limits[host]["bucket"].wait_time(priority)
+            if wait >= max_ratelimit_wait:
+                raise RatelimitReached(
+                    f"{host}: Ratelimit reached! Try again in {round(wait, 1)} seconds.",
+                    reset_time=Time().time + wait,
+                )
+
+        reservation = {}
+        tasks = {
+            host: asyncio.ensure_future(self.rate_limits[host]["bucket"].acquire(max_ratelimit_wait, priority))
+            for host in needed
+        }
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for host, task in tasks.items():
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    self.rate_limits[host]["bucket"].refund()
+            raise
+        for host in tasks:
+            reservation[host] = 1
+
+        token = current_reservation.set(reservation)
+        try:
+            yield reservation
+        finally:
+            current_reservation.reset(token)
+            for host, count in reservation.items():
+                if count:
+                    self.rate_limits[host]["bucket"].refund(count)
+            reservation.clear()  # a coalesced call still running with it takes its own tokens from now on
+
     async def before_request(self, params: aiohttp.tracing.TraceRequestStartParams,
-                             max_ratelimit_wait: int = DEFAULT_TIMEOUT) -> aiohttp.tracing.TraceRequestStartParams:
-        host = str(params.url.host)
-        api_d = None
+                             max_ratelimit_wait: int = DEFAULT_TIMEOUT,
+                             priority: str = DEFAULT_PRIORITY, ctx=None) -> aiohttp.tracing.TraceRequestStartParams:
+        host = request_host(params, ctx)
         if host in self.rate_limits:
             api_d = self.rate_limits[host]
 
             if any([params.url.path.startswith(i) for i in api_d["exclude"]]):
                 return params
-            api_d["in_queue"] += 1
 
             params.headers.update(api_d.get("headers", {}))
 
-            while 1:
-                if (api_d["reset_time"] - Time().time) + 2 <= 0:
-                    api_d["remaining"], api_d["reset_time"] = api_d["max"] - 1, Time().time + 60
-                    break
-
-                if api_d["remaining"] <= 1:
-                    extra_wait = int(api_d["in_queue"] / api_d["max"]) * 60
-
-                    sleep_time = abs((api_d["reset_time"] - Time().time) + extra_wait)
-                    if sleep_time >= max_ratelimit_wait:
-                        api_d["in_queue"] -= 1
-                        from objects.errors import RatelimitReached
-                        raise RatelimitReached(
-                            f"Ratelimit reached for {host}! Try again in {round(sleep_time, 1)} seconds. {api_d['in_queue']} requests in queue.",
-                            reset_time=api_d["reset_time"],
-                        )
-                    self.logger.error(
-                        f"Ratelimit reached for {host}! Sleeping for {round(sleep_time, 1)} seconds. {api_d['in_queue']} requests in queue."
-                    )
-                    await asyncio.sleep(sleep_time + 1.5)
-
-                elif api_d["remaining"] > 1:
-                    api_d["remaining"] -= 1
-                    break
-                print("waiting for ratelimit")
-
-        if api_d:
-            api_d["in_queue"] -= 1
+            bucket: TokenBucket = api_d["bucket"]
+            started = time.monotonic()
+            reservation = current_reservation.get()
+            if reservation and reservation.get(host):
+                reservation[host] -= 1
+                waited = 0
+            else:
+                try:
+                    waited = await bucket.acquire(max_ratelimit_wait, priority)
+                except RatelimitReached as e:
+                    raise RatelimitReached(f"{host}: {e.message}", reset_time=e.reset_time)
+            if ctx is not None:
+                ctx.ratelimit_seq = bucket.sent
+
+            pool: KeyPool = api_d.get("key_pool")
+            if pool is not None:
+                self._update_key_pool(api_d)
+                try:  # whatever the host bucket took comes out of the time this request may wait
+                    api_key = await pool.acquire(max(0.0, max_ratelimit_wait - (time.monotonic() - started)), priority)
+                except BaseException:
+                    bucket.refund()
+                    raise
+                params.headers[pool.header] = api_key.key
+                if ctx is not None:
+                    ctx.api_key, ctx.api_key_seq = api_key, api_key.bucket.sent
+            if waited:
+                self.logger.debug(
+                    f"Waited {round(waited, 1)} seconds for {host} ({priority}). {bucket.queued()} requests in queue."
+                )
         return params
 
-    async def after_request(self, params: aiohttp.tracing.TraceRequestEndParams):
-        host = str(params.url.host)
+    def request_not_sent(self, params: aiohttp.tracing.TraceRequestStartParams, ctx=None):
+        """Gives back the tokens before_request granted to a request that got cancelled or failed before it was sent"""
+        host = request_host(params, ctx)
+        if ctx is not None and hasattr(ctx, "ratelimit_seq") and host in self.rate_limits:
+            del ctx.ratelimit_seq
+            self.rate_limits[host]["bucket"].refund()
+            api_key: ApiKey = getattr(ctx, "api_key", None)
+            if api_key:
+                ctx.api_key = None
+                api_key.bucket.refund()
+
+    def request_failed(self, params: aiohttp.tracing.TraceRequestExceptionParams, ctx=None):
+        host = request_host(params, ctx)
+        if ctx is not None and hasattr(ctx, "ratelimit_seq") and host in self.rate_limits:
+            self.rate_limits[host]["bucket"].release()
+            if getattr(ctx, "api_key", None):
+                ctx.api_key.bucket.release()
+
+    async def after_request(self, params: aiohttp.tracing.TraceRequestEndParams, ctx=None):
+        host = request_host(params, ctx)
         if host in self.rate_limits:
             api_d, headers = self.rate_limits[host], params.response.headers
+            if ctx is None or not hasattr(ctx, "ratelimit_seq"):  # excluded path, never took a token
+                return
+            bucket: TokenBucket = api_d["bucket"]
+            bucket.release()
+            api_key: ApiKey = getattr(ctx, "api_key", None)
+            if api_key:
+                api_key.bucket.release()
+                if api_d["key_pool"].report(api_key, params.response.status):
+                    self._update_key_pool(api_d)
+            if params.response.status == 429:
+                seconds = retry_after(headers)
+                if api_key:
+                    api_key.bucket.backoff(seconds)
+                    bucket.set_tokens(min(bucket.available(), api_d["key_pool"].tokens()))
+                else:
+                    bucket.backoff(seconds)
+                self.logger.warning(f"429 from {host}, backing off for {round(seconds, 1)}s")
+                return  # syncing could hand the tokens right back
             if not api_d["ratelimit_sync"]:
                 return
             try:
                 seconds = float(headers.get("RateLimit-Reset") or headers.get("Retry-After"))
                 remaining = int(headers.get("RateLimit-Remaining") or headers.get("X-RateLimit-Remaining"))
-            except TypeError:
+            except (TypeError, ValueError):
                 return
 
-            # if time.time() - request_time > seconds - 10:
-            #     print(time.time() - request_time, seconds)
-            #     return
-            if seconds <= 5 or remaining <= 10:
-                print(f"Not syncing {seconds}, {api_d['remaining']}, {remaining}")
-                return
+            if api_key:  # the server's window belongs to the key, the host bucket follows the keys
+                synced = api_key.bucket
+                drift = synced.sync(remaining, seconds, ctx.api_key_seq)
+                bucket.set_tokens(api_d["key_pool"].tokens())
+            else:
+                synced = bucket
+                drift = bucket.sync(remaining, seconds, ctx.ratelimit_seq)
+            self.logger.debug(
+                f"Synced the rate-limits for {host}: {remaining} remaining, reset in {seconds}s, "
+                f"drift {round(drift, 1)} (mean {round(synced.drift['mean_abs'], 1)})"
+            )
 
-            try:
-                if api_d.get("ratelimit_sync_remaining", True):
-                    api_d["remaining"] = min(
-                        remaining,
-                        api_d["remaining"]
-                    )
-                seconds = float(headers.get("RateLimit-Reset") or headers.get("Retry-After"))
-                api_d["reset_time"] = Time().time + seconds
-                self.logger.info(f"Synced the rate-limits for {host} {api_d['remaining']} {seconds}")
-            except TypeError:
-                pass
+
+class ResponseCache:
+    """
+    Bounded LRU cache of decoded GET responses, keyed by URL.
+    Every endpoint has its own TTL (see RESPONSE_CACHE_TTLS), endpoints without one aren't cached.
+    The cached values are shared between callers, treat them as read-only.
+    """
+
+    def __init__(self, ttls: dict = None, max_size: int = 1024):
+        self.ttls = RESPONSE_CACHE_TTLS if ttls is None else ttls
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # url or key: (expires, value)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __repr__(self):
+        return f"<ResponseCache size: {len(self._entries)}/{self.max_size} stats: {self.stats}>"
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl(self, url: yarl.URL) -> Union[float, None]:
+        for prefix, ttl in self.ttls.get(url.host, {}).items():
+            if url.path.startswith(prefix):
+                return ttl
+        return None
+
+    def get(self, url: yarl.URL, key=None):
+        """Returns the cached value or None, key defaults to the url"""
+        key = url if key is None else key
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            if self.ttl(url):
+                self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def set(self, url: yarl.URL, value, key=None):
+        ttl = self.ttl(url)
+        if not ttl:
+            return
+        key = url if key is None else key
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+
+class ConnectionProfiles:
+    """Per-host connection limits and timeouts, plus counters of how often connections get reused."""
+
+    def __init__(self, profiles: dict = None):
+        self.profiles = CONNECTION_PROFILES if profiles is None else profiles
+        self._semaphores = {}
+        self.stats = {}
+
+    def get(self, host: str) -> dict:
+        return {**self.profiles["default"], **self.profiles.get(host, {})}
+
+    def connector(self, **kwargs) -> aiohttp.TCPConnector:
+        kwargs.setdefault("limit", sum(self.get(host)["limit"] for host in self.profiles))
+        kwargs.setdefault("limit_per_host", max(self.get(host)["limit"] for host in self.profiles))
+        kwargs.setdefault("keepalive_timeout", max(self.get(host)["keepalive_timeout"] for host in self.profiles))
+        kwargs.setdefault("ttl_dns_cache", DNS_CACHE_TTL)
+        return aiohttp.TCPConnector(**kwargs)
+
+    def timeout(self, host: str, total: float = None) -> aiohttp.ClientTimeout:
+        profile = self.get(host)
+        return aiohttp.ClientTimeout(
+            total=total, sock_connect=profile["connect_timeout"], sock_read=profile["read_timeout"]
+        )
+
+    def semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.get(host)["limit"])
+        return self._semaphores[host]
+
+    def count(self, host: str, stat: str):
+        if host not in self.stats:
+            self.stats[host] = {"requests": 0, "new_connections": 0, "reused_connections": 0, "dns_hits": 0,
+                                "dns_misses": 0}
+        self.stats[host][stat] += 1
+
+    def reuse_rate(self, host: str) -> float:
+        stats = self.stats.get(host)
+        if not stats:
+            return 0.0
+        total = stats["new_connections"] + stats["reused_connections"]
+        return stats["reused_connections"] / total if total else 0.0
 
 
 class RateLimitSession(aiohttp.ClientSession):
-    def __init__(self, logger: logging.Logger = None, *args, **kwargs):
+    def __init__(self, logger: logging.Logger = None, *args, response_cache: ResponseCache = None,
+                 connection_profiles: ConnectionProfiles = None, limiter: MemoryLimiter = None,
+                 cassette: Cassette = None, upstreams: dict = None, max_requeues: int = MAX_REQUEUES, **kwargs):
         _trace_config = aiohttp.TraceConfig()
         _trace_config.on_request_start.append(self.on_request_start)
         _trace_config.on_request_end.append(self.on_request_end)
+        _trace_config.on_request_exception.append(self.on_request_exception)
+        _trace_config.on_connection_create_end.append(self.on_connection_create_end)
+        _trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+        _trace_config.on_dns_cache_hit.append(self.on_dns_cache_hit)
+        _trace_config.on_dns_cache_miss.append(self.on_dns_cache_miss)
 
         kwargs_config = kwargs.get("trace_configs", [])
         kwargs_config.append(_trace_config)
         kwargs["trace_configs"] = kwargs_config
 
+        self.connection_profiles = connection_profiles if connection_profiles else ConnectionProfiles()
+        if "connector" not in kwargs:
+            kwargs["connector"] = self.connection_profiles.connector()
+
         super().__init__(*args, **kwargs)
         self.logger = logger if logger else logging.getLogger(__name__)
-        self.ratelimit_handler = RatelimitHandler(self.logger)
+        self.ratelimit_handler = RatelimitHandler(self.logger, limiter)
+        self.response_cache = response_cache
+        self.single_flight = SingleFlight()
+        self.cassette = cassette
+        # host: base URL to send its requests to instead, rate-limits and stats still go by the original host
+        self.upstreams = {host: yarl.URL(url) for host, url in (upstreams or {}).items()}
+        self.max_requeues = max_requeues
+        self.requeues = 0
 
-    async def on_request_start(self, session, ctx, params: aiohttp.tracing.TraceRequestStartParams):
-        params: aiohttp.tracing.TraceRequestStartParams = (
-            await self.ratelimit_handler.before_request(
-                params, ctx.trace_request_ctx.get("max_ratelimit_wait", DEFAULT_TIMEOUT)
-                if ctx.trace_request_ctx else DEFAULT_TIMEOUT,
-            )
-        )
-        self.logger.info(f"Making {params.method} request to {params.url}")
+    async def _request(self, method: str, str_or_url, **kwargs):
+        body = kwargs.get("data") if kwargs.get("json") is None else codec.dumps(kwargs["json"])
+        if self.cassette is not None and self.cassette.replaying:
+            return await self.cassette.play(method, str_or_url, body)
+        url = yarl.URL(str_or_url)
+        host, timeout = url.host, "timeout" not in kwargs
+        if url.host in self.upstreams:
+            kwargs["trace_request_ctx"] = {**(kwargs.get("trace_request_ctx") or {}), "host": url.host}
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), "Host": url.host}
+            url = self.upstreams[url.host].with_path(url.path).with_query(url.query)
 
-    async def on_request_end(self, session, ctx, params: aiohttp.tracing.TraceRequestEndParams):
-        if params.response.status == 429:
+        requeues = 0
+        while True:
+            left = deadline.check(f"{method} {host}{url.path}")
+            if timeout:
+                kwargs["timeout"] = self.connection_profiles.timeout(host, left)
+            response = await super()._request(method, url, **kwargs)
+            if response.status != 429 or requeues >= self.max_requeues:
+                break
+            # the limiter is backing off already, go again at the front of its queue
+            response.release()
+            requeues += 1
+            self.requeues += 1
+            kwargs["trace_request_ctx"] = {**(kwargs.get("trace_request_ctx") or {}), "priority": "requeue"}
+
+        if response.status == 429:
             try:
-                r = await params.response.json()
+                r = await response.json()
             except:
                 try:
-                    r = await params.response.text()
+                    r = await response.text()
                 except:
-                    r = params.response
-            from objects.errors import InternalRatelimitReached
-            error = InternalRatelimitReached(params.response, r)
+                    r = response
+            error = InternalRatelimitReached(response, r)
             self.logger.error(error.message)
             raise error
-        await self.ratelimit_handler.after_request(params)
+        if self.cassette is not None and self.cassette.recording:
+            await self.cassette.record(method, str_or_url, body, response)
+        return response
+
+    async def close(self):
+        if self.cassette is not None:
+            self.cassette.close()
+        await super().close()
+
+    def _release_connection_slot(self, ctx):
+        slot = getattr(ctx, "connection_slot", None)
+        if slot is not None:
+            ctx.connection_slot = None
+            slot.release()
+
+    async def get_json(self, url: str, decode=codec.loads, cache_key=None, cache_value=None, use_cache: bool = True,
+                       **kwargs):
+        """
+        GETs and decodes a JSON response, raising UnexpectedResponse for anything but a 200.
+        decode gets the raw body, pass a cache_key along with it when it doesn't return the plain decoded response.
+        cache_value maps the decoded response to what's kept of it in the response_cache, nothing when it returns None.
+        The caller that made the request gets all of it, later ones only what was kept.
+        Endpoints with a TTL in the response_cache are answered from it without using a rate-limit token, unless
+        use_cache is False.
+        """
+        url = yarl.URL(url)
+        response_cache = self.response_cache if use_cache else None
+        if response_cache is not None:
+            cached = response_cache.get(url, cache_key)
+            if cached is not None:
+                return cached
+        async with self.get(url, **kwargs) as r:
+            if r.status != 200:
+                raise UnexpectedResponse(f"Error getting {url.path} {r.status}", r)
+            data = decode(await r.read())
+        if response_cache is not None:
+            kept = data if cache_value is None else cache_value(data)
+            if kept is not None:
+                response_cache.set(url, kept, cache_key)
+        return data
+
+    async def on_request_start(self, session, ctx, params: aiohttp.tracing.TraceRequestStartParams):
+        trace_request_ctx = ctx.trace_request_ctx or {}
+        max_ratelimit_wait = trace_request_ctx.get("max_ratelimit_wait", current_max_ratelimit_wait.get())
+        left = deadline.time_left()
+        try:
+            params: aiohttp.tracing.TraceRequestStartParams = (
+                await self.ratelimit_handler.before_request(
+                    params,
+                    max_ratelimit_wait if left is None else min(max_ratelimit_wait, left),
+                    trace_request_ctx.get("priority", current_priority.get()),
+                    ctx,
+                )
+            )
+        except RatelimitReached as e:
+            if left is not None and left < max_ratelimit_wait:  # it was the deadline that didn't leave enough time
+                raise DeadlineExceeded(f"{e.message} That's past the deadline.", f"{params.method} {params.url}")
+            raise
+        # aiohttp only sends on_request_exception/on_request_end once this returned, anything that goes wrong from here
+        # on has to give back the token and the connection slot itself
+        try:
+            ctx.host = request_host(params, ctx)
+            self.connection_profiles.count(ctx.host, "requests")
+            # taken after the rate limiter so requests waiting for a token don't hold up the ones that have one
+            slot = self.connection_profiles.semaphore(ctx.host)
+            await slot.acquire()
+            ctx.connection_slot = slot
+            ctx.sent_at = time.monotonic()
+            self.logger.info(f"Making {params.method} request to {params.url}")
+        except BaseException:
+            self._release_connection_slot(ctx)
+            self.ratelimit_handler.request_not_sent(params, ctx)
+            raise
+
+    async def on_connection_create_end(self, session, ctx, params):
+        self.connection_profiles.count(getattr(ctx, "host", None), "new_connections")
+
+    async def on_connection_reuseconn(self, session, ctx, params):
+        self.connection_profiles.count(getattr(ctx, "host", None), "reused_connections")
+
+    async def on_dns_cache_hit(self, session, ctx, params):
+        self.connection_profiles.count(params.host, "dns_hits")
+
+    async def on_dns_cache_miss(self, session, ctx, params):
+        self.connection_profiles.count(params.host, "dns_misses")
+
+    async def on_request_exception(self, session, ctx, params: aiohttp.tracing.TraceRequestExceptionParams):
+        self._release_connection_slot(ctx)
+        self.ratelimit_handler.request_failed(params, ctx)
+
+    async def on_request_end(self, session, ctx, params: aiohttp.tracing.TraceRequestEndParams):
+        self._release_connection_slot(ctx)
+        if self.cassette is not None and hasattr(ctx, "sent_at"):
+            self.cassette.latencies[params.response] = time.monotonic() - ctx.sent_at
+        await self.ratelimit_handler.after_request(params, ctx)
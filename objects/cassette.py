@@ -0,0 +1,185 @@
+"""
+Record/replay of HTTP responses for running the pipeline offline.
+
+In record mode RateLimitSession appends every response (status, headers, body and how long the server took) to a
+gzipped JSON lines cassette. In replay mode requests never leave the process, they are answered from the cassette with
+the recorded latency, or a fixed one, so a guild refresh can be rerun deterministically with real payload sizes and
+without using any quota. Replayed requests skip the rate limiter.
+
+CASSETTE=cassettes/guild_refresh.jsonl.gz CASSETTE_MODE=record|replay [CASSETTE_LATENCY=0.05] python main.py
+"""
+import asyncio
+import base64
+import collections
+import gzip
+import hashlib
+import http
+import json
+import logging
+import os
+import weakref
+
+import aiohttp
+import yarl
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from objects.errors import *
+
+MODES = ("record", "replay")
+# Query parameters that differ between runs without changing the response, API keys mostly
+IGNORED_PARAMS = ("key",)
+# Response headers that are useless offline
+IGNORED_HEADERS = ("Set-Cookie", "Date", "CF-RAY", "Report-To", "NEL")
+
+
+def request_key(method: str, url, body=None) -> str:
+    url = yarl.URL(str(url))
+    query = sorted((key, value) for key, value in url.query.items() if key not in IGNORED_PARAMS)
+    url = url.with_query(query).with_fragment(None)
+    if isinstance(body, str):
+        body = body.encode()
+    digest = hashlib.sha1(body).hexdigest()[:16] if body else ""
+    return f"{method.upper()} {url} {digest}".rstrip()
+
+
+class CassetteResponse:
+    """Stands in for an aiohttp.ClientResponse when replaying"""
+
+    def __init__(self, method: str, url, status: int, headers: list, body: bytes):
+        self.method = method
+        self.url = yarl.URL(str(url))
+        self.status = status
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self._body = body
+        try:
+            self.reason = http.HTTPStatus(status).phrase
+        except ValueError:
+            self.reason = ""
+
+    def __repr__(self):
+        return f"<CassetteResponse({self.url}) [{self.status} {self.reason}]>"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    @property
+    def content_type(self) -> str:
+        return self.headers.get("Content-Type", "application/octet-stream").split(";")[0].strip()
+
+    @property
+    def content_length(self) -> int:
+        return len(self._body)
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str = None, errors: str = "strict") -> str:
+        return self._body.decode(encoding or "utf-8", errors)
+
+    async def json(self, *, encoding: str = None, loads=json.loads, content_type: str = "application/json"):
+        if not self._body.strip():
+            return None
+        return loads(self._body.decode(encoding or "utf-8"))
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise aiohttp.ClientResponseError(
+                None, (), status=self.status, message=self.reason, headers=self.headers
+            )
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Cassette:
+    """
+    A cassette file, see the module docstring.
+    Identical requests are replayed in the order they were recorded, the last recording is repeated once they run out.
+    latency overrides the recorded latency of every response when set, 0 replays as fast as possible.
+    """
+
+    def __init__(self, path: str, mode: str = "replay", latency: float = None, logger: logging.Logger = None):
+        if mode not in MODES:
+            raise ValueError(f"Invalid cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.latencies = weakref.WeakKeyDictionary()  # response: seconds until its headers arrived
+        self.stats = {"recorded": 0, "played": 0, "misses": 0, "bytes": 0}
+        self._tapes = collections.defaultdict(collections.deque)
+        self._file = None
+
+        if self.replaying:
+            self.load()
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = gzip.open(path, "at", encoding="utf-8")
+
+    def __repr__(self):
+        return f"<Cassette {self.path} mode: {self.mode} {self.stats}>"
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._tapes[entry["key"]].append(entry)
+        self.logger.info(f"Loaded {sum(map(len, self._tapes.values()))} responses from {self.path}")
+
+    async def record(self, method: str, url, body, response: aiohttp.ClientResponse):
+        raw = await response.read()  # aiohttp keeps the body around, the caller reads it again
+        try:
+            entry_body = {"body": raw.decode("utf-8")}
+        except UnicodeDecodeError:
+            entry_body = {"body_b64": base64.b64encode(raw).decode()}
+        entry = {
+            "key": request_key(method, url, body),
+            "status": response.status,
+            "headers": [[k, v] for k, v in response.headers.items() if k not in IGNORED_HEADERS],
+            "latency": round(self.latencies.pop(response, 0.0), 4),
+            **entry_body,
+        }
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.stats["recorded"] += 1
+        self.stats["bytes"] += len(raw)
+
+    async def play(self, method: str, url, body=None) -> CassetteResponse:
+        key = request_key(method, url, body)
+        tape = self._tapes.get(key)
+        if not tape:
+            self.stats["misses"] += 1
+            raise CassetteMiss(f"No recorded response for {key} in {self.path}", key)
+        entry = tape.popleft() if len(tape) > 1 else tape[0]
+        await asyncio.sleep(entry["latency"] if self.latency is None else self.latency)
+        if "body_b64" in entry:
+            raw = base64.b64decode(entry["body_b64"])
+        else:
+            raw = entry["body"].encode("utf-8")
+        self.stats["played"] += 1
+        self.stats["bytes"] += len(raw)
+        return CassetteResponse(method, url, entry["status"], entry["headers"], raw)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.logger.info(f"Recorded {self.stats['recorded']} responses to {self.path}")
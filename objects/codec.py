@@ -0,0 +1,48 @@
+"""
+JSON codec used by Httpr for decoding responses and encoding request bodies.
+Uses orjson when it's installed, then ujson, and the standard library otherwise.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson is not None:
+    BACKEND = "orjson"
+elif ujson is not None:
+    BACKEND = "ujson"
+else:
+    BACKEND = "json"
+
+CONTENT_TYPE = "application/json"
+
+
+def loads(data):
+    """Decodes JSON from bytes or str"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:  # orjson refuses integers over 64 bits, the standard library doesn't
+            return json.loads(data)
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """Encodes obj to compact UTF-8 JSON bytes"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:  # same for encoding, and for non-str keys
+            pass
+    elif ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False).encode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
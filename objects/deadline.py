@@ -0,0 +1,42 @@
+"""
+Deadlines that follow a refresh into every request and query it makes.
+
+deadline(seconds) sets an absolute deadline for everything inside it, including tasks created there. RateLimitSession
+caps rate-limit waits and request timeouts to the time left, RetryPolicy doesn't retry past it and Database passes it as
+the query timeout. Work started after the deadline raises DeadlineExceeded.
+"""
+import contextlib
+import time
+from contextvars import ContextVar
+from typing import Union
+
+from objects.errors import DeadlineExceeded
+
+# Absolute deadline on the time.monotonic() clock, None when there is none
+current_deadline: ContextVar[Union[float, None]] = ContextVar("current_deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """Everything inside has to be done within seconds, an earlier deadline that's already set is kept"""
+    at = time.monotonic() + seconds
+    outer = current_deadline.get()
+    token = current_deadline.set(at if outer is None else min(outer, at))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def time_left() -> Union[float, None]:
+    """Seconds until the current deadline, None without one"""
+    at = current_deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def check(what: str) -> Union[float, None]:
+    """Raises DeadlineExceeded when the deadline has passed before `what` could start, otherwise returns time_left()"""
+    left = time_left()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline passed {round(-left, 1)}s before {what}", what)
+    return left
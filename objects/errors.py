@@ -56,3 +56,25 @@ class InvalidURL(Exception):
     def __init__(self, message, url: str):
         super().__init__(message)
         self.url: str = url
+
+
+class CassetteMiss(Exception):
+    def __init__(self, message, key: str):
+        super().__init__(message)
+        self.message = message
+        self.key = key
+
+
+class CircuitOpen(Exception):
+    def __init__(self, message, host: str, retry_in: float):
+        super().__init__(message)
+        self.message = message
+        self.host = host
+        self.retry_in = retry_in
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message, what: str):
+        super().__init__(message)
+        self.message = message
+        self.what = what
@@ -0,0 +1,50 @@
+"""
+Skill, catacombs and class levels from experience.
+
+The cumulative XP tables are built once at import and looked up with bisect instead of rebuilding and scanning a dict
+on every call. The arithmetic is done in the same order as the old SkyBlockPlayer.get_skill_lvl/get_cata_lvl so the
+results are bit-identical, benchmarks/bench_levels.py checks that.
+"""
+from bisect import bisect_right
+from itertools import accumulate
+
+# XP needed for each catacombs (and class) level on top of the previous one, index 0 is level 1
+CATA_XP_PER_LEVEL = (
+    50, 75, 110, 160, 230, 330, 470, 670, 950, 1340, 1890, 2665, 3760, 5260, 7380, 10300, 14400, 20000, 27600, 38000,
+    52500, 71500, 97000, 132000, 180000, 243000, 328000, 445000, 600000, 800000, 1065000, 1410000, 1900000, 2500000,
+    3300000, 4300000, 5600000, 7200000, 9200000, 12000000, 15000000, 19000000, 24000000, 30000000, 38000000, 48000000,
+    60000000, 75000000, 93000000, 116250000,
+)
+CATA_XP = (0, *accumulate(CATA_XP_PER_LEVEL))  # CATA_XP[level]: total XP to reach level
+CATA_MAX_LEVEL = len(CATA_XP_PER_LEVEL)
+CATA_OVERFLOW_XP = 200000000  # per level past 50
+
+# Total XP to reach each skill level, SKILL_XP[level]
+SKILL_XP = (
+    0, 50, 175, 375, 675, 1175, 1925, 2925, 4425, 6425, 9925, 14925, 22425, 32425, 47425, 67425, 97425, 147425, 222425,
+    322425, 522425, 822425, 1222425, 1722425, 2322425, 3022425, 3822425, 4722425, 5722425, 6822425, 8022425, 9322425,
+    10722425, 12222425, 13822425, 15522425, 17322425, 19222425, 21222425, 23322425, 25522425, 27822425, 30222425,
+    32722425, 35322425, 38072425, 40972425, 44072425, 47472425, 51172425, 55172425, 59472425, 64072425, 68972425,
+    74172425, 79672425, 85472425, 91572425, 97972425, 104672425, 111672425,
+)
+SKILL_XP_PER_LEVEL = (0, *(high - low for low, high in zip(SKILL_XP, SKILL_XP[1:])))
+
+
+def cata_level(exp, overflow: bool = False):
+    """Catacombs or class level, past 50 every 200m XP is another level when overflow is set"""
+    if exp >= CATA_XP[-1]:
+        return CATA_MAX_LEVEL + (exp - CATA_XP[-1]) / CATA_OVERFLOW_XP if overflow else CATA_MAX_LEVEL
+    level = bisect_right(CATA_XP, exp) or 1  # negative XP counts as part of level 1 like it always did
+    if level > CATA_MAX_LEVEL:  # nan
+        return 0
+    return level + (exp - CATA_XP[level - 1]) / CATA_XP_PER_LEVEL[level - 1] - 1
+
+
+def skill_level(exp, max_level: int = 60):
+    """Skill level capped at max_level"""
+    if exp >= SKILL_XP[max_level]:
+        return max_level
+    level = bisect_right(SKILL_XP, exp) or 1
+    if level > max_level:  # nan
+        return 0
+    return (level - 1) + (exp - SKILL_XP[level - 1]) / SKILL_XP_PER_LEVEL[level]
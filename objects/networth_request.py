@@ -0,0 +1,72 @@
+"""
+Builds the request bodies for the networth service.
+
+A member of an endgame profile is several hundred KB of JSON. It's sent whole, which fields the networth calculation
+reads is up to the service and changes with it. With NETWORTH_GZIP=1 it's gzipped, item data compresses well, until
+the service answers a gzipped body with anything but a 200, it gets plain JSON from then on.
+"""
+import asyncio
+import gzip
+import os
+
+from objects import codec
+
+# Off unless set to 1, nothing tells us the service accepts Content-Encoding: gzip
+NETWORTH_GZIP = os.getenv("NETWORTH_GZIP") == "1"
+COMPRESS_MIN_SIZE = 1024  # smaller bodies aren't worth the CPU
+THREAD_MIN_SIZE = 256 * 1024  # compress bigger bodies off the event loop
+
+
+class NetworthRequests:
+    def __init__(self, compress: bool = NETWORTH_GZIP, level: int = 6):
+        self.compress = compress
+        self.level = level
+        self.stats = {"requests": 0, "bytes_json": 0, "bytes_sent": 0, "compressed": 0}
+
+    def __repr__(self):
+        return f"<NetworthRequests compress: {self.compress} sent: {self.stats['bytes_sent']} bytes>"
+
+    def payload(self, uuid: str, profile: dict) -> dict:
+        return {
+            "profileData": profile["members"][uuid],
+            "bankBalance": (profile.get("banking") or {}).get("balance", 0),
+            "options": {
+                "onlyNetworth": True,
+            },
+        }
+
+    def _gzip(self, body: bytes) -> bytes:
+        return gzip.compress(body, self.level, mtime=0)  # no timestamp, the same profile always gives the same body
+
+    async def build(self, uuid: str, profile: dict) -> tuple:
+        """The body and headers to send"""
+        body = codec.dumps(self.payload(uuid, profile))
+        headers = {"Content-Type": codec.CONTENT_TYPE}
+        self.stats["requests"] += 1
+        self.stats["bytes_json"] += len(body)
+        if self.compress and len(body) >= COMPRESS_MIN_SIZE:
+            if len(body) >= THREAD_MIN_SIZE:
+                body = await asyncio.to_thread(self._gzip, body)
+            else:
+                body = self._gzip(body)
+            headers["Content-Encoding"] = "gzip"
+            self.stats["compressed"] += 1
+        self.stats["bytes_sent"] += len(body)
+        return body, headers
+
+    def rejected(self, status: int, headers: dict) -> bool:
+        """
+        True when a compressed body got anything but a 200, compression is turned off and the request should be sent
+        again as plain JSON. A service that fails to read gzip doesn't necessarily answer 415, a 400 or 500 is as
+        likely, and sending the same gzipped body again would fail the same way.
+        """
+        if status == 200 or headers.get("Content-Encoding") != "gzip":
+            return False
+        self.compress = False
+        return True
+
+    def saved(self) -> float:
+        """Fraction of the JSON bytes that compression saved"""
+        if not self.stats["bytes_json"]:
+            return 0.0
+        return 1 - self.stats["bytes_sent"] / self.stats["bytes_json"]
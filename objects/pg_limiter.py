@@ -0,0 +1,206 @@
+"""
+Rate-limit buckets shared between processes through Postgres.
+
+Every bucket is a row in ratelimit_buckets holding its tokens and when they were last refilled. Taking a token is one
+UPDATE that refills the row on the database clock and takes a token if there is one, the row lock serializes processes
+asking at the same time. Each process still queues its own requests in a local TokenBucket, so priorities work as
+before and only the request at the front of the local queue asks the database.
+
+python -m objects.pg_limiter [processes] [seconds] checks it against the database in the DB_* environment variables.
+"""
+import asyncio
+import logging
+import sys
+import time
+
+import asyncpg
+
+from objects.cache import DEFAULT_PRIORITY, DEFAULT_TIMEOUT, TokenBucket
+from objects.errors import *
+from objects.utils import Time
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS ratelimit_buckets (
+    name TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+)
+"""
+
+# Also adds the refunds ($4) that weren't written yet
+TAKE = """
+WITH bucket AS (
+    SELECT LEAST($3::float8,
+        tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated)::float8 * $2::float8 + $4::float8) AS tokens
+    FROM ratelimit_buckets WHERE name = $1 FOR UPDATE
+)
+UPDATE ratelimit_buckets SET tokens = bucket.tokens - (bucket.tokens >= 1)::int, updated = clock_timestamp()
+FROM bucket WHERE name = $1
+RETURNING bucket.tokens >= 1 AS granted, bucket.tokens
+"""
+
+# Lowers the tokens to what a server reported is left, never raises them, other processes may have spent the rest
+LOWER = """
+UPDATE ratelimit_buckets SET tokens = LEAST($4::float8,
+    LEAST($3::float8, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated)::float8 * $2::float8)),
+    updated = clock_timestamp()
+WHERE name = $1
+"""
+
+REFUND = """
+UPDATE ratelimit_buckets SET tokens = LEAST($3::float8,
+    tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated)::float8 * $2::float8 + $4::float8),
+    updated = clock_timestamp()
+WHERE name = $1
+"""
+REFUND_DELAY = 1.0  # seconds refunds are collected for before they're written in one UPDATE
+
+
+class PostgresBucket(TokenBucket):
+    """
+    TokenBucket whose tokens are shared with every process using the same row.
+    The local bucket keeps the queue and priorities of this process, after getting a local token a request waits for
+    a token from the row. Server syncs and refunds are applied to the row in the background, refunds are collected
+    for REFUND_DELAY seconds and written together, or with the next take if that comes first.
+    """
+
+    def __init__(self, limiter: "PostgresLimiter", name: str, max_per_minute: int, burst: int = None):
+        super().__init__(max_per_minute, burst)
+        self.limiter = limiter
+        self.name = name
+        self._lock = asyncio.Lock()  # one request of this process asks the database at a time, in local queue order
+        self._refunds = 0.0  # refunded tokens the row doesn't have yet
+        self._refund_timer = None
+        self.stats = {"granted": 0, "denied": 0, "refund_writes": 0}
+
+    def __repr__(self):
+        return f"<PostgresBucket {self.name} max: {self.max} tokens: {round(self.tokens, 2)} in_queue: {self.in_queue}>"
+
+    async def _take(self) -> tuple:
+        await self.limiter.ensure(self)
+        refunds, self._refunds = self._refunds, 0.0
+        try:
+            row = await self.limiter.pool.fetchrow(TAKE, self.name, self.rate, float(self.capacity), refunds)
+        except BaseException:
+            self._refunds += refunds
+            raise
+        return row["granted"], row["tokens"]
+
+    async def acquire(self, max_wait: float = DEFAULT_TIMEOUT, priority: str = DEFAULT_PRIORITY):
+        started = time.monotonic()
+        await super().acquire(max_wait, priority)
+        try:
+            async with self._lock:
+                while True:
+                    granted, tokens = await self._take()
+                    if granted:
+                        self.stats["granted"] += 1
+                        return time.monotonic() - started
+                    self.stats["denied"] += 1
+                    wait = (1 - tokens) / self.rate
+                    if time.monotonic() - started + wait >= max_wait:
+                        raise RatelimitReached(
+                            f"Ratelimit reached! Shared with other processes, try again in {round(wait, 1)} seconds.",
+                            reset_time=Time().time + wait,
+                        )
+                    await asyncio.sleep(wait)
+        except BaseException:
+            super().refund()  # the local token, the shared row never gave one
+            raise
+
+    def sync(self, remaining: int, reset: float, seq: int) -> float:
+        drift = super().sync(remaining, reset, seq)
+        target = (remaining - self.in_flight) - self.rate * max(0.0, reset)
+        self.limiter.background(LOWER, self.name, self.rate, float(self.capacity), target)
+        return drift
+
+    def refund(self, count: int = 1):
+        super().refund(count)
+        self._refunds += count
+        if self._refund_timer is None:
+            self._refund_timer = asyncio.get_running_loop().call_later(REFUND_DELAY, self._write_refunds)
+
+    def _write_refunds(self):
+        self._refund_timer = None
+        refunds, self._refunds = self._refunds, 0.0
+        if refunds:
+            self.stats["refund_writes"] += 1
+            self.limiter.background(REFUND, self.name, self.rate, float(self.capacity), refunds)
+
+
+class PostgresLimiter:
+    """
+    Hands out PostgresBuckets, pass it to RateLimitSession as limiter to share the rate-limits of every process
+    connected to the same database. Uses the existing asyncpg pool.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool, logger: logging.Logger = None):
+        self.pool = pool
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self._created = set()
+        self._tasks = set()
+
+    def __repr__(self):
+        return f"<PostgresLimiter buckets: {len(self._created)}>"
+
+    def bucket(self, name: str, max_per_minute: int, burst: int = None) -> PostgresBucket:
+        return PostgresBucket(self, name, max_per_minute, burst)
+
+    async def ensure(self, bucket: PostgresBucket):
+        if bucket.name in self._created:
+            return
+        if not self._created:
+            await self.pool.execute(CREATE_TABLE)
+        await self.pool.execute(
+            "INSERT INTO ratelimit_buckets (name, tokens) VALUES ($1, $2) ON CONFLICT (name) DO NOTHING",
+            bucket.name, float(bucket.capacity)
+        )
+        self._created.add(bucket.name)
+
+    def background(self, query: str, name: str, *args):
+        if name not in self._created:
+            return  # nothing was taken from a row that doesn't exist yet
+
+        async def run():
+            try:
+                await self.pool.execute(query, name, *args)
+            except (asyncpg.PostgresError, OSError) as e:
+                self.logger.error(f"Could not update the shared rate-limit {name} {e}")
+
+        task = asyncio.ensure_future(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+async def _check(processes: int = 3, seconds: float = 30, max_per_minute: int = 120):
+    """Processes with their own pool hammering one bucket, the combined rate should stay at max_per_minute"""
+    from utils.database import Database
+
+    name = f"check:{time.time_ns()}"
+    pools = [await Database.get_pool() for _ in range(processes)]
+    buckets = [PostgresLimiter(pool).bucket(name, max_per_minute, 5) for pool in pools]
+    granted = [0] * processes
+
+    async def worker(index: int, bucket: PostgresBucket):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            try:
+                await bucket.acquire(max_wait=deadline - time.monotonic())
+            except RatelimitReached:
+                break
+            granted[index] += 1
+            bucket.release()
+
+    await asyncio.gather(*(worker(index, bucket) for index, bucket in enumerate(buckets) for _ in range(5)))
+    allowed = 5 + max_per_minute / 60 * seconds
+    print(f"{processes} processes granted {sum(granted)} {granted} in {seconds}s, the limit allows {round(allowed)}")
+    await pools[0].execute("DELETE FROM ratelimit_buckets WHERE name = $1", name)
+    for pool in pools:
+        await pool.close()
+    return sum(granted) <= allowed + 1
+
+
+if __name__ == "__main__":
+    args = [float(arg) for arg in sys.argv[1:3]]
+    ok = asyncio.run(_check(int(args[0]) if args else 3, *args[1:]))
+    sys.exit(0 if ok else 1)
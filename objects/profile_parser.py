@@ -0,0 +1,123 @@
+"""
+Field-selective parsing of /skyblock/profiles responses.
+
+A response for an active player is several MB, almost all of it inventories, collections and co-op members we never
+read. parse_profiles keeps only what the weight, level, slayer, dungeon and leveling code needs for one player, plus
+that player's own member data of every profile for the networth request, taken from the same decode. Only the pruned
+part is worth caching, cached() drops the rest.
+With ijson installed, responses over STREAM_THRESHOLD bytes are streamed one profile at a time, so only one full
+profile is in memory at once. Streaming is several times slower than decoding with objects.codec, so smaller responses
+are decoded in one go and pruned right away.
+"""
+from objects import codec
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Member fields we keep, True keeps the whole value, a dict keeps only the listed keys ("*" matches any key)
+MEMBER_FIELDS = {
+    "last_save": True,
+    "leveling": {"experience": True},
+    "slayer_bosses": {"*": {"xp": True}},
+    "dungeons": {
+        "dungeon_types": {
+            "catacombs": {"experience": True, "tier_completions": True},
+            "master_catacombs": {"tier_completions": True},
+        },
+        "player_classes": {"*": {"experience": True}},
+    },
+}
+MEMBER_PREFIXES = ("experience_skill_",)
+PROFILE_FIELDS = ("profile_id", "cute_name", "game_mode", "selected")
+STREAM_THRESHOLD = 4 * 1024 * 1024
+
+
+def select(data: dict, fields: dict) -> dict:
+    selected = {}
+    for key, value in data.items():
+        selector = fields.get(key, fields.get("*"))
+        if selector is None:
+            continue
+        if selector is True or not isinstance(value, dict):
+            selected[key] = value
+        else:
+            selected[key] = select(value, selector)
+    return selected
+
+
+def select_member(member: dict) -> dict:
+    selected = select(member, MEMBER_FIELDS)
+    for key, value in member.items():
+        if key.startswith(MEMBER_PREFIXES):
+            selected[key] = value
+    return selected
+
+
+def select_profile(profile: dict, uuid: str) -> dict:
+    """The profile with only the fields we use and only uuid's member data, None if uuid isn't a member"""
+    members = profile.get("members") or {}
+    if uuid not in members:
+        return None
+    selected = {key: profile[key] for key in PROFILE_FIELDS if key in profile}
+    selected["banking"] = {"balance": (profile.get("banking") or {}).get("balance", 0)}
+    selected["members"] = {uuid: select_member(members[uuid])}
+    return selected
+
+
+def _streaming(raw: bytes) -> bool:
+    return ijson is not None and len(raw) > STREAM_THRESHOLD
+
+
+def _iter_profiles(raw: bytes):
+    if _streaming(raw):
+        yield from ijson.items(raw, "profiles.item", use_float=True)
+    else:
+        yield from codec.loads(raw).get("profiles") or []
+
+
+def _has_profiles(raw: bytes) -> bool:
+    """False when the response has "profiles": null (or none at all), without parsing the list itself"""
+    for prefix, event, _ in ijson.parse(raw):
+        if prefix == "profiles":
+            return event != "null"
+    return False
+
+
+def parse_profiles(raw: bytes, uuid: str) -> dict:
+    """
+    Parses a /skyblock/profiles response keeping only uuid's profiles and the fields listed above.
+    uuid's unfiltered member data is kept under "full_members" by profile_id, for the networth request. Httpr.get_profile
+    drops all but the selected profile's once the profile is selected.
+    """
+    if _streaming(raw):
+        success = next(ijson.items(raw, "success"), True)
+        profiles = ijson.items(raw, "profiles.item", use_float=True) if _has_profiles(raw) else None
+    else:
+        data = codec.loads(raw)
+        success, profiles = data.get("success", True), data.get("profiles")
+        del data  # the profiles list is all we hold on to while selecting
+    full_members = {}
+    if profiles is not None:
+        selected_profiles = []
+        for profile in profiles:
+            selected = select_profile(profile, uuid)
+            if selected:
+                selected_profiles.append(selected)
+                full_members[profile.get("profile_id")] = profile["members"][uuid]
+        profiles = selected_profiles
+    return {"success": success, "profiles": profiles, "full_members": full_members}
+
+
+def cached(parsed: dict) -> dict:
+    """What of parse_profiles' result is worth keeping in a response cache, the full members are too big"""
+    return {"success": parsed["success"], "profiles": parsed["profiles"]}
+
+
+def extract_member(raw: bytes, uuid: str, profile_id: str) -> dict:
+    """uuid's full, unfiltered member data in profile_id from a raw /skyblock/profiles response"""
+    for profile in _iter_profiles(raw):
+        if profile.get("profile_id") == profile_id:
+            return (profile.get("members") or {}).get(uuid)
+    return None
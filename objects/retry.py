@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import random
+import time
+from functools import wraps
+
+from aiohttp import ClientConnectionError, ClientPayloadError
+
+from objects import deadline
+from objects.errors import *
+
+# Statuses that are worth trying again, everything else is a real answer from the server
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524}
+# Exceptions that mean the request never completed (connection resets, timeouts, cut-off bodies)
+RETRY_EXCEPTIONS = (ClientConnectionError, ClientPayloadError, asyncio.TimeoutError)
+# Answers that won't change no matter how often we ask
+FATAL_EXCEPTIONS = (InvalidName, InvalidUUID, NotInAGuild, GuildNotFound, RatelimitReached, DeadlineExceeded)
+# Exceptions that mean we asked too often, not that the host is unhealthy
+RATELIMIT_EXCEPTIONS = (RatelimitReached, InternalRatelimitReached)
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, FATAL_EXCEPTIONS):
+        return False
+    if isinstance(error, UnexpectedResponse):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, RETRY_EXCEPTIONS)
+
+
+def is_ratelimit(error: Exception) -> bool:
+    if isinstance(error, UnexpectedResponse):
+        return error.status == 429
+    return isinstance(error, RATELIMIT_EXCEPTIONS)
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the requests made to a host.
+    Every first attempt deposits `ratio` tokens, every retry withdraws one. A host that keeps failing runs out of tokens
+    and its requests fail fast instead of retrying, so a retry storm can't use up the rate-limit budget other requests
+    need.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 10, max_tokens: float = 50):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(min_tokens)
+
+    def __repr__(self):
+        return f"<RetryBudget tokens: {round(self.tokens, 1)}>"
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a host that keeps failing.
+    closed: requests go through, `threshold` failures in a row open the breaker.
+    open: requests fail with CircuitOpen right away for `cooldown` seconds.
+    half_open: one probe request at a time is let through, a success closes the breaker, a failure opens it again.
+    Only failures is_retryable counts as one mean the host is unhealthy, any other answer counts as a success.
+    429s and RatelimitReached count as neither, they say we're asking too often, the token buckets handle that. A
+    breaker opened by them would hold back every request to the host after the ratelimit has already reset.
+    """
+
+    def __init__(self, host: str, threshold: int = 5, cooldown: float = 30, logger: logging.Logger = None):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.stats = {"opened": 0, "half_opened": 0, "closed": 0, "rejected": 0}
+
+    def __repr__(self):
+        return f"<CircuitBreaker {self.host} {self.state} failures: {self.failures}>"
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        self.logger.warning(f"Circuit breaker for {self.host}: {self.state} -> {state}")
+        self.state = state
+        self.stats[{"open": "opened", "half_open": "half_opened", "closed": "closed"}[state]] += 1
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def is_open(self) -> bool:
+        """True when a request would be rejected right now"""
+        if self.state == "open":
+            return self.retry_in() > 0
+        return self.state == "half_open" and self.probing
+
+    def before_call(self):
+        if self.state == "open":
+            if self.retry_in() > 0:
+                self.stats["rejected"] += 1
+                raise CircuitOpen(
+                    f"{self.host} is failing, not trying again for {round(self.retry_in(), 1)}s", self.host,
+                    self.retry_in()
+                )
+            self._set_state("half_open")
+        if self.state == "half_open":
+            if self.probing:
+                self.stats["rejected"] += 1
+                raise CircuitOpen(f"{self.host} is failing, waiting for a probe request", self.host, 0.0)
+            self.probing = True
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        self._set_state("closed")
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self._set_state("open")
+
+
+class RetryPolicy:
+    """
+    Retries a request with exponential backoff and full jitter, so failing coroutines don't retry in lockstep.
+    Gives up when the error isn't retryable, after `attempts` tries, when the host's retry budget is empty or when the
+    next attempt would start after `deadline` seconds, or after the deadline of the caller (see objects.deadline). The last
+    error is raised in all of those cases.
+    Every attempt goes through the host's CircuitBreaker, CircuitOpen is raised without trying while it's open.
+    """
+
+    def __init__(self, attempts: int = 6, base_delay: float = 1, max_delay: float = 30, deadline: float = 120,
+                 logger: logging.Logger = None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.budgets = {}
+        self.breakers = {}
+        self.stats = {"retries": 0, "gave_up": 0, "budget_exhausted": 0}
+
+    def budget(self, host: str) -> RetryBudget:
+        if host not in self.budgets:
+            self.budgets[host] = RetryBudget()
+        return self.budgets[host]
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(host, logger=self.logger)
+        return self.breakers[host]
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def run(self, host: str, call, name: str = "request"):
+        budget = self.budget(host)
+        breaker = self.breaker(host)
+        budget.deposit()
+        started = time.monotonic()
+        for attempt in range(self.attempts):
+            left = deadline.check(name)
+            limit = self.deadline if left is None else min(self.deadline, time.monotonic() - started + left)
+            breaker.before_call()
+            try:
+                result = await call()
+            except Exception as e:
+                ratelimited = is_ratelimit(e)
+                if not is_retryable(e):
+                    if ratelimited or isinstance(e, DeadlineExceeded):  # never left this process or only too often
+                        breaker.probing = False
+                    else:
+                        breaker.success()  # the host answered
+                    raise
+                if ratelimited:
+                    breaker.probing = False  # the host is up, let the next request probe
+                else:
+                    breaker.failure()
+                if attempt + 1 >= self.attempts:
+                    self.stats["gave_up"] += 1
+                    self.logger.error(f"Error getting {name} {e}, giving up after {attempt + 1} attempts")
+                    raise
+                delay = self.backoff(attempt)
+                if time.monotonic() - started + delay > limit:
+                    self.stats["gave_up"] += 1
+                    self.logger.error(f"Error getting {name} {e}, giving up, no time left to retry")
+                    raise
+                if not budget.withdraw():
+                    self.stats["budget_exhausted"] += 1
+                    self.logger.error(f"Error getting {name} {e}, retry budget for {host} exhausted")
+                    raise
+                self.stats["retries"] += 1
+                self.logger.error(
+                    f"Error getting {name} {e}, retrying {attempt + 1}/{self.attempts} in {round(delay, 1)}s"
+                )
+                await asyncio.sleep(delay)
+            except BaseException:
+                breaker.probing = False  # cancelled, let the next request probe
+                raise
+            else:
+                breaker.success()
+                return result
+
+
+def retry_request(host: str, name: str = None):
+    """Runs the decorated Httpr method through the instance's retry_policy."""
+
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            return await self.retry_policy.run(
+                host, lambda: method(self, *args, **kwargs), name or method.__name__.removeprefix("get_")
+            )
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,98 @@
+"""
+The numbers a guild refresh keeps of a player.
+
+A SkyBlockPlayer holds the whole parsed /skyblock/profiles response, every profile and the full member data for the
+networth request, while Tasks.get_player only needs a few dozen numbers out of the selected profile to build the players
+and player_metrics rows. PlayerSnapshot is those numbers, taken once the profile is selected and the lily weight known,
+so the player and its response can be dropped before the name, scammer and database round trips.
+"""
+from objects import levels
+from objects.api_objects import SKILL_MAX_LEVEL, SkyBlockPlayer
+
+SLAYERS = ("zombie", "spider", "wolf", "enderman", "blaze")
+CLASSES = ("healer", "mage", "berserk", "archer", "tank")
+SKILLS = ("taming", "mining", "farming", "combat", "foraging", "fishing", "enchanting", "alchemy", "carpentry")
+
+
+class PlayerSnapshot:
+    """Read-only, XP is kept in tuples ordered like SLAYERS, CLASSES and SKILLS, levels are computed from it"""
+
+    __slots__ = (
+        "uuid", "senither_weight", "lily_weight", "average_skill", "sb_experience", "catacombs_xp", "total_slayer",
+        "slayer_xp", "class_xp", "skill_xp",
+    )
+
+    def __init__(self, uuid: str, senither_weight: float, lily_weight: float, average_skill: float,
+                 sb_experience: int, catacombs_xp: float, total_slayer: float, slayer_xp: tuple, class_xp: tuple,
+                 skill_xp: tuple):
+        for name, value in (
+                ("uuid", uuid), ("senither_weight", senither_weight), ("lily_weight", lily_weight),
+                ("average_skill", average_skill), ("sb_experience", sb_experience), ("catacombs_xp", catacombs_xp),
+                ("total_slayer", total_slayer), ("slayer_xp", tuple(slayer_xp)), ("class_xp", tuple(class_xp)),
+                ("skill_xp", tuple(skill_xp)),
+        ):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __repr__(self):
+        return f"<PlayerSnapshot {self.uuid} senither_weight: {round(self.senither_weight, 2)}>"
+
+    @classmethod
+    def of(cls, player: SkyBlockPlayer, lily_weight: float) -> "PlayerSnapshot":
+        """The snapshot of player's selected profile, lily_weight is the total of player.lily_weight()"""
+        profile = player.profile if player.profile else {}
+        slayer_bosses = profile.get("slayer_bosses") or {}
+        player_classes = (profile.get("dungeons") or {}).get("player_classes") or {}
+        return cls(
+            uuid=player.uuid,
+            senither_weight=player.senither_weight(),
+            lily_weight=lily_weight,
+            average_skill=player.average_skill,
+            sb_experience=player.sb_experience,
+            catacombs_xp=player.catacombs_xp,
+            total_slayer=player.slayer_xp,
+            slayer_xp=(slayer_bosses.get(slayer, {}).get("xp", 0) for slayer in SLAYERS),
+            class_xp=(player_classes.get(cls_name, {}).get("experience", 0) for cls_name in CLASSES),
+            skill_xp=(profile.get(f"experience_skill_{skill}", 0) for skill in SKILLS),
+        )
+
+    @property
+    def catacombs(self) -> float:
+        return levels.cata_level(self.catacombs_xp, overflow=True)
+
+    def stats(self) -> dict:
+        """The profile columns of the players row"""
+        return {
+            "senither_weight": self.senither_weight,
+            "lily_weight": self.lily_weight,
+            "average_skill": self.average_skill,
+            "catacombs": self.catacombs,
+            "catacomb_xp": self.catacombs_xp,
+            "total_slayer": self.total_slayer,
+            "sb_experience": self.sb_experience,
+        }
+
+    def metrics(self) -> dict:
+        """The profile columns of the player_metrics row"""
+        metrics = {
+            "senither_weight": self.senither_weight,
+            "lily_weight": self.lily_weight,
+            "sb_experience": self.sb_experience,
+        }
+        for slayer, xp in zip(SLAYERS, self.slayer_xp):
+            metrics[f"{slayer}_xp"] = xp
+        metrics["catacombs_xp"] = self.catacombs_xp
+        metrics["catacombs"] = self.catacombs
+        for cls_name, xp in zip(CLASSES, self.class_xp):
+            metrics[cls_name] = levels.cata_level(xp, overflow=True)
+            metrics[f"{cls_name}_xp"] = xp
+        metrics["average_skill"] = self.average_skill
+        for skill, xp in zip(SKILLS, self.skill_xp):
+            metrics[skill] = levels.skill_level(xp, SKILL_MAX_LEVEL[skill])
+            metrics[f"{skill}_xp"] = xp
+        return metrics
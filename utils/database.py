@@ -9,6 +9,8 @@ from typing import TYPE_CHECKING, List
 import asyncpg
 from dotenv import load_dotenv
 
+from objects import deadline
+
 if TYPE_CHECKING:
     from main import Client
 
@@ -50,8 +52,13 @@ CREATE TABLE players (
     scam_reason TEXT,
     lily_weight REAL,
     networth BIGINT,
-    sb_experience BIGINT
+    sb_experience BIGINT,
+    name_checked TIMESTAMP,
+    networth_captured TIMESTAMP
 )
+players.name_checked is when the name was last confirmed by Mojang (ALTER TABLE players ADD COLUMN name_checked TIMESTAMP)
+players.networth_captured is when the networth API computed players.networth, capture_date moves on every refresh even
+when the networth is reused (ALTER TABLE players ADD COLUMN networth_captured TIMESTAMP)
 
 CREATE TABLE player_metrics (
     uuid TEXT,
@@ -116,6 +123,23 @@ CREATE TABLE history (
     guild_id TEXT,
     guild_name TEXT
 )
+
+CREATE TABLE ratelimit_buckets (
+    name TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+)
+ratelimit_buckets is created by objects.pg_limiter when RATELIMIT_BACKEND=postgres
+
+CREATE TABLE weight_components (
+    uuid TEXT,
+    profile_id TEXT,
+    components TEXT,
+    updated TIMESTAMP,
+    PRIMARY KEY (uuid, profile_id)
+)
+weight_components is created by utils.weights.WeightCache when WEIGHT_CACHE_BACKEND=postgres, components is the JSON
+of the profile's last senither components and lily weight with the XP they were computed from
 """
 
     pool: asyncpg.pool.Pool = None
@@ -150,6 +174,11 @@ CREATE TABLE history (
         self.client.logger.info('Database connection closed.')
         return self
 
+    @staticmethod
+    def timeout(what: str) -> float:
+        """Query timeout for the deadline of the caller (see objects.deadline), None keeps the pool's command_timeout"""
+        return deadline.check(what)
+
     def format_json(self, record: asyncpg.Record) -> dict:
         if record is None:
             return None
@@ -157,13 +186,15 @@ CREATE TABLE history (
 
     async def insert_new_guild(
             self, guild_id: str, guild_name: str, players: List[str], senither_weight: float, skills: float,
-            catacombs: float, slayer: float, scammers: int, lily_weight: float, networth: int, sb_experience: int
+            catacombs: float, slayer: float, scammers: int, lily_weight: float, networth: int, sb_experience: int,
+            conn=None
     ):
-        await self.pool.execute(
+        await (conn or self.pool).execute(
             """
 INSERT INTO guilds (guild_id, guild_name, capture_date, players, senither_weight, skills, catacombs, slayer, scammers, lily_weight, networth, sb_experience)
 VALUES ($1, $2, NOW(), $3, $4, $5, $6, $7, $8, $9, $10, $11)        
-        """, guild_id, guild_name, players, senither_weight, skills, catacombs, slayer, scammers, lily_weight, networth, sb_experience
+        """, guild_id, guild_name, players, senither_weight, skills, catacombs, slayer, scammers, lily_weight, networth, sb_experience,
+            timeout=self.timeout("inserting the guild")
         )
 
     async def insert_new_player(self, **kwargs):
@@ -172,14 +203,14 @@ INSERT INTO players ({", ".join(kwargs.keys())}, capture_date)
 VALUES ({", ".join(["$" + str(i + 1) for i in range(len(kwargs))])}, NOW()) ON CONFLICT (uuid) 
 DO UPDATE SET {", ".join([f"{key}=${i + 1}" for i, key in enumerate(kwargs.keys())])}, capture_date=NOW();
         """
-        await self.pool.execute(querry, *list(kwargs.values()))
+        await self.pool.execute(querry, *list(kwargs.values()), timeout=self.timeout("inserting the player"))
 
     async def insert_new_player_metric(self, **kwargs):
         querry = f"""
 INSERT INTO player_metrics ({", ".join(kwargs.keys())}, capture_date)
 VALUES ({", ".join(["$" + str(i + 1) for i in range(len(kwargs))])}, NOW())
             """
-        await self.pool.execute(querry, *list(kwargs.values()))
+        await self.pool.execute(querry, *list(kwargs.values()), timeout=self.timeout("inserting player metrics"))
 
     async def get_guild_name(self, guild_id, conn=None):
         query_str = """
@@ -199,30 +230,83 @@ FROM guilds
     WHERE guild_id = $1 
     ORDER BY guild_id, capture_date DESC;
         """
+        timeout = self.timeout("getting the guild members")
         if conn:
-            r = await conn.fetchrow(query_str, guild_id)
+            r = await conn.fetchrow(query_str, guild_id, timeout=timeout)
         else:
-            r = await self.pool.fetchrow(query_str, guild_id)
+            r = await self.pool.fetchrow(query_str, guild_id, timeout=timeout)
         return r["players"] if r else []
 
     async def insert_history(self, history_type: str, uuid: str, name: str, guild_id: str, guild_name: str,
-                             capture_date: datetime.datetime = None):
+                             capture_date: datetime.datetime = None, conn=None):
         args = [history_type, uuid, name, guild_id, guild_name]
         if capture_date:
             args.append(capture_date)
 
-        await self.pool.execute(
+        await (conn or self.pool).execute(
             f"""
 INSERT INTO history (type, uuid, name, capture_date, guild_id, guild_name)
 VALUES ($1, $2, $3, {'$6' if capture_date else 'NOW()'}, $4, $5)        
-        """, *args
+        """, *args, timeout=self.timeout("inserting history")
         )
 
-    async def get_names(self, uuids: List):
-        r = await self.pool.fetch("""
-SELECT uuid, name FROM players WHERE uuid = ANY($1)""", uuids)
+    async def get_names(self, uuids: List, conn=None):
+        r = await (conn or self.pool).fetch("""
+SELECT uuid, name FROM players WHERE uuid = ANY($1)""", uuids, timeout=self.timeout("getting names"))
         return {row['uuid']: row['name'] for row in r}
 
+    async def get_checked_names(self, uuids: List) -> dict:
+        """
+        {uuid: (name, checked)} with the name we have for every uuid, checked is players.name_checked. Without one it's
+        the newest name seen in players or history with checked None, history only records when a name was seen.
+        """
+        r = await self.pool.fetch("""
+SELECT DISTINCT ON (uuid) uuid, name, checked FROM (
+    SELECT uuid, name, name_checked AS checked, capture_date AS seen FROM players WHERE uuid = ANY($1)
+    UNION ALL
+    SELECT uuid, name, NULL::timestamp AS checked, capture_date AS seen FROM history
+        WHERE uuid = ANY($1) AND uuid != name
+) AS names
+ORDER BY uuid, checked DESC NULLS LAST, seen DESC NULLS LAST;""", uuids, timeout=self.timeout("getting names"))
+        return {row['uuid']: (row['name'], row['checked']) for row in r}
+
+    async def get_unchanged_networth(self, uuid: str, last_save: int, max_age: datetime.timedelta):
+        """
+        The stored networth and networth_captured of uuid if the networth was captured after last_save (ms) and within
+        max_age, else None
+        """
+        return await self.pool.fetchrow("""
+SELECT networth, networth_captured FROM players WHERE uuid = $1 AND networth IS NOT NULL
+    AND networth_captured >= to_timestamp($2 / 1000.0) AT TIME ZONE 'UTC'
+    AND networth_captured >= (NOW() - $3::interval) AT TIME ZONE 'UTC';""", uuid, last_save, max_age,
+                                        timeout=self.timeout("getting the networth"))
+
+    async def get_last_networth(self, uuid: str):
+        return await self.pool.fetchrow("""
+SELECT networth, networth_captured FROM players WHERE uuid = $1 AND networth IS NOT NULL;""", uuid,
+                                        timeout=self.timeout("getting the networth"))
+
+    async def create_weight_components(self):
+        await self.pool.execute("""
+CREATE TABLE IF NOT EXISTS weight_components (
+    uuid TEXT,
+    profile_id TEXT,
+    components TEXT,
+    updated TIMESTAMP,
+    PRIMARY KEY (uuid, profile_id)
+);""")
+
+    async def get_weight_components(self, uuid: str) -> list:
+        return await self.pool.fetch("SELECT profile_id, components FROM weight_components WHERE uuid = $1", uuid,
+                                     timeout=self.timeout("getting weight components"))
+
+    async def set_weight_components(self, rows: list):
+        """rows are (uuid, profile_id, components as JSON)"""
+        await self.pool.executemany("""
+INSERT INTO weight_components (uuid, profile_id, components, updated) VALUES ($1, $2, $3, NOW())
+ON CONFLICT (uuid, profile_id) DO UPDATE SET components = $3, updated = NOW();""", rows,
+                                    timeout=self.timeout("storing weight components"))
+
     async def insert_discord(self, guildid, discord):
         r = await self.pool.execute("""
 INSERT INTO guild_information (guild_id, discord)      
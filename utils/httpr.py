@@ -1,19 +1,32 @@
 from __future__ import annotations
 
-import asyncio
 import os
 from typing import TYPE_CHECKING
 
-from aiohttp import ClientOSError, ClientPayloadError
-
+from objects import codec, profile_parser
 from objects.api_objects import SkyBlockPlayer
-from objects.cache import RateLimitSession, Ratelimit, ratelimit_apis
+from objects.cache import (
+    RateLimitSession, Ratelimit, RatelimitHandler, ResponseCache, coalesce_requests, ratelimit_apis,
+)
+from objects.cassette import Cassette
 from objects.errors import *
+from objects.networth_request import NetworthRequests
+from objects.pg_limiter import PostgresLimiter
+from objects.retry import RetryPolicy, retry_request
 
 if TYPE_CHECKING:
     from main import Client
 
 SBZ_KEY = os.getenv("SBZ_KEY")
+# "postgres" shares the rate-limits with every process using the same database, "memory" keeps them in this process
+RATELIMIT_BACKEND = os.getenv("RATELIMIT_BACKEND", "memory")
+# Records responses to / replays them from a cassette file, see objects.cassette
+CASSETTE = os.getenv("CASSETTE")
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "replay")
+CASSETTE_LATENCY = float(os.getenv("CASSETTE_LATENCY")) if os.getenv("CASSETTE_LATENCY") else None
+# Sends the requests for every host Httpr calls to this server instead, e.g. a local benchmarks.fake_api at
+# http://127.0.0.1:8080. The rate-limits still go by the real hosts.
+FAKE_API = os.getenv("FAKE_API")
 
 
 class Httpr:
@@ -31,10 +44,21 @@ class Httpr:
 
     def __init__(self, client: Client):
         self.client = client
+        self.retry_policy = RetryPolicy(logger=self.client.logger)
+        self.networth_requests = NetworthRequests()
 
     async def open(self):
-        Httpr.session = RateLimitSession(logger=self.client.logger)
-        self.client.logger.info("RateLimitSession has been initialized")
+        limiter = PostgresLimiter(self.client.db.pool, self.client.logger) if RATELIMIT_BACKEND == "postgres" else None
+        cassette = Cassette(CASSETTE, CASSETTE_MODE, CASSETTE_LATENCY, self.client.logger) if CASSETTE else None
+        upstreams = None
+        if FAKE_API:
+            upstreams = {host: FAKE_API for host in self.hosts()}
+            self.client.logger.warning(f"Sending all requests to the fake API at {FAKE_API}")
+        Httpr.session = RateLimitSession(
+            logger=self.client.logger, response_cache=ResponseCache(), limiter=limiter, cassette=cassette,
+            upstreams=upstreams,
+        )
+        self.client.logger.info(f"RateLimitSession has been initialized ({RATELIMIT_BACKEND} rate-limits)")
         return self
 
     async def close(self):
@@ -47,29 +71,56 @@ class Httpr:
     def get_ratelimit(host: str) -> Ratelimit:
         return Httpr.session.ratelimit_handler.get_ratelimit(host)
 
+    @staticmethod
+    def hosts() -> set:
+        """Every host Httpr makes requests to"""
+        return {host for hosts in Httpr.host_mapping.values() for host in hosts}
+
+    def stats(self) -> list:
+        """Lines of the response cache, connection and networth request counters since startup, for the logs"""
+        lines = []
+        cache = Httpr.session.response_cache
+        if cache is not None:
+            lines.append(f"response cache: {round(cache.hit_rate() * 100, 1)}% hits {cache.stats}")
+        profiles = Httpr.session.connection_profiles
+        for host, stats in profiles.stats.items():
+            lines.append(f"{host}: {round(profiles.reuse_rate(host) * 100, 1)}% of the connections reused {stats}")
+        networth = self.networth_requests
+        lines.append(f"networth requests: {round(networth.saved() * 100, 1)}% of the JSON bytes saved {networth.stats}")
+        return lines
+
+    @staticmethod
+    def ratelimit_handler() -> RatelimitHandler:
+        """The limiter of the session, for ratelimit_apis outside Httpr. None before open()"""
+        return Httpr.session.ratelimit_handler if Httpr.session else None
+
     """
     Mojang APIs
     """
 
     @ratelimit_apis("api.mojang.com", host_mapping=host_mapping)
+    @coalesce_requests
+    @retry_request("api.mojang.com", "uuid")
     async def get_uuid(self, name: str, db_check: bool = True) -> str:
         async with Httpr.session.get(f"https://api.mojang.com/users/profiles/minecraft/{name}") as r:
             if r.status == 200:
-                res = (await r.json())
+                res = (await r.json(loads=codec.loads))
                 return res["id"]
             elif r.status == 204:
                 raise InvalidName("No UUID found for name", r, name)
             elif r.status == 400:
-                rj = await r.json()
+                rj = await r.json(loads=codec.loads)
                 raise UnexpectedResponse(f"{rj['error']} | {rj['errorMessage']}", r)
             else:
                 raise UnexpectedResponse("Error while getting UUID", r)
 
     @ratelimit_apis("api.mojang.com", host_mapping=host_mapping)
+    @coalesce_requests
+    @retry_request("api.mojang.com", "name")
     async def _mojang_get_name(self, uuid: str) -> str:
         async with Httpr.session.get(f"https://api.mojang.com/user/profiles/{uuid}/names") as r:
             if r.status == 200:
-                res = (await r.json())[-1]['name']
+                res = (await r.json(loads=codec.loads))[-1]['name']
                 return res
             elif r.status == 204:
                 raise InvalidUUID("No name found for UUID", r, uuid)
@@ -78,10 +129,12 @@ class Httpr:
                     f"Error while getting name {r.status}", r)
 
     @ratelimit_apis("sessionserver.mojang.com", host_mapping=host_mapping)
+    @coalesce_requests
+    @retry_request("sessionserver.mojang.com", "name")
     async def _session_get_name(self, uuid: str, ) -> str:
         async with Httpr.session.get(f"https://sessionserver.mojang.com/session/minecraft/profile/{uuid}") as r:
             if r.status == 200:
-                res = (await r.json())['name']
+                res = (await r.json(loads=codec.loads))['name']
                 return res
             elif r.status == 204:
                 raise InvalidUUID("No name found for UUID", r, uuid)
@@ -92,8 +145,9 @@ class Httpr:
     @ratelimit_apis(_mojang_get_name, _session_get_name, host_mapping=host_mapping)
     async def get_name(self, uuid: str, db_check: bool = True,
                        return_uuid: bool = False) -> str:
-        if self.get_ratelimit("sessionserver.mojang.com").is_limited() and self.get_ratelimit(
-                "api.mojang.com").remaining() > 10:
+        if self.retry_policy.breaker("sessionserver.mojang.com").is_open() or (
+                self.get_ratelimit("sessionserver.mojang.com").is_limited() and self.get_ratelimit(
+                "api.mojang.com").remaining() > 10):
             name = await self._mojang_get_name(uuid)
         else:
             try:
@@ -109,30 +163,37 @@ class Httpr:
     """
 
     @ratelimit_apis("api.hypixel.net", host_mapping=host_mapping)
+    @coalesce_requests
+    @retry_request("api.hypixel.net")
     async def get_player_data(self, uuid: str, ) -> dict:
-        for i in range(50):
-            try:
-                async with self.session.get(f"https://api.hypixel.net/player?uuid={uuid}") as r:
-                    if r.status == 200:
-                        return await r.json()
-                    else:
-                        raise UnexpectedResponse("Error while getting UUID", r)
-            except (ClientOSError, ClientPayloadError, UnexpectedResponse) as e:
-                self.client.logger.error(f"Error getting player_data {e}, retrying {i + 1}/5")
-                await asyncio.sleep(5)
+        return await self.session.get_json(f"https://api.hypixel.net/player?uuid={uuid}")
 
     @ratelimit_apis("api.hypixel.net", host_mapping=host_mapping)
-    async def get_sb_player_data(self, uuid: str, ) -> dict:
-        for i in range(50):
-            try:
-                async with self.session.get(f"https://api.hypixel.net/skyblock/profiles?uuid={uuid}") as r:
-                    if r.status == 200:
-                        return await r.json()
-                    else:
-                        raise UnexpectedResponse(f"Error getting sb_player_data {r.status}", r)
-            except (ClientOSError, ClientPayloadError, UnexpectedResponse) as e:
-                self.client.logger.error(f"Error getting sb_player_data {e}, retrying {i + 1}/50")
-                await asyncio.sleep(5)
+    @coalesce_requests
+    @retry_request("api.hypixel.net")
+    async def get_sb_player_data(self, uuid: str, selective: bool = False) -> dict:
+        """
+        selective keeps only uuid's profiles and the fields the weight, level and leveling code reads, with uuid's full
+        member data under "full_members" for the networth request (see objects.profile_parser). Answers from the
+        response cache don't have the full members.
+        """
+        url = f"https://api.hypixel.net/skyblock/profiles?uuid={uuid}"
+        if selective:
+            return await self.session.get_json(
+                url, decode=lambda raw: profile_parser.parse_profiles(raw, uuid), cache_key=(url, "selective"),
+                cache_value=profile_parser.cached,
+            )
+        return await self.session.get_json(url)
+
+    @ratelimit_apis("api.hypixel.net", host_mapping=host_mapping)
+    @coalesce_requests
+    @retry_request("api.hypixel.net")
+    async def get_full_member(self, uuid: str, profile_id: str) -> dict:
+        """uuid's full member data in profile_id, for when get_sb_player_data was answered from the response cache"""
+        url = f"https://api.hypixel.net/skyblock/profiles?uuid={uuid}"
+        return await self.session.get_json(
+            url, decode=lambda raw: profile_parser.extract_member(raw, uuid, profile_id), use_cache=False,
+        )
 
     @ratelimit_apis(get_sb_player_data, host_mapping=host_mapping)
     async def get_profile(
@@ -140,16 +201,23 @@ class Httpr:
             profile_id: str = None,
             profile_name: str = None,
             select_profile_on: str = "last_save",
+            weight_cache=None,
     ) -> SkyBlockPlayer:
-        return SkyBlockPlayer(
-            uuid,
-            await self.get_sb_player_data(uuid),
-            profile_id,
-            profile_name,
-            select_profile_on,
-        )
+        data = await self.get_sb_player_data(uuid, selective=True)
+        player = SkyBlockPlayer(uuid, data, profile_id, profile_name, select_profile_on, weight_cache)
+        # only the selected profile's full member is sent to the networth API, don't hold the others with the player.
+        # data itself is left alone, coalesced callers share it
+        full_members = data.get("full_members")
+        if full_members:
+            selected = (player.selected_profile or {}).get("profile_id")
+            player.player_data = {
+                **data, "full_members": {selected: full_members[selected]} if selected in full_members else {},
+            }
+        return player
 
     @ratelimit_apis("api.hypixel.net", host_mapping=host_mapping)
+    @coalesce_requests
+    @retry_request("api.hypixel.net")
     async def get_guild_data(self, _id: str = None, uuid: str = None, name: str = None,
                              ) -> dict:
         if _id is not None:
@@ -160,22 +228,12 @@ class Httpr:
             param = f"?name={name}"
         else:
             raise Exception("No parameters given")
-        for i in range(50):
-            try:
-                async with self.session.get(f"https://api.hypixel.net/guild{param}") as r:
-                    if r.status == 200:
-                        rj = await r.json()
-                        if not rj["guild"] and uuid:
-                            raise NotInAGuild("Player is not in a guild", uuid)
-                        elif not rj["guild"] and name:
-                            raise GuildNotFound("Guild not found", name)
-                        return rj
-                    else:
-                        print(await r.json())
-                        raise UnexpectedResponse("Error while getting Guild data", r)
-            except (ClientOSError, ClientPayloadError, UnexpectedResponse) as e:
-                self.client.logger.error(f"Error getting networth {e}, retrying {i + 1}/50")
-                await asyncio.sleep(5)
+        rj = await self.session.get_json(f"https://api.hypixel.net/guild{param}")
+        if not rj["guild"] and uuid:
+            raise NotInAGuild("Player is not in a guild", uuid)
+        elif not rj["guild"] and name:
+            raise GuildNotFound("Guild not found", name)
+        return rj
 
     @ratelimit_apis(get_guild_data, host_mapping=host_mapping)
     async def get_guild_members(self, *args, **kwargs) -> list:
@@ -205,22 +263,18 @@ class Httpr:
         #         await asyncio.sleep(5)
 
     @ratelimit_apis("nwapi.guildleaderboard.com", host_mapping=host_mapping)
+    @retry_request("nwapi.guildleaderboard.com")
     async def get_networth(self, uuid: str, profile):
-        for i in range(50):
-            try:
-                async with self.session.get(
-                        f'https://nwapi.guildleaderboard.com/networth?uuid={uuid}', json={
-                            "profileData": profile["members"][uuid],
-                            "bankBalance": profile.get("banking", {}).get("balance", 0),
-                            "options": {
-                                "onlyNetworth": True,
-                            }
-                        },
-                ) as r:
-                    if r.status == 200:
-                        return await r.json()
-                    else:
-                        raise UnexpectedResponse("Error while getting networth", r)
-            except (ClientOSError, ClientPayloadError, UnexpectedResponse) as e:
-                self.client.logger.error(f"Error getting networth {e}, retrying {i + 1}/50")
-                await asyncio.sleep(5)
+        while True:
+            body, headers = await self.networth_requests.build(uuid, profile)
+            async with self.session.get(
+                    f'https://nwapi.guildleaderboard.com/networth?uuid={uuid}', data=body, headers=headers,
+            ) as r:
+                if r.status == 200:
+                    return await r.json(loads=codec.loads)
+                elif self.networth_requests.rejected(r.status, headers):
+                    self.client.logger.warning(
+                        f"Networth API answered a gzipped body with {r.status}, sending plain JSON"
+                    )
+                else:
+                    raise UnexpectedResponse(f"Error getting networth {r.status}", r)
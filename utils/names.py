@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import datetime
+from typing import TYPE_CHECKING, Dict, List, Union
+
+from objects.utils import Time
+
+if TYPE_CHECKING:
+    from main import Client
+
+
+class NameResolver:
+    """
+    Resolves uuids to names with as few Mojang requests as possible.
+    Names are looked up in a bounded in-memory LRU first, then in one query against the players/history tables for all
+    misses, and only names that are unknown or haven't been checked against Mojang within `ttl` are requested from
+    Mojang. When Mojang fails the last name we know is used, however old it is.
+    """
+
+    def __init__(self, client: Client, max_size: int = 20000, ttl: datetime.timedelta = datetime.timedelta(days=7),
+                 concurrency: int = 10):
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self._names = collections.OrderedDict()  # uuid: (name, checked)
+        self.stats = {"memory_hits": 0, "db_hits": 0, "mojang_lookups": 0, "stale": 0, "failures": 0}
+
+    async def open(self):
+        self.client.logger.info("NameResolver has been initialized")
+        return self
+
+    def _remember(self, uuid: str, name: str, checked: datetime.datetime):
+        self._names[uuid] = (name, checked)
+        self._names.move_to_end(uuid)
+        while len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+
+    def _is_fresh(self, checked: datetime.datetime) -> bool:
+        return checked is not None and Time.utcnow() - checked < self.ttl
+
+    def checked_at(self, uuid: str) -> Union[datetime.datetime, None]:
+        """When the name we have for uuid was last confirmed by Mojang"""
+        entry = self._names.get(uuid)
+        return entry[1] if entry else None
+
+    async def get_name(self, uuid: str) -> str:
+        names = await self.get_names([uuid])
+        if uuid not in names:
+            raise KeyError(f"Could not resolve the name of {uuid}")
+        return names[uuid]
+
+    async def get_names(self, uuids: List[str]) -> Dict[str, str]:
+        """Names for as many of the uuids as could be resolved"""
+        names, misses = {}, []
+        for uuid in dict.fromkeys(uuids):
+            entry = self._names.get(uuid)
+            if entry and self._is_fresh(entry[1]):
+                self._names.move_to_end(uuid)
+                names[uuid] = entry[0]
+                self.stats["memory_hits"] += 1
+            else:
+                misses.append(uuid)
+        if not misses:
+            return names
+
+        stale = {}
+        for uuid, (name, checked) in (await self.client.db.get_checked_names(misses)).items():
+            if self._is_fresh(checked):
+                self._remember(uuid, name, checked)
+                names[uuid] = name
+                self.stats["db_hits"] += 1
+            else:
+                stale[uuid] = name
+
+        # Mojang has no bulk uuid -> name endpoint, the rest goes out concurrently through the rate limiter
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def lookup(uuid: str):
+            async with semaphore:
+                try:
+                    name = await self.client.httpr.get_name(uuid)
+                except Exception as e:
+                    self.stats["failures"] += 1
+                    if uuid in stale:
+                        self.stats["stale"] += 1
+                        names[uuid] = stale[uuid]
+                    self.client.logger.error(f"Could not resolve the name of {uuid} {e}")
+                    return
+                self.stats["mojang_lookups"] += 1
+                self._remember(uuid, name, Time.utcnow())
+                names[uuid] = name
+
+        await asyncio.gather(*(lookup(uuid) for uuid in misses if uuid not in names))
+        return names
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import collections
+import datetime
+import os
+from typing import TYPE_CHECKING, Union
+
+from objects.utils import Time
+
+if TYPE_CHECKING:
+    from main import Client
+
+# Seconds a networth is reused for. Guilds are refreshed a day apart (GUILD_REFRESH_INTERVAL in utils.tasks), so this
+# has to be longer than a day for the next refresh to ever reuse one, two days fetches it at least every other refresh.
+NETWORTH_MAX_AGE = float(os.getenv("NETWORTH_MAX_AGE", 2 * 24 * 3600))
+
+
+class NetworthCache:
+    """
+    Skips the networth request for profiles that haven't changed.
+    Values are kept in memory by (uuid, profile_id, last_save). On a miss the networth stored in players is used when
+    none of the player's profiles were saved after it was captured, so the same profile was selected and nothing in it
+    changed. Both only within `max_age` seconds of when the networth API computed it, item prices move even when the
+    profile doesn't. Reusing a networth doesn't make it any newer, players.networth_captured keeps the original time.
+    """
+
+    def __init__(self, client: Client, max_size: int = 20000, max_age: float = NETWORTH_MAX_AGE):
+        self.client = client
+        self.max_size = max_size
+        self.max_age = datetime.timedelta(seconds=max_age)
+        self._values = collections.OrderedDict()  # key: (networth, captured)
+        self._latest = collections.OrderedDict()  # uuid: (networth, captured) we got last for any of its profiles
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+        self.degraded = 0  # last known values used because the networth API was down
+
+    def __repr__(self):
+        return (f"<NetworthCache size: {len(self._values)} hit_rate: {round(self.hit_rate(), 2)} {self.stats} "
+                f"degraded: {self.degraded}>")
+
+    async def open(self):
+        self.client.logger.info("NetworthCache has been initialized")
+        return self
+
+    @staticmethod
+    def key(uuid: str, profile: dict) -> tuple:
+        return uuid, profile.get("profile_id"), profile["members"][uuid].get("last_save")
+
+    def hit_rate(self) -> float:
+        lookups = sum(self.stats.values())
+        return (self.stats["memory_hits"] + self.stats["db_hits"]) / lookups if lookups else 0.0
+
+    async def get(self, uuid: str, profile: dict, profiles: list) -> Union[tuple, None]:
+        """
+        (networth, captured) of uuid's selected profile if it's known and still valid, profiles are all of uuid's
+        profiles
+        """
+        key = self.key(uuid, profile)
+        entry = self._values.get(key)
+        if entry and Time.utcnow() - entry[1] < self.max_age:
+            self._values.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return entry
+
+        last_save = max(p["members"][uuid].get("last_save") or 0 for p in profiles)
+        row = await self.client.db.get_unchanged_networth(uuid, last_save, self.max_age) if last_save else None
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["db_hits"] += 1
+        self.set(uuid, profile, row["networth"], row["networth_captured"])
+        return row["networth"], row["networth_captured"]
+
+    async def last_known(self, uuid: str) -> Union[tuple, None]:
+        """(networth, captured) we got last for uuid however old it is, for when the networth API is down"""
+        entry = self._latest.get(uuid)
+        if entry is None:
+            row = await self.client.db.get_last_networth(uuid)
+            entry = (row["networth"], row["networth_captured"]) if row else None
+        if entry is not None:
+            self.degraded += 1
+        return entry
+
+    def set(self, uuid: str, profile: dict, networth: int, captured: datetime.datetime = None) -> tuple:
+        """Remembers networth, captured by the networth API at captured (now when not given)"""
+        entry = (networth, captured or Time.utcnow())
+        self._latest[uuid] = entry
+        self._latest.move_to_end(uuid)
+        if len(self._latest) > self.max_size:
+            self._latest.popitem(last=False)
+        key = self.key(uuid, profile)
+        if key[2] is None:  # without a last_save we can't tell when it changes
+            return entry
+        self._values[key] = entry
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+        return entry
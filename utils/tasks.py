@@ -1,12 +1,28 @@
 import asyncio
+import collections
+import datetime
 from math import sin
 from typing import TYPE_CHECKING
 
+from objects.cache import ratelimit_apis, ratelimit_wait, request_priority
+from objects.deadline import deadline
+from objects.errors import CircuitOpen, DeadlineExceeded
+from objects.retry import is_retryable
+from objects.snapshot import PlayerSnapshot
+from objects.utils import Time
+from utils.httpr import Httpr
+
 if TYPE_CHECKING:
     from main import Client
     from objects.api_objects import SkyBlockPlayer
 
 
+GUILD_REFRESH_DEADLINE = 600  # seconds a guild refresh gets, rate-limit waits and DB writes included
+GUILD_REFRESH_INTERVAL = datetime.timedelta(days=1)  # how old a guild gets before update_guilds refreshes it again
+# seconds a player's name lookup may wait for Mojang's rate-limit before falling back to the name in the database
+NAME_RATELIMIT_WAIT = 10
+
+
 def weight_multiplier(members):
     frequency = sin(members / (125 / 0.927296)) + 0.2
     return members / 125 + (1 - members / 125) * frequency
@@ -15,6 +31,8 @@ def weight_multiplier(members):
 class Tasks:
     def __init__(self, client: "Client"):
         self.client: Client = client
+        self.refresh_stats = {"completed": 0, "deadline_exceeded": 0}
+        self.timed_out = collections.deque(maxlen=100)  # (guild, cause, when) of refreshes that ran out of time
 
     async def open(self):
         # self.client.loop.create_task(self.delete_old_records())
@@ -26,7 +44,8 @@ class Tasks:
         #         with open("history.json", "w") as f:
         #             json.dump([{key: str(value) if key == "capture_date" else value for key, value in dict(i).items()} for i in r], f, indent=4)
 
-        self.client.loop.create_task(self.add_new_guild(guild_name="Menhir"))  # Drachen Jaeger 3
+        with request_priority("interactive"):  # onboarding skips ahead of the refresh and backfill work
+            self.client.loop.create_task(self.add_new_guild(guild_name="Menhir"))  # Drachen Jaeger 3
 
         self.client.logger.info("Tasks started")
         return self
@@ -37,34 +56,61 @@ class Tasks:
 SELECT * FROM history WHERE uuid = name ORDER by capture_date DESC;
             """)
             uuids = [i["uuid"] for i in broken_rows]
-            uuid_name_dict = await self.client.db.get_names(uuids)
-            for row in broken_rows:
-                try:
-                    name = uuid_name_dict[row["uuid"]]
-                except KeyError:
-                    name = await self.client.httpr.get_name(row["uuid"])
+            with request_priority("backfill"):
+                uuid_name_dict = await self.client.names.get_names(uuids)
+            for uuid, name in uuid_name_dict.items():
                 await self.client.db.pool.execute("""
     UPDATE history SET name = $1 WHERE uuid = $2;
-                """, name, row["uuid"])
+                """, name, uuid)
             await asyncio.sleep(3600)
 
+    async def fetch_networth(self, player: "SkyBlockPlayer", selected_profile: dict) -> tuple:
+        """(networth, captured) of selected_profile from the networth API"""
+        breaker = self.client.httpr.retry_policy.breaker("nwapi.guildleaderboard.com")
+        if breaker.is_open():  # don't bother getting the full member
+            raise CircuitOpen("nwapi.guildleaderboard.com is failing", breaker.host, breaker.retry_in())
+        # only the fields we use were parsed, networth needs all of the member
+        member = (player.player_data.get("full_members") or {}).get(selected_profile["profile_id"])
+        if member is None:  # the profiles came from the response cache, which doesn't keep full members
+            member = await self.client.httpr.get_full_member(player.uuid, selected_profile["profile_id"])
+        full_profile = {**selected_profile, "members": {player.uuid: member}}
+        r = await self.client.httpr.get_networth(
+            uuid=player.uuid, profile=full_profile
+        )
+        return self.client.networth.set(player.uuid, selected_profile, r["networth"])
+
+    # Only the profile request is made for every player: names come from the NameResolver, filled for the whole guild
+    # up front, and networth is often reused (utils.networth), so those hosts are limited when they're actually hit
+    @ratelimit_apis(Httpr.get_profile, host_mapping=Httpr.host_mapping, limiter=Httpr.ratelimit_handler)
     async def get_player(self, guild_stats, uuid):
-        player: SkyBlockPlayer = await self.client.httpr.get_profile(uuid=uuid, select_profile_on="weight")
+        await self.client.weights.load(uuid)
+        player: SkyBlockPlayer = await self.client.httpr.get_profile(
+            uuid=uuid, select_profile_on="weight", weight_cache=self.client.weights
+        )
+        lily_weight = await player.lily_weight(self.client)
+        snapshot = PlayerSnapshot.of(player, lily_weight["total"])
 
-        if not player.profile:
-            networth = 0
-        else:
-            full_profile = [
-                profile for profile in player.player_data.get("profiles", []) if
-                profile["members"][uuid] == player.profile
-            ][0]
-            r = await self.client.httpr.get_networth(
-                uuid=uuid, profile=full_profile
-            )
-            networth = r["networth"]
+        networth, networth_captured = 0, None
+        if player.profile:
+            profiles = player.player_data.get("profiles", [])
+            known = await self.client.networth.get(uuid, player.selected_profile, profiles)
+            if known is None:
+                try:
+                    known = await self.fetch_networth(player, player.selected_profile)
+                except Exception as e:  # the networth API is down, the last value we have beats dropping the player
+                    if not (isinstance(e, CircuitOpen) or is_retryable(e)):
+                        raise
+                    known = await self.client.networth.last_known(uuid)
+                    if known is None:
+                        raise
+                    self.client.logger.warning(f"Using the last known networth of {uuid}: {e}")
+            networth, networth_captured = known
+            del profiles
+        del player  # the snapshot is all we need from here on, don't hold the response through the rest
 
         try:
-            name = await player.get_name(self.client)
+            with ratelimit_wait(NAME_RATELIMIT_WAIT):
+                name = await self.client.names.get_name(uuid)
         except:
             name = (await self.client.db.pool.fetchrow("""
 SELECT name FROM players WHERE uuid=$1 LIMIT 1;            
@@ -83,21 +129,18 @@ SELECT name FROM players WHERE uuid=$1 LIMIT 1;
         scam_reason = None
         if sbzscammer["success"]:
             scam_reason = sbzscammer["result"]["reason"]
-        lily_weight = await player.lily_weight(self.client)
 
         p_stats = {
-            "uuid": player.uuid,
+            "uuid": snapshot.uuid,
             "name": name,
-            "senither_weight": player.senither_weight(),
-            "lily_weight": lily_weight["total"],
-            "average_skill": player.average_skill,
-            "catacombs": player.catacombs_level_overflow,
-            'catacomb_xp': player.catacombs_xp,
-            "total_slayer": player.slayer_xp,
+            **snapshot.stats(),
             "scam_reason": scam_reason,
             "networth": networth,
-            "sb_experience": player.sb_experience,
         }
+        if self.client.names.checked_at(uuid):  # keep the stored date when the name came from the fallback
+            p_stats["name_checked"] = self.client.names.checked_at(uuid)
+        if networth_captured is not None:  # a reused networth keeps the date it was computed
+            p_stats["networth_captured"] = networth_captured
         await self.client.db.insert_new_player(**p_stats)
         guild_stats["senither_weight"] += p_stats["senither_weight"]
         guild_stats["lily_weight"] += p_stats["lily_weight"]
@@ -110,80 +153,74 @@ SELECT name FROM players WHERE uuid=$1 LIMIT 1;
         if p_stats["scam_reason"]:
             guild_stats["scammers"] += 1
 
-        p_profile = player.profile if player.profile else {}
-
-        dungeon_types = p_profile.get("dungeons", {}).get("player_classes", {})
-
         player_metrics = {
-            "uuid": player.uuid,
+            "uuid": snapshot.uuid,
             "name": name,
-
-            "senither_weight": player.senither_weight(),
-            "lily_weight": lily_weight["total"],
+            **snapshot.metrics(),
             "networth": networth,
-            "sb_experience": player.sb_experience,
-
-            "zombie_xp": p_profile.get("slayer_bosses", {}).get("zombie", {}).get("xp", 0),
-            "spider_xp": p_profile.get("slayer_bosses", {}).get("spider", {}).get("xp", 0),
-            "wolf_xp": p_profile.get("slayer_bosses", {}).get("wolf", {}).get("xp", 0),
-            "enderman_xp": p_profile.get("slayer_bosses", {}).get("enderman", {}).get("xp", 0),
-            "blaze_xp": p_profile.get("slayer_bosses", {}).get("blaze", {}).get("xp", 0),
-
-            "catacombs_xp": player.catacombs_xp,
-            "catacombs": player.catacombs_level_overflow,
-            "healer": player.get_cata_lvl(dungeon_types.get("healer", {}).get("experience", 0), True),
-            "healer_xp": dungeon_types.get("healer", {}).get("experience", 0),
-            "mage": player.get_cata_lvl(dungeon_types.get("mage", {}).get("experience", 0), True),
-            "mage_xp": dungeon_types.get("mage", {}).get("experience", 0),
-            "berserk": player.get_cata_lvl(dungeon_types.get("berserk", {}).get("experience", 0), True),
-            "berserk_xp": dungeon_types.get("berserk", {}).get("experience", 0),
-            "archer": player.get_cata_lvl(dungeon_types.get("archer", {}).get("experience", 0), True),
-            "archer_xp": dungeon_types.get("archer", {}).get("experience", 0),
-            "tank": player.get_cata_lvl(dungeon_types.get("tank", {}).get("experience", 0), True),
-            "tank_xp": dungeon_types.get("tank", {}).get("experience", 0),
-
-            "average_skill": player.average_skill,
-            "taming": player.get_skill_lvl("taming", p_profile.get("experience_skill_taming", 0)),
-            "taming_xp": p_profile.get("experience_skill_taming", 0),
-            "mining": player.get_skill_lvl("mining", p_profile.get("experience_skill_mining", 0)),
-            "mining_xp": p_profile.get("experience_skill_mining", 0),
-            "farming": player.get_skill_lvl("farming", p_profile.get("experience_skill_farming", 0)),
-            "farming_xp": p_profile.get("experience_skill_farming", 0),
-            "combat": player.get_skill_lvl("combat", p_profile.get("experience_skill_combat", 0)),
-            "combat_xp": p_profile.get("experience_skill_combat", 0),
-            "foraging": player.get_skill_lvl("foraging", p_profile.get("experience_skill_foraging", 0)),
-            "foraging_xp": p_profile.get("experience_skill_foraging", 0),
-            "fishing": player.get_skill_lvl("fishing", p_profile.get("experience_skill_fishing", 0)),
-            "fishing_xp": p_profile.get("experience_skill_fishing", 0),
-            "enchanting": player.get_skill_lvl("enchanting", p_profile.get("experience_skill_enchanting", 0)),
-            "enchanting_xp": p_profile.get("experience_skill_enchanting", 0),
-            "alchemy": player.get_skill_lvl("alchemy", p_profile.get("experience_skill_alchemy", 0)),
-            "alchemy_xp": p_profile.get("experience_skill_alchemy", 0),
-            "carpentry": player.get_skill_lvl("carpentry", p_profile.get("experience_skill_carpentry", 0)),
-            "carpentry_xp": p_profile.get("experience_skill_carpentry", 0),
         }
 
         await self.client.db.insert_new_player_metric(**player_metrics)
 
-    async def add_guild_history(self, old_players, new_players, guild_id, guild_name):
+    async def add_guild_history(self, old_players, new_players, guild_id, guild_name, conn=None):
         leave_uuids = [uuid for uuid in old_players if uuid not in new_players]
         join_uuids = [uuid for uuid in new_players if uuid not in old_players]
 
-        name_uuid_dict = await self.client.db.get_names(leave_uuids + join_uuids)
+        name_uuid_dict = await self.client.db.get_names(leave_uuids + join_uuids, conn)
 
         for leave_uuid in leave_uuids:
             name = name_uuid_dict.get(leave_uuid, leave_uuid)
-            await self.client.db.insert_history("0", leave_uuid, name, guild_id, guild_name)
+            await self.client.db.insert_history("0", leave_uuid, name, guild_id, guild_name, conn=conn)
 
         for join_uuid in join_uuids:
             name = name_uuid_dict.get(join_uuid, join_uuid)
-            await self.client.db.insert_history("1", join_uuid, name, guild_id, guild_name)
+            await self.client.db.insert_history("1", join_uuid, name, guild_id, guild_name, conn=conn)
+
+    async def add_new_guild(self, guild_name=None, guild_id=None, weight_req=None, time_limit=GUILD_REFRESH_DEADLINE):
+        """
+        Refreshes a guild and all its members within time_limit seconds. Every request and query made for it gets the
+        time that's left (see objects.deadline), when it runs out the refresh is cancelled. Members are written as
+        they're refreshed, so the ones done by then keep their new players and player_metrics rows. The guild and its
+        history are written in one transaction, all of it or none.
+        """
+        progress = {"stage": "getting the guild", "players": 0, "total": 0, "error": None}
+        timeout = asyncio.timeout(time_limit)
+        try:
+            with deadline(time_limit):
+                async with timeout:
+                    written = await self.refresh_guild(progress, guild_name, guild_id, weight_req)
+        except DeadlineExceeded as e:
+            self.deadline_exceeded(progress, guild_name or guild_id, time_limit, e.message)
+        except TimeoutError:
+            if not timeout.expired():  # a request or query that timed out on its own, not the refresh
+                raise
+            self.deadline_exceeded(
+                progress, guild_name or guild_id, time_limit,
+                f"last error: {progress['error']}" if progress["error"] else None,
+            )
+        else:
+            self.refresh_stats["completed"] += 1
+            if written:  # outside the deadline, update_positions isn't part of this guild's refresh
+                self.client.loop.create_task(self.update_positions())
+        finally:
+            self.client.logger.info(
+                f"After refreshing {guild_name or guild_id}:\n" + "\n".join(self.client.httpr.stats())
+            )
 
-    async def add_new_guild(self, guild_name=None, guild_id=None, weight_req=None):
+    def deadline_exceeded(self, progress: dict, guild: str, time_limit: float, detail: str = None):
+        cause = f"{progress['stage']}, {progress['players']}/{progress['total']} players done"
+        if detail:
+            cause += f", {detail}"
+        self.refresh_stats["deadline_exceeded"] += 1
+        self.timed_out.append((guild, cause, Time.utcnow()))
+        self.client.logger.error(f"Refresh of {guild} cancelled after {time_limit}s: {cause}")
+
+    async def refresh_guild(self, progress: dict, guild_name=None, guild_id=None, weight_req=None) -> bool:
+        """Refreshes the guild's members and writes the guild, False when the guild wasn't written"""
         r = await self.client.httpr.get_guild_data(name=guild_name, _id=guild_id)
         guild_data = r["guild"]
         if not guild_data:
-            return
+            return False
         members = [i["uuid"] for i in guild_data["members"]]
 
         guild_stats = {
@@ -200,15 +237,24 @@ SELECT name FROM players WHERE uuid=$1 LIMIT 1;
         # does_not_need_update_uuids = await self.client.db.does_not_need_update()
         # print(does_not_need_update_uuids)
         # return
+        progress["total"] = len(members)
+        progress["stage"] = "resolving names"
+        await self.client.names.get_names(members)  # one lookup for the whole guild, get_player reads it from memory
+        progress["stage"] = "refreshing players"
         tasks = []
-        for uuid in members:
-            tasks.append(self.client.loop.create_task(self.get_player(guild_stats, uuid)))
-            if len(tasks) >= 2:
-                await asyncio.wait(tasks)
-                tasks = []
-
-        if tasks:
-            await asyncio.wait(tasks)
+        try:
+            for uuid in members:
+                tasks.append(self.client.loop.create_task(self.get_player(guild_stats, uuid)))
+                if len(tasks) >= 2:
+                    await self.wait_players(tasks, guild_stats, progress)
+                    tasks = []
+
+            if tasks:
+                await self.wait_players(tasks, guild_stats, progress)
+        finally:
+            for task in tasks:  # still running when the deadline hit
+                task.cancel()
+        await self.client.weights.flush()  # one write for every profile whose weight changed
 
         if guild_stats["count"] != len(members):
             print("Count mismatch", guild_stats["count"], len(members), guild_name)
@@ -225,28 +271,45 @@ SELECT name FROM players WHERE uuid=$1 LIMIT 1;
         print(new_guild_stats)
         if weight_req and new_guild_stats["senither_weight"] < weight_req:
             print("Not adding", guild_name or guild_id)
-            return
+            return False
 
         print("Adding", guild_name or guild_id)
-        old_guild_members = await self.client.db.get_guild_members(guild_data["_id"])
+        progress["stage"] = "writing the guild"
+        self.client.logger.info(f"Networth requests saved so far: {self.client.networth}")
+        self.client.logger.info(f"Profile weights so far: {self.client.weights}")
         new_guild_members = [i["uuid"] for i in guild_data["members"]]
-
-        await self.client.db.insert_new_guild(
-            guild_id=guild_data["_id"],
-            guild_name=guild_data["name"],
-            players=new_guild_members,
-            senither_weight=new_guild_stats["senither_weight"],
-            lily_weight=new_guild_stats["lily_weight"],
-            skills=new_guild_stats["skills"],
-            catacombs=new_guild_stats["catacombs"],
-            slayer=new_guild_stats["slayer"],
-            scammers=new_guild_stats["scammers"],
-            networth=new_guild_stats["networth"],
-            sb_experience=new_guild_stats["sb_experience"],
-        )
-        await self.add_guild_history(old_guild_members, new_guild_members, guild_data["_id"], guild_data["name"])
-
-        self.client.loop.create_task(self.update_positions())
+        async with self.client.db.pool.acquire() as conn:
+            async with conn.transaction():  # a guild without its history would lose the joins and leaves for good
+                old_guild_members = await self.client.db.get_guild_members(guild_data["_id"], conn)
+                await self.client.db.insert_new_guild(
+                    guild_id=guild_data["_id"],
+                    guild_name=guild_data["name"],
+                    players=new_guild_members,
+                    senither_weight=new_guild_stats["senither_weight"],
+                    lily_weight=new_guild_stats["lily_weight"],
+                    skills=new_guild_stats["skills"],
+                    catacombs=new_guild_stats["catacombs"],
+                    slayer=new_guild_stats["slayer"],
+                    scammers=new_guild_stats["scammers"],
+                    networth=new_guild_stats["networth"],
+                    sb_experience=new_guild_stats["sb_experience"],
+                    conn=conn,
+                )
+                progress["stage"] = "writing the history"
+                await self.add_guild_history(
+                    old_guild_members, new_guild_members, guild_data["_id"], guild_data["name"], conn
+                )
+        return True
+
+    async def wait_players(self, tasks: list, guild_stats: dict, progress: dict):
+        await asyncio.wait(tasks)
+        progress["players"] = guild_stats["count"]
+        for task in tasks:
+            if not task.cancelled() and task.exception() is not None:
+                progress["error"] = repr(task.exception())
+                if isinstance(task.exception(), DeadlineExceeded):
+                    raise task.exception()
+                self.client.logger.error(f"Error refreshing a player {progress['error']}")
 
     async def delete_old_records(self):
         # members = await self.client.httpr.get_guild_members(name=self.guilds_to_add[0])
@@ -267,13 +330,20 @@ DELETE FROM player_metrics WHERE (NOW()::date - '90 day'::interval) > capture_da
     async def update_guilds(self):
         while True:
             r = await self.client.db.pool.fetch("""
-SELECT guild_id FROM (SELECT DISTINCT ON (guild_id) * FROM guilds ORDER BY guild_id, capture_date DESC) AS latest_guilds WHERE (NOW() - capture_date::timestamptz at time zone 'UTC') > '1 day'::interval;
-""")
+SELECT guild_id FROM (SELECT DISTINCT ON (guild_id) * FROM guilds ORDER BY guild_id, capture_date DESC) AS latest_guilds WHERE (NOW() - capture_date::timestamptz at time zone 'UTC') > $1::interval;
+""", GUILD_REFRESH_INTERVAL)
+            weight_stats = dict(self.client.weights.stats)
             for guild_id in r:
                 try:
-                    await self.add_new_guild(guild_id=guild_id[0])
+                    with request_priority("refresh"):
+                        await self.add_new_guild(guild_id=guild_id[0])
                 except asyncio.exceptions.TimeoutError:
                     pass
+            if r:
+                self.client.logger.info(
+                    f"Refreshed {len(r)} guilds, reused {round(self.client.weights.reuse_rate(weight_stats) * 100, 1)}% "
+                    f"of the profile weights"
+                )
             await asyncio.sleep(10)
 
     async def update_positions(self):
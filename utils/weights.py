@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import collections
+import os
+from array import array
+from itertools import chain
+from typing import TYPE_CHECKING
+
+from lilyweight import LilyWeight
+
+from objects import codec
+from objects.api_objects import senither_components, senither_inputs, lily_weight_inputs
+
+if TYPE_CHECKING:
+    from main import Client
+
+# memory keeps weights until restart, postgres also stores them in weight_components
+WEIGHT_CACHE_BACKEND = os.getenv("WEIGHT_CACHE_BACKEND", "memory")
+
+
+def _lily_key(args: tuple, slayers: dict) -> tuple:
+    """Everything LilyWeight.get_weight_raw(*args, **slayers) reads, flattened"""
+    *dicts, cata_xp = args
+    key = [cata_xp]
+    for values in (*dicts, slayers):
+        key.append(len(values))
+        key.extend(chain.from_iterable(values.items()))
+    return tuple(key)
+
+
+def _pack_lily(weight: dict) -> tuple:
+    return (
+        weight["skill_weight"]["base"], weight["skill_weight"]["overflow"], weight["catacombs"]["completion"]["base"],
+        weight["catacombs"]["completion"]["master"], weight["catacombs"]["experience"], weight["slayer"],
+        weight["total"],
+    )
+
+
+def _unpack_lily(packed: tuple) -> dict:
+    """The dict LilyWeight.get_weight_raw returned for packed"""
+    skill, overflow, completion, master, experience, slayer, total = packed
+    return {
+        "total": total,
+        "skill_weight": {"base": skill, "overflow": overflow},
+        "catacombs": {"completion": {"base": completion, "master": master}, "experience": experience},
+        "slayer": slayer,
+    }
+
+
+class _Entry:
+    """The last weights computed for one profile, with what they were computed from"""
+
+    __slots__ = ("senither_key", "senither", "lily_key", "lily")
+
+    def __init__(self, senither_key: array = None, senither: tuple = None, lily_key: tuple = None,
+                 lily: tuple = None):
+        self.senither_key = senither_key
+        self.senither = senither  # (slayer, skill, dungeon)
+        self.lily_key = lily_key
+        self.lily = lily  # _pack_lily of the result
+
+    def dumps(self) -> str:
+        return codec.dumps({
+            "senither": None if self.senither is None else [list(self.senither_key), self.senither],
+            "lily": None if self.lily is None else [self.lily_key, self.lily],
+        }).decode()
+
+    @classmethod
+    def loads(cls, data: str) -> "_Entry":
+        data = codec.loads(data)
+        entry = cls()
+        if data.get("senither"):
+            entry.senither_key, entry.senither = array("d", data["senither"][0]), tuple(data["senither"][1])
+        if data.get("lily"):
+            entry.lily_key, entry.lily = tuple(data["lily"][0]), tuple(data["lily"][1])
+        return entry
+
+
+class WeightCache:
+    """
+    The senither components and lily weight of every profile we've seen, keyed by the XP they were computed from.
+    A refresh of a profile whose XP didn't change reuses them instead of computing them again. A profile's weight is
+    computed or reused as a whole, the parts are too cheap to be worth a lookup each.
+    benchmarks/bench_weight_cache.py checks that a reuse is cheaper than computing and that the results are the same.
+    """
+
+    def __init__(self, client: Client, max_size: int = 20000, backend: str = WEIGHT_CACHE_BACKEND):
+        if backend not in ("memory", "postgres"):
+            raise ValueError(f"Invalid weight cache backend: {backend}")
+        self.client = client
+        self.max_size = max_size
+        self.backend = backend
+        self._players = collections.OrderedDict()  # uuid: {profile_id: _Entry}, least recently refreshed first
+        self._loaded = set()  # uuids already looked up in the database
+        self._dirty = set()  # (uuid, profile_id) with weights the database doesn't have yet
+        self.stats = {"reused": 0, "computed": 0}
+
+    def __repr__(self):
+        return f"<WeightCache players: {len(self._players)} reuse_rate: {round(self.reuse_rate(), 2)} {self.stats}>"
+
+    async def open(self):
+        if self.backend == "postgres":
+            await self.client.db.create_weight_components()
+        self.client.logger.info(f"WeightCache has been initialized ({self.backend})")
+        return self
+
+    def reuse_rate(self, since: dict = None) -> float:
+        """Fraction of weights reused instead of computed, since is an earlier copy of stats"""
+        since = since or {}
+        reused = self.stats["reused"] - since.get("reused", 0)
+        total = reused + self.stats["computed"] - since.get("computed", 0)
+        return reused / total if total else 0.0
+
+    def _touch(self, uuid: str) -> dict:
+        profiles = self._players.get(uuid)
+        if profiles is None:
+            profiles = self._players[uuid] = {}
+            self._evict()
+        else:
+            self._players.move_to_end(uuid)
+        return profiles
+
+    def _evict(self):
+        while len(self._players) > self.max_size:
+            evicted, profiles = self._players.popitem(last=False)
+            self._loaded.discard(evicted)
+            for profile_id in profiles:
+                self._dirty.discard((evicted, profile_id))
+
+    def _entry(self, uuid: str, profile_id: str) -> _Entry:
+        profiles = self._touch(uuid)
+        entry = profiles.get(profile_id)
+        if entry is None:
+            entry = profiles[profile_id] = _Entry()
+        return entry
+
+    def senither_components(self, uuid: str, profile_id: str, member: dict) -> dict:
+        """senither_components(member) of uuid's profile_id"""
+        entry = self._entry(uuid, profile_id)
+        key = senither_inputs(member)
+        if entry.senither is not None and entry.senither_key == key:
+            self.stats["reused"] += 1
+            slayer, skill, dungeon = entry.senither
+            return {"slayer": slayer, "skill": skill, "dungeon": dungeon}
+        components = senither_components(member)
+        entry.senither_key = key
+        entry.senither = (components["slayer"], components["skill"], components["dungeon"])
+        self.stats["computed"] += 1
+        self._dirty.add((uuid, profile_id))
+        return components
+
+    def lily_weight(self, uuid: str, profile_id: str, member: dict, skill_level_dict: dict = None,
+                    skill_experience_dict: dict = None) -> dict:
+        """lily_weight_of(member, skill_level_dict, skill_experience_dict) of uuid's profile_id"""
+        entry = self._entry(uuid, profile_id)
+        args, slayers = lily_weight_inputs(member, skill_level_dict, skill_experience_dict)
+        key = _lily_key(args, slayers)
+        if entry.lily is not None and entry.lily_key == key:
+            self.stats["reused"] += 1
+            return _unpack_lily(entry.lily)
+        weight = LilyWeight.get_weight_raw(*args, **slayers)
+        entry.lily_key, entry.lily = key, _pack_lily(weight)
+        self.stats["computed"] += 1
+        self._dirty.add((uuid, profile_id))
+        return weight
+
+    async def load(self, uuid: str):
+        """Gets uuid's weights from the database the first time uuid is refreshed after a restart"""
+        if self.backend != "postgres" or uuid in self._loaded:
+            return
+        self._loaded.add(uuid)
+        if uuid in self._players:
+            self._players.move_to_end(uuid)
+            return
+        rows = await self.client.db.get_weight_components(uuid)
+        if rows:
+            self._players[uuid] = {row["profile_id"]: _Entry.loads(row["components"]) for row in rows}
+            self._evict()
+
+    async def flush(self):
+        """Stores the weights recomputed since the last flush, in one query"""
+        if self.backend != "postgres" or not self._dirty:
+            self._dirty.clear()
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = [
+            (uuid, profile_id, self._players[uuid][profile_id].dumps()) for uuid, profile_id in dirty
+            if profile_id in self._players.get(uuid, {})
+        ]
+        try:
+            await self.client.db.set_weight_components(rows)
+        except BaseException:
+            self._dirty |= dirty  # tried again with the next flush
+            raise